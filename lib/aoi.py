@@ -0,0 +1,109 @@
+"""
+Area of interest for clipped orthorectification.
+
+--aoi is either a geographic bbox "xmin,xmax,ymin,ymax" (the order used by
+--catalog_bbox) or a vector file whose features are unioned.  Images whose
+metadata footprint misses the AOI are skipped before they are staged or
+opened, and the warp extent of the others is the intersection of the image
+footprint and the AOI.
+"""
+
+import os, logging
+
+import ogr, osr
+
+from lib import dg_metadata
+
+logger = logging.getLogger("logger")
+
+WGS84 = 4326
+
+_memo = {}
+
+
+def _geographic():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(WGS84)
+    return srs
+
+
+def load(spec):
+    """AOI geometry in geographic coordinates, memoized per spec."""
+    geom = _memo.get(spec)
+    if geom is None:
+        if os.path.isfile(spec):
+            geom = _load_vector(spec)
+        else:
+            geom = _load_bbox(spec)
+        _memo[spec] = geom
+    return geom.Clone()
+
+
+def _load_bbox(spec):
+    try:
+        xmin, xmax, ymin, ymax = [float(v) for v in spec.split(",")]
+    except ValueError:
+        raise ValueError("AOI is neither a vector file nor a xmin,xmax,ymin,ymax bbox: %s" % spec)
+    wkt = 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' % (
+        xmin, ymin, xmin, ymax, xmax, ymax, xmax, ymin, xmin, ymin)
+    return ogr.CreateGeometryFromWkt(wkt)
+
+
+def _load_vector(path):
+    ds = ogr.Open(path)
+    if ds is None:
+        raise ValueError("Cannot open AOI file: %s" % path)
+    g_srs = _geographic()
+    union = None
+    for i in range(ds.GetLayerCount()):
+        lyr = ds.GetLayer(i)
+        l_srs = lyr.GetSpatialRef()
+        ct = None
+        if l_srs is not None and not l_srs.IsSame(g_srs):
+            ct = osr.CoordinateTransformation(l_srs, g_srs)
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                continue
+            geom = geom.Clone()
+            if ct is not None:
+                geom.Transform(ct)
+            union = geom if union is None else union.Union(geom)
+    ds = None
+    if union is None or union.IsEmpty():
+        raise ValueError("AOI file has no geometries: %s" % path)
+    return union
+
+
+def intersects_metadata(spec, metapath):
+    """
+    False only if the footprint in the image's DG metadata is known to miss
+    the AOI; images without a readable footprint are kept.
+    """
+    if metapath is None or os.path.splitext(metapath)[1].lower() != ".xml":
+        return True
+    try:
+        footprint = dg_metadata.read(metapath).footprint
+    except Exception as e:
+        logger.debug("Cannot read footprint from %s: %s" % (metapath, e))
+        return True
+    if not footprint:
+        return True
+    pts = list(footprint) + [footprint[0]]
+    wkt = "POLYGON (( %s ))" % ", ".join(["%f %f" % pt for pt in pts])
+    return load(spec).Intersects(ogr.CreateGeometryFromWkt(wkt))
+
+
+def clip(spec, extent_geom, t_srs):
+    """
+    Intersection of extent_geom (in t_srs) with the AOI, in t_srs, or None
+    if they do not intersect.
+    """
+    geom = load(spec)
+    g_srs = _geographic()
+    if not g_srs.IsSame(t_srs):
+        geom.Transform(osr.CoordinateTransformation(g_srs, t_srs))
+    inter = extent_geom.Intersection(geom)
+    if inter is None or inter.IsEmpty():
+        return None
+    return inter
@@ -0,0 +1,321 @@
+"""
+SQLite scene catalog.
+
+A catalog holds one row per image with its file path, size and mtime plus the
+DG metadata fields batch runs filter and rank on (acquisition time, cloud
+cover, sun elevation, off-nadir angle, footprint) and per-band ABSCALFACTOR /
+EFFECTIVEBANDWIDTH.  Footprints are indexed in an SQLite R*Tree so spatial
+queries do not scan the table.  An archive is crawled once with
+pgc_catalog.py; ortho and mosaic runs accept the catalog file in place of a
+source directory and query it instead of re-crawling and re-parsing xmls.
+"""
+
+import os, json, sqlite3, logging
+
+from lib import dg_metadata
+
+logger = logging.getLogger("logger")
+
+CATALOG_EXTS = [".db", ".sqlite"]
+
+#### Options added by add_query_arguments, stripped from child job arg lists
+QUERY_ARG_KEYS = ("catalog_bbox", "catalog_sensors", "catalog_start", "catalog_end",
+                  "catalog_max_cloudcover", "catalog_min_sunel", "catalog_max_offnadir")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    xmlpath TEXT,
+    xmlmtime REAL,
+    satid TEXT,
+    catid TEXT,
+    acqtime TEXT,
+    sunel REAL,
+    offnadir REAL,
+    cloudcover REAL,
+    numrows INTEGER,
+    numcolumns INTEGER,
+    minx REAL,
+    maxx REAL,
+    miny REAL,
+    maxy REAL,
+    footprint TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_catid ON scenes (catid);
+CREATE INDEX IF NOT EXISTS scenes_acqtime ON scenes (acqtime);
+CREATE TABLE IF NOT EXISTS scene_bands (
+    scene_id INTEGER NOT NULL,
+    band TEXT NOT NULL,
+    abscalfactor REAL,
+    effectivebandwidth REAL,
+    tdilevel INTEGER,
+    PRIMARY KEY (scene_id, band)
+);
+"""
+
+
+def is_catalog(path):
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in CATALOG_EXTS
+
+
+def find_xml(srcfp):
+    """Default metadata locator: <image>.xml or <image>.XML."""
+    for ext in (".xml", ".XML"):
+        xmlpath = os.path.splitext(srcfp)[0] + ext
+        if os.path.isfile(xmlpath):
+            return xmlpath
+    return None
+
+
+def add_query_arguments(parser):
+    """Adds the catalog filter options to an argparse parser."""
+    parser.add_argument("--catalog_bbox", nargs=4, type=float,
+                        help="when src is a scene catalog, select scenes whose footprint intersects this geographic bbox -- xmin xmax ymin ymax")
+    parser.add_argument("--catalog_sensors", nargs="+",
+                        help="when src is a scene catalog, select scenes from these sensors (e.g. WV02 WV03)")
+    parser.add_argument("--catalog_start",
+                        help="when src is a scene catalog, select scenes acquired on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--catalog_end",
+                        help="when src is a scene catalog, select scenes acquired before this date (YYYY-MM-DD)")
+    parser.add_argument("--catalog_max_cloudcover", type=float,
+                        help="when src is a scene catalog, select scenes with cloud cover <= this fraction")
+    parser.add_argument("--catalog_min_sunel", type=float,
+                        help="when src is a scene catalog, select scenes with sun elevation >= this angle")
+    parser.add_argument("--catalog_max_offnadir", type=float,
+                        help="when src is a scene catalog, select scenes with off-nadir angle <= this angle")
+
+
+def query_from_args(catalog_path, args, prime=True):
+    """
+    Opens catalog_path, returns the image paths matching the catalog options
+    in args and (by default) seeds the metadata memo with their records.
+    """
+    cat = Catalog(catalog_path)
+    try:
+        paths = cat.query(
+            bbox=args.catalog_bbox,
+            sensors=args.catalog_sensors,
+            start=args.catalog_start,
+            end=args.catalog_end,
+            max_cloudcover=args.catalog_max_cloudcover,
+            min_sunel=args.catalog_min_sunel,
+            max_offnadir=args.catalog_max_offnadir,
+        )
+        if prime:
+            cat.prime(paths)
+    finally:
+        cat.close()
+    return paths
+
+
+class Catalog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS scenes_rtree USING rtree(id, minx, maxx, miny, maxy)"
+            )
+            self.rtree = True
+        except sqlite3.OperationalError:
+            #### SQLite built without R*Tree, fall back to a plain bbox index
+            self.conn.execute("CREATE INDEX IF NOT EXISTS scenes_bbox ON scenes (minx, maxx, miny, maxy)")
+            self.rtree = False
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM scenes").fetchone()[0]
+
+    def update(self, image_list, find_xml=find_xml):
+        """
+        Adds or refreshes the rows for image_list.  Images whose size, mtime
+        and metadata mtime are unchanged since the last update are skipped
+        without opening their xml.  Returns (added, updated, unchanged).
+        """
+        existing = dict(
+            (row[0], row[1:]) for row in
+            self.conn.execute("SELECT path, id, size, mtime, xmlmtime FROM scenes")
+        )
+        added = updated = unchanged = 0
+
+        for srcfp in image_list:
+            srcfp = os.path.abspath(srcfp)
+            try:
+                st = os.stat(srcfp)
+            except OSError as e:
+                logger.warning("Cannot stat image %s: %s" % (srcfp, e))
+                continue
+
+            xmlpath = find_xml(srcfp)
+            xmlmtime = os.path.getmtime(xmlpath) if xmlpath else None
+
+            row = existing.get(srcfp)
+            if row is not None and (row[1], row[2], row[3]) == (st.st_size, st.st_mtime, xmlmtime):
+                unchanged += 1
+                continue
+
+            md = None
+            if xmlpath:
+                try:
+                    md = dg_metadata.read(xmlpath)
+                except Exception as e:
+                    logger.warning("Cannot read metadata %s: %s" % (xmlpath, e))
+
+            scene_id = self._write(row[0] if row else None, srcfp, st, xmlpath, xmlmtime, md)
+            if row is None:
+                existing[srcfp] = (scene_id, st.st_size, st.st_mtime, xmlmtime)
+                added += 1
+            else:
+                updated += 1
+
+        self.conn.commit()
+        return added, updated, unchanged
+
+    def _write(self, scene_id, srcfp, st, xmlpath, xmlmtime, md):
+        values = dict(path=srcfp, size=st.st_size, mtime=st.st_mtime,
+                      xmlpath=xmlpath, xmlmtime=xmlmtime)
+        if md is not None:
+            values.update(
+                satid=md.satid, catid=md.catid, acqtime=md.firstlinetime,
+                sunel=md.sunel, offnadir=md.offnadir, cloudcover=md.cloudcover,
+                numrows=md.numrows, numcolumns=md.numcolumns,
+                metadata=json.dumps(md.to_dict()),
+            )
+            if md.footprint:
+                xs = [pt[0] for pt in md.footprint]
+                ys = [pt[1] for pt in md.footprint]
+                ring = list(md.footprint) + [md.footprint[0]]
+                values.update(
+                    minx=min(xs), maxx=max(xs), miny=min(ys), maxy=max(ys),
+                    footprint="POLYGON ((%s))" % ", ".join("%.8f %.8f" % pt for pt in ring),
+                )
+
+        if scene_id is not None:
+            self._delete(scene_id)
+            values["id"] = scene_id
+        keys = sorted(values)
+        cur = self.conn.execute(
+            "INSERT INTO scenes (%s) VALUES (%s)" % (", ".join(keys), ", ".join("?" * len(keys))),
+            [values[k] for k in keys]
+        )
+        scene_id = cur.lastrowid
+
+        if md is not None:
+            self.conn.executemany(
+                "INSERT INTO scene_bands VALUES (?, ?, ?, ?, ?)",
+                [(scene_id, band, md.abscalfactor.get(band), md.effectivebandwidth.get(band),
+                  md.tdilevel.get(band)) for band in md.bands]
+            )
+            if self.rtree and "minx" in values:
+                self.conn.execute(
+                    "INSERT INTO scenes_rtree VALUES (?, ?, ?, ?, ?)",
+                    (scene_id, values["minx"], values["maxx"], values["miny"], values["maxy"])
+                )
+        return scene_id
+
+    def _delete(self, scene_id):
+        self.conn.execute("DELETE FROM scenes WHERE id = ?", (scene_id,))
+        self.conn.execute("DELETE FROM scene_bands WHERE scene_id = ?", (scene_id,))
+        if self.rtree:
+            self.conn.execute("DELETE FROM scenes_rtree WHERE id = ?", (scene_id,))
+
+    def prune(self):
+        """Removes rows whose image no longer exists.  Returns the count."""
+        gone = [row for row in self.conn.execute("SELECT id, path FROM scenes")
+                if not os.path.isfile(row[1])]
+        for scene_id, path in gone:
+            logger.debug("Removing missing image from catalog: %s" % path)
+            self._delete(scene_id)
+        self.conn.commit()
+        return len(gone)
+
+    def query(self, bbox=None, sensors=None, start=None, end=None,
+              max_cloudcover=None, min_sunel=None, max_offnadir=None):
+        """
+        Returns the image paths matching every given filter, ordered by path.
+        bbox is a geographic (xmin, xmax, ymin, ymax) tested against the
+        footprint extent; start/end compare against the acquisition time.
+        Scenes without DG metadata only match when no metadata filter is set.
+        """
+        clauses = []
+        params = []
+
+        if bbox is not None:
+            xmin, xmax, ymin, ymax = bbox
+            if self.rtree:
+                clauses.append("id IN (SELECT id FROM scenes_rtree WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?)")
+            else:
+                clauses.append("minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?")
+            params.extend([xmax, xmin, ymax, ymin])
+        if sensors:
+            clauses.append("satid IN (%s)" % ", ".join("?" * len(sensors)))
+            params.extend([s.upper() for s in sensors])
+        if start is not None:
+            clauses.append("acqtime >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("acqtime < ?")
+            params.append(end)
+        if max_cloudcover is not None:
+            clauses.append("cloudcover <= ?")
+            params.append(max_cloudcover)
+        if min_sunel is not None:
+            clauses.append("sunel >= ?")
+            params.append(min_sunel)
+        if max_offnadir is not None:
+            clauses.append("offnadir <= ?")
+            params.append(max_offnadir)
+
+        sql = "SELECT path FROM scenes"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY path"
+        return [row[0] for row in self.conn.execute(sql, params)]
+
+    def metadata(self, path):
+        """Returns the stored DGMetadata record for an image, or None."""
+        row = self.conn.execute(
+            "SELECT metadata FROM scenes WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return dg_metadata.DGMetadata.from_dict(json.loads(row[0]))
+
+    def bands(self, path):
+        """Returns {band: (abscalfactor, effectivebandwidth, tdilevel)} for an image."""
+        rows = self.conn.execute(
+            "SELECT b.band, b.abscalfactor, b.effectivebandwidth, b.tdilevel "
+            "FROM scene_bands b JOIN scenes s ON s.id = b.scene_id WHERE s.path = ?",
+            (os.path.abspath(path),)
+        )
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def prime(self, paths=None):
+        """
+        Seeds lib.dg_metadata with the stored records of paths (default all),
+        so later metadata reads skip parsing.  Records whose xml has changed
+        since cataloging are re-parsed on read as usual.
+        """
+        if paths is None:
+            rows = self.conn.execute("SELECT metadata FROM scenes WHERE metadata IS NOT NULL")
+        else:
+            wanted = set(os.path.abspath(p) for p in paths)
+            rows = (
+                (row[1],) for row in
+                self.conn.execute("SELECT path, metadata FROM scenes WHERE metadata IS NOT NULL")
+                if row[0] in wanted
+            )
+        n = 0
+        for row in rows:
+            dg_metadata.prime(dg_metadata.DGMetadata.from_dict(json.loads(row[0])))
+            n += 1
+        return n
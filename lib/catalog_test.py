@@ -0,0 +1,56 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import catalog
+from lib import dg_metadata
+
+PGC_XML = "test_data/xml/post_pgc_ortho.xml"
+
+
+class Test_catalog(TestCase):
+    def setUp(self):
+        dg_metadata.clear_memo()
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmpdir, "WV02_scene.tif")
+        open(self.image, "w").close()
+        shutil.copy(PGC_XML, os.path.join(self.tmpdir, "WV02_scene.xml"))
+        self.cat = catalog.Catalog(os.path.join(self.tmpdir, "scenes.db"))
+
+    def tearDown(self):
+        self.cat.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_update_skips_unchanged(self):
+        """second update of the same images reads no metadata."""
+        self.assertEqual(self.cat.update([self.image]), (1, 0, 0))
+        self.assertEqual(self.cat.update([self.image]), (0, 0, 1))
+        self.assertEqual(len(self.cat), 1)
+
+    def test_query_filters(self):
+        """spatial and attribute filters select the scene."""
+        self.cat.update([self.image])
+        self.assertEqual(self.cat.query(bbox=(-85, -84, 30, 31)), [self.image])
+        self.assertEqual(self.cat.query(bbox=(10, 11, 30, 31)), [])
+        self.assertEqual(self.cat.query(sensors=["wv02"], max_cloudcover=0.1), [self.image])
+        self.assertEqual(self.cat.query(min_sunel=50), [])
+        self.assertEqual(self.cat.query(start="2014-03-02"), [])
+
+    def test_bands_and_prime(self):
+        """per-band factors are stored and records seed the metadata memo."""
+        self.cat.update([self.image])
+        self.assertEqual(self.cat.bands(self.image)["BAND_C"][:2], (9.295654e-03, 4.73e-02))
+        dg_metadata.clear_memo()
+        self.assertEqual(self.cat.prime([self.image]), 1)
+        xml = os.path.join(self.tmpdir, "WV02_scene.xml")
+        self.assertIs(dg_metadata.read(xml), dg_metadata.read(xml))
+        self.assertEqual(dg_metadata.read(xml).catid, "103001002E9AC500")
+
+    def test_prune(self):
+        """rows for deleted images are removed."""
+        self.cat.update([self.image])
+        os.remove(self.image)
+        self.assertEqual(self.cat.prune(), 1)
+        self.assertEqual(len(self.cat), 0)
@@ -0,0 +1,213 @@
+"""
+In-process priority compositing of mosaic tiles.
+
+composite() replaces the gdalwarp-per-contributor loop of
+pgc_mosaic_build_tile, where every contributor was a process launch and a
+pass over the same temporary tile, followed by a gdal_translate to compress
+it.  Here each contributor gets a warped VRT covering only its overlap with
+the tile, so it is resampled on read, and the tile is built window by window
+on a thread pool: a window is filled from the contributors in priority
+order, each one only writing pixels that are still nodata, until the window
+is covered.  Windows are written once, straight to the compressed, tiled
+output, with band statistics accumulated on the way, and only a few windows
+per thread are held ahead of the writer.
+
+As with gdalwarp, a contributor pixel is nodata when all its bands are, and
+a higher-priority contributor wins wherever it has data.  With pan_to_multi,
+single-band contributors to a multiband tile are read once and their band
+is copied to every tile band, instead of being written out as an N-band
+copy first.
+"""
+
+import os, math, logging, threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import gdal, gdalconst, osr
+
+from lib import pansharpen
+
+logger = logging.getLogger("logger")
+
+BLOCK = 1024
+#### Warped VRTs (and their open sources) each thread keeps, least recently used closed first
+MAX_OPEN = 16
+CREATION_OPTIONS = ["PHOTOMETRIC=MINISBLACK", "TILED=YES", "BIGTIFF=IF_SAFER"]
+COMPRESSION_OPTIONS = {
+    "lzw": ["COMPRESS=LZW"],
+    "jpeg95": ["COMPRESS=JPEG", "JPEG_QUALITY=95"],
+}
+
+
+class Grid(object):
+    """Pixel grid of a tile, as given to gdalwarp with -te and -tr."""
+
+    def __init__(self, xmin, xmax, ymin, ymax, xres, yres, proj):
+        self.xmin, self.xmax, self.ymin, self.ymax = xmin, xmax, ymin, ymax
+        self.xres, self.yres = xres, yres
+        self.proj = proj
+        self.xsize = int((xmax - xmin) / xres + 0.5)
+        self.ysize = int((ymax - ymin) / yres + 0.5)
+
+    def geotransform(self):
+        return (self.xmin, self.xres, 0, self.ymax, 0, -self.yres)
+
+    def window(self, xmin, xmax, ymin, ymax):
+        """(x0, y0, x1, y1) pixels of the grid covering a box, or None if it misses the grid."""
+        x0 = max(0, int(math.floor((xmin - self.xmin) / self.xres)))
+        x1 = min(self.xsize, int(math.ceil((xmax - self.xmin) / self.xres)))
+        y0 = max(0, int(math.floor((self.ymax - ymax) / self.yres)))
+        y1 = min(self.ysize, int(math.ceil((self.ymax - ymin) / self.yres)))
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def bounds(self, window):
+        """Warp output bounds (xmin, ymin, xmax, ymax) of a window."""
+        x0, y0, x1, y1 = window
+        return (self.xmin + x0 * self.xres, self.ymax - y1 * self.yres,
+                self.xmin + x1 * self.xres, self.ymax - y0 * self.yres)
+
+
+class Source(object):
+    """A contributor and the tile window it covers."""
+
+    def __init__(self, path, window, bands, datatype):
+        self.path = path
+        self.window = window
+        self.bands = bands
+        self.datatype = datatype
+
+
+def _source(path, grid):
+    ds = gdal.Open(path, gdalconst.GA_ReadOnly)
+    if ds is None:
+        logger.warning("Cannot open image: %s" % path)
+        return None
+    window = (0, 0, grid.xsize, grid.ysize)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(ds.GetProjectionRef())
+    tile_srs = osr.SpatialReference()
+    tile_srs.ImportFromWkt(grid.proj)
+    #### Images in other projections or with GCPs are warped over the whole tile
+    if ds.GetGCPCount() == 0 and srs.IsSame(tile_srs):
+        gt = ds.GetGeoTransform()
+        xs = [gt[0], gt[0] + ds.RasterXSize * gt[1]]
+        ys = [gt[3], gt[3] + ds.RasterYSize * gt[5]]
+        window = grid.window(min(xs), max(xs), min(ys), max(ys))
+        if window is None:
+            logger.info("Image does not overlap tile: %s" % path)
+            return None
+    return Source(path, window, ds.RasterCount, ds.GetRasterBand(1).DataType)
+
+
+def composite(images, dstfp, grid, bands=None, nodata=0, compression="lzw", resample="near", threads=1, block=BLOCK,
+              pan_to_multi=False, max_open=MAX_OPEN):
+    """
+    Writes the tile on grid to dstfp from images, ordered from lowest to
+    highest priority (later images cover earlier ones).  The tile takes its
+    data type, and unless given its band count, from the first image.
+    With pan_to_multi, single-band images fill every band.  Each thread
+    keeps at most max_open contributors open.  Returns 0 on success, 1 on
+    failure.
+    """
+    sources = [s for s in [_source(path, grid) for path in images] if s is not None]
+    if len(sources) == 0:
+        logger.error("No images to composite into %s" % dstfp)
+        return 1
+    bands = bands or sources[0].bands
+    datatype = sources[0].datatype
+    def usable(s):
+        return s.bands == bands or (pan_to_multi and s.bands == 1)
+
+    for s in sources:
+        if not usable(s):
+            logger.warning("Skipping image with %i bands instead of %i: %s" % (s.bands, bands, s.path))
+    #### highest priority first
+    sources = [s for s in reversed(sources) if usable(s)]
+
+    driver = gdal.GetDriverByName("GTiff")
+    dst_ds = driver.Create(dstfp, grid.xsize, grid.ysize, bands, datatype,
+                           CREATION_OPTIONS + COMPRESSION_OPTIONS[compression])
+    if dst_ds is None:
+        logger.error("Cannot create tile: %s" % dstfp)
+        return 1
+    dst_ds.SetGeoTransform(grid.geotransform())
+    dst_ds.SetProjection(grid.proj)
+    for b in range(bands):
+        dst_ds.GetRasterBand(b + 1).SetNoDataValue(nodata)
+
+    dtype = pansharpen.gdal_array_type(datatype)
+    local = threading.local()
+
+    def warped(s):
+        #### GDAL datasets are not thread safe: one set of VRTs per thread
+        if not hasattr(local, "vrts"):
+            local.vrts = OrderedDict()
+        vrt = local.vrts.pop(s.path, None)
+        if vrt is None:
+            x0, y0, x1, y1 = s.window
+            vrt = gdal.Warp("", s.path, format="VRT", outputBounds=grid.bounds(s.window), width=x1 - x0, height=y1 - y0,
+                            dstSRS=grid.proj, srcNodata=nodata, dstNodata=nodata, resampleAlg=resample)
+            if vrt is None:
+                return None
+            while len(local.vrts) >= max(1, max_open):
+                local.vrts.popitem(last=False)
+        local.vrts[s.path] = vrt
+        return vrt
+
+    def work(window):
+        xoff, yoff, w, h = window
+        out = numpy.full((bands, h, w), nodata, dtype=dtype)
+        empty = numpy.ones((h, w), dtype=bool)
+        for s in sources:
+            x0, y0, x1, y1 = s.window
+            ix0, iy0 = max(xoff, x0), max(yoff, y0)
+            ix1, iy1 = min(xoff + w, x1), min(yoff + h, y1)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            rows = slice(iy0 - yoff, iy1 - yoff)
+            cols = slice(ix0 - xoff, ix1 - xoff)
+            todo = empty[rows, cols]
+            if not todo.any():
+                continue
+            vrt = warped(s)
+            if vrt is None:
+                raise RuntimeError("Cannot warp %s to the tile grid" % s.path)
+            data = vrt.ReadAsArray(ix0 - x0, iy0 - y0, ix1 - ix0, iy1 - iy0)
+            if data.ndim == 2:
+                data = data[numpy.newaxis]
+            fill = todo & numpy.any(data != nodata, axis=0)
+            region = out[:, rows, cols]
+            #### a single-band image broadcasts to every band
+            region[:, fill] = data[:, fill]
+            todo[fill] = False
+            if not empty.any():
+                break
+        return window, out, ~empty
+
+    windows = [(x, y, min(block, grid.xsize - x), min(block, grid.ysize - y))
+               for y in range(0, grid.ysize, block) for x in range(0, grid.xsize, block)]
+    stats = pansharpen.RunningStats(bands)
+    pool = ThreadPool(max(1, threads))
+    rc = 0
+    try:
+        inflight = pansharpen.INFLIGHT_PER_THREAD * max(1, threads)
+        for (xoff, yoff, w, h), out, valid in pansharpen.imap_bounded(pool, work, windows, inflight):
+            for b in range(bands):
+                dst_ds.GetRasterBand(b + 1).WriteArray(out[b], xoff, yoff)
+            stats.add(out, valid)
+    except Exception as e:
+        logger.error("Compositing failed: %s" % e)
+        rc = 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if rc == 0:
+        stats.write(dst_ds)
+    dst_ds = None
+    if rc == 1 and os.path.isfile(dstfp):
+        os.remove(dstfp)
+    return rc
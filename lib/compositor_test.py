@@ -0,0 +1,94 @@
+# std modules:
+from unittest import TestCase, skipIf
+import os
+import shutil
+import tempfile
+
+import numpy
+
+try:
+    import gdal, osr
+    from lib import compositor
+except ImportError:
+    gdal = None
+
+
+@skipIf(gdal is None, "GDAL is not installed")
+class Test_compositor(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3413)
+        self.proj = srs.ExportToWkt()
+        self.grid = compositor.Grid(0, 4, 0, 4, 1.0, 1.0, self.proj)
+        self.dstfp = os.path.join(self.tmpdir, "tile.tif")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def image(self, name, data):
+        """Writes data (bands x 4 x 4) as a GTiff on the tile grid."""
+        data = numpy.asarray(data, dtype=numpy.uint16)
+        path = os.path.join(self.tmpdir, name + ".tif")
+        ds = gdal.GetDriverByName("GTiff").Create(path, 4, 4, data.shape[0], gdal.GDT_UInt16)
+        ds.SetGeoTransform(self.grid.geotransform())
+        ds.SetProjection(self.proj)
+        for b in range(data.shape[0]):
+            ds.GetRasterBand(b + 1).WriteArray(data[b])
+        ds = None
+        return path
+
+    def tile(self):
+        return gdal.Open(self.dstfp).ReadAsArray()
+
+    def test_higher_priority_wins(self):
+        """where both images have data the later (higher score) one is kept."""
+        low = self.image("low", numpy.full((2, 4, 4), 1))
+        high = self.image("high", numpy.full((2, 4, 4), 2))
+        self.assertEqual(compositor.composite([low, high], self.dstfp, self.grid), 0)
+        self.assertTrue((self.tile() == 2).all())
+
+    def test_lower_priority_fills_nodata(self):
+        """a lower priority image only fills pixels the others leave nodata."""
+        data = numpy.full((2, 4, 4), 2)
+        data[:, :, :2] = 0
+        data[0, 3, 3] = 0  # one band nodata is still data
+        low = self.image("low", numpy.full((2, 4, 4), 1))
+        high = self.image("high", data)
+        self.assertEqual(compositor.composite([low, high], self.dstfp, self.grid, threads=2, block=2), 0)
+        tile = self.tile()
+        self.assertTrue((tile[:, :, :2] == 1).all())
+        self.assertTrue((tile[1, :, 2:] == 2).all())
+        self.assertEqual(tile[0, 3, 3], 0)
+
+    def test_covered_window_stops(self):
+        """once a window is covered, lower priority images are not read."""
+        low = self.image("low", numpy.full((1, 4, 4), 1))
+        high = self.image("high", numpy.full((1, 4, 4), 2))
+        warped = []
+        warp = compositor.gdal.Warp
+
+        def record(dst, src, **kwargs):
+            warped.append(src)
+            return warp(dst, src, **kwargs)
+
+        compositor.gdal.Warp = record
+        try:
+            self.assertEqual(compositor.composite([low, high], self.dstfp, self.grid), 0)
+        finally:
+            compositor.gdal.Warp = warp
+        self.assertEqual(warped, [high])
+
+    def test_pan_to_multi(self):
+        """a single-band image fills every band of a multiband tile."""
+        multi = numpy.full((3, 4, 4), 5)
+        multi[:, 0, :] = 0
+        ms = self.image("ms", multi)
+        pan = self.image("pan", [numpy.arange(16).reshape(4, 4) + 1])
+        self.assertEqual(compositor.composite([pan, ms], self.dstfp, self.grid, 3), 0)
+        tile = self.tile()
+        for b in range(3):
+            self.assertTrue((tile[b, 0] == [1, 2, 3, 4]).all())
+            self.assertTrue((tile[b, 1:] == 5).all())
+        self.assertEqual(compositor.composite([pan, ms], self.dstfp, self.grid, 3, pan_to_multi=False), 0)
+        self.assertTrue((self.tile()[:, 0] == 0).all())
@@ -0,0 +1,228 @@
+"""
+Per-scene DEM crops for RPC orthorectification.
+
+With --dem every warp points RPC_DEM at the full DEM, so the RPC
+transformer pages through a large shared file for each scene.  DemCache
+crops the DEM to the scene footprint plus a buffer, optionally reprojecting
+it, and keeps the crops in a directory shared by all jobs.  Crop windows are
+snapped outward to a grid of DEM pixels and any cached crop containing a
+scene's window is reused, so overlapping scenes share crops.  The store is
+kept under a size limit by evicting the least recently used crops.
+
+DEM extent and spatial reference are read once per DEM and memoized
+(dem_info), which overlap_check uses as well.
+"""
+
+import os, math, glob, time, hashlib, logging
+
+import gdal, osr, ogr, gdalconst
+
+logger = logging.getLogger("logger")
+
+#### Crop windows are snapped outward to multiples of TILE DEM pixels after
+#### adding BUFFER pixels around the footprint
+TILE = 512
+BUFFER = 64
+#### Crops used within this many seconds are never evicted, since another
+#### job may be about to open them
+MIN_AGE = 600
+
+_info = {}
+
+
+class DemInfo(object):
+    __slots__ = ("path", "srs_wkt", "geotransform", "xsize", "ysize")
+
+    def srs(self):
+        return osr.SpatialReference(self.srs_wkt)
+
+    def bounds(self):
+        """(minx, miny, maxx, maxy) in the DEM spatial reference."""
+        gt = self.geotransform
+        xs = (gt[0], gt[0] + self.xsize * gt[1])
+        ys = (gt[3], gt[3] + self.ysize * gt[5])
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def extent_wkt(self):
+        minx, miny, maxx, maxy = self.bounds()
+        return 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' % (
+            minx, miny, minx, maxy, maxx, maxy, maxx, miny, minx, miny)
+
+
+def dem_info(path):
+    """
+    Memoized DemInfo for the DEM at path, or None if it cannot be opened.
+    srs_wkt is empty if the DEM has no spatial reference.
+    """
+    key = os.path.abspath(path)
+    try:
+        mtime = os.path.getmtime(key)
+    except OSError:
+        mtime = None
+    cached = _info.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    ds = gdal.Open(path, gdalconst.GA_ReadOnly)
+    if ds is None:
+        return None
+    info = DemInfo()
+    info.path = key
+    info.srs_wkt = ds.GetProjectionRef()
+    info.geotransform = ds.GetGeoTransform()
+    info.xsize = ds.RasterXSize
+    info.ysize = ds.RasterYSize
+    ds = None
+    _info[key] = (mtime, info)
+    return info
+
+
+def snap_window(bounds, gt, xsize, ysize, buffer=BUFFER, tile=TILE):
+    """
+    Pixel window (xoff, yoff, xsize, ysize) covering bounds (minx, miny,
+    maxx, maxy) plus buffer pixels, snapped outward to multiples of tile and
+    clipped to the raster.  Returns None if it misses the raster.
+    """
+    minx, miny, maxx, maxy = bounds
+    px = sorted([(minx - gt[0]) / gt[1], (maxx - gt[0]) / gt[1]])
+    py = sorted([(miny - gt[3]) / gt[5], (maxy - gt[3]) / gt[5]])
+    x0 = int(math.floor(px[0])) - buffer
+    x1 = int(math.ceil(px[1])) + buffer
+    y0 = int(math.floor(py[0])) - buffer
+    y1 = int(math.ceil(py[1])) + buffer
+
+    x0 = max(0, (x0 // tile) * tile)
+    y0 = max(0, (y0 // tile) * tile)
+    x1 = min(xsize, -(-x1 // tile) * tile)
+    y1 = min(ysize, -(-y1 // tile) * tile)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def contains(outer, inner):
+    ox, oy, ow, oh = outer
+    ix, iy, iw, ih = inner
+    return ox <= ix and oy <= iy and ix + iw <= ox + ow and iy + ih <= oy + oh
+
+
+class DemCache(object):
+
+    def __init__(self, cache_dir, max_mb=4096, epsg=None):
+        """
+        cache_dir is shared by every job using the same DEMs.  If epsg is
+        given the crops are reprojected to it.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.epsg = epsg
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def crop(self, dempath, geometry_wkt, geometry_srs, run):
+        """
+        Path of a cached crop of dempath covering geometry_wkt (in
+        geometry_srs), creating it with run(cmd) -> (err, so, se) if no
+        cached crop contains it.  Returns None if no crop could be made.
+        """
+        info = dem_info(dempath)
+        if info is None or not info.srs_wkt:
+            return None
+
+        geom = ogr.CreateGeometryFromWkt(geometry_wkt)
+        dem_srs = info.srs()
+        if not geometry_srs.IsSame(dem_srs):
+            geom.Transform(osr.CoordinateTransformation(geometry_srs, dem_srs))
+        minx, maxx, miny, maxy = geom.GetEnvelope()
+        window = snap_window((minx, miny, maxx, maxy), info.geotransform, info.xsize, info.ysize)
+        if window is None:
+            return None
+
+        prefix = self._prefix(info)
+        for fp, w in self._entries(prefix):
+            if contains(w, window):
+                self._touch(fp)
+                logger.info("Reusing DEM crop: %s" % os.path.basename(fp))
+                return fp
+
+        fp = os.path.join(self.cache_dir, "%s_%d_%d_%d_%d.tif" % ((prefix,) + window))
+        tmp = "%s.%d.tmp.tif" % (os.path.splitext(fp)[0], os.getpid())
+        cmd = self._crop_cmd(info, window, tmp)
+        err, so, se = run(cmd)
+        if err == 1 or not os.path.isfile(tmp):
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return None
+        os.rename(tmp, fp)
+        logger.info("Cropped DEM to %s (%d x %d pixels)" % (os.path.basename(fp), window[2], window[3]))
+        self.evict(keep=fp)
+        return fp
+
+    def evict(self, keep=None):
+        """Removes least recently used crops until the store fits max_mb."""
+        entries = []
+        for fp in glob.glob(os.path.join(self.cache_dir, "*.tif")):
+            if fp.endswith(".tmp.tif"):
+                continue
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fp))
+        total = sum([e[1] for e in entries])
+        now = time.time()
+        for mtime, size, fp in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fp == keep or now - mtime < MIN_AGE:
+                continue
+            try:
+                os.remove(fp)
+                total -= size
+                logger.debug("Evicted DEM crop: %s" % os.path.basename(fp))
+            except OSError:
+                pass
+
+    def _prefix(self, info):
+        """Crop name prefix identifying the DEM version and output srs."""
+        st = os.stat(info.path)
+        h = hashlib.sha1(("%s|%d|%f" % (info.path, st.st_size, st.st_mtime)).encode("utf-8")).hexdigest()[:10]
+        prefix = "%s_%s" % (os.path.splitext(os.path.basename(info.path))[0], h)
+        if self.epsg:
+            prefix += "_epsg%d" % self.epsg
+        return prefix
+
+    def _entries(self, prefix):
+        """(path, window) of the cached crops named prefix_<window>.tif."""
+        entries = []
+        for fp in glob.glob(os.path.join(self.cache_dir, prefix + "_*.tif")):
+            parts = os.path.basename(fp)[len(prefix) + 1:-4].split("_")
+            try:
+                window = tuple([int(p) for p in parts])
+            except ValueError:
+                continue
+            if len(window) == 4:
+                entries.append((fp, window))
+        return entries
+
+    def _touch(self, fp):
+        try:
+            os.utime(fp, None)
+        except OSError:
+            pass
+
+    def _crop_cmd(self, info, window, dst):
+        xoff, yoff, xsize, ysize = window
+        co = "-co TILED=YES -co COMPRESS=LZW -co BIGTIFF=IF_SAFER"
+        if not self.epsg:
+            return 'gdal_translate -of GTiff %s -srcwin %d %d %d %d "%s" "%s"' % (
+                co, xoff, yoff, xsize, ysize, info.path, dst)
+        gt = info.geotransform
+        xs = (gt[0] + xoff * gt[1], gt[0] + (xoff + xsize) * gt[1])
+        ys = (gt[3] + yoff * gt[5], gt[3] + (yoff + ysize) * gt[5])
+        return 'gdalwarp -of GTiff %s -r bilinear -te %.12f %.12f %.12f %.12f -te_srs "%s" -t_srs EPSG:%d "%s" "%s"' % (
+            co, min(xs), min(ys), max(xs), max(ys), info.srs().ExportToProj4(), self.epsg, info.path, dst)
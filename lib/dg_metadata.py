@@ -0,0 +1,256 @@
+"""
+DigitalGlobe IMD metadata reader.
+
+Extracts the fields we use from a DG .XML (or a pgc_ortho output .xml that
+wraps it in SOURCE_IMD) in a single iterparse pass that stops at the end of
+the IMD block, so the large EPH/ATT/TIL sections are never parsed.  Records
+are memoized per (path, mtime) and can optionally be persisted to an on-disk
+cache directory (see set_cache_dir) so batch runs over thousands of scenes
+only parse each file once.
+"""
+
+import os, json, hashlib, logging
+from datetime import datetime
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+logger = logging.getLogger("logger")
+
+CACHE_ENV_VAR = "DG_METADATA_CACHE"
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+#### IMD/IMAGE tags and the record attribute each one populates
+IMAGE_TAGS = {
+    "SATID": ("satid", str),
+    "CATID": ("catid", str),
+    "FIRSTLINETIME": ("firstlinetime", str),
+    "MEANSUNEL": ("sunel", float),
+    "SUNEL": ("sunel", float),
+    "MEANSUNAZ": ("sunaz", float),
+    "SUNAZ": ("sunaz", float),
+    "MEANSATEL": ("satel", float),
+    "SATEL": ("satel", float),
+    "MEANSATAZ": ("sataz", float),
+    "SATAZ": ("sataz", float),
+    "MEANOFFNADIRVIEWANGLE": ("offnadir", float),
+    "OFFNADIRVIEWANGLE": ("offnadir", float),
+    "CLOUDCOVER": ("cloudcover", float),
+}
+IMD_TAGS = {
+    "NUMROWS": ("numrows", int),
+    "NUMCOLUMNS": ("numcolumns", int),
+    "BANDID": ("bandid", str),
+    "PRODUCTLEVEL": ("productlevel", str),
+}
+CORNER_TAGS = ("ULLON", "ULLAT", "URLON", "URLAT", "LRLON", "LRLAT", "LLLON", "LLLAT")
+IMD_PARENTS = ("isd", "SOURCE_IMD")
+
+_memo = {}
+_cache_dir = os.environ.get(CACHE_ENV_VAR)
+
+
+class DGMetadata(object):
+    """
+    Compact record of the IMD fields of one DG metadata file.
+
+    Per-band values (abscalfactor, effectivebandwidth, tdilevel) are dicts
+    keyed by DG band tag (BAND_P, BAND_C, ...); bands lists the band tags in
+    document order and tdilevels every TDILEVEL value in document order.
+    footprint is the (lon, lat) UL, UR, LR, LL corners of the first band.
+    """
+
+    __slots__ = (
+        "path", "mtime",
+        "satid", "catid", "firstlinetime", "bandid", "productlevel",
+        "numrows", "numcolumns",
+        "sunel", "sunaz", "satel", "sataz", "offnadir", "cloudcover",
+        "bands", "abscalfactor", "effectivebandwidth", "tdilevel", "tdilevels",
+        "footprint",
+    )
+
+    def __init__(self, path=None, mtime=None):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.path = path
+        self.mtime = mtime
+        self.bands = ()
+        self.abscalfactor = {}
+        self.effectivebandwidth = {}
+        self.tdilevel = {}
+        self.tdilevels = ()
+
+    @property
+    def acqtime(self):
+        if self.firstlinetime is None:
+            return None
+        return datetime.strptime(self.firstlinetime, TIME_FORMAT)
+
+    def to_dict(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, d):
+        md = cls()
+        for slot in cls.__slots__:
+            if slot in d:
+                setattr(md, slot, d[slot])
+        md.bands = tuple(md.bands or ())
+        md.tdilevels = tuple(md.tdilevels or ())
+        if md.footprint is not None:
+            md.footprint = tuple(tuple(pt) for pt in md.footprint)
+        return md
+
+    def __repr__(self):
+        return "DGMetadata(%r, satid=%r, catid=%r)" % (self.path, self.satid, self.catid)
+
+
+def set_cache_dir(path):
+    """
+    Enable (or with None, disable) the on-disk cache.  Defaults to the
+    directory named by the DG_METADATA_CACHE environment variable.
+    """
+    global _cache_dir
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    _cache_dir = path
+
+
+def clear_memo():
+    _memo.clear()
+
+
+def prime(md):
+    """
+    Seeds the memo with a record obtained elsewhere (e.g. a scene catalog)
+    so later reads of md.path skip parsing while its mtime is unchanged.
+    """
+    _memo[os.path.abspath(md.path)] = md
+
+
+def read(path):
+    """
+    Returns the DGMetadata record for path, parsing it only if it is not
+    already memoized or cached for the file's current mtime.
+    """
+    key = os.path.abspath(path)
+    mtime = os.path.getmtime(key)
+
+    hit = _memo.get(key)
+    if hit is not None and hit.mtime == mtime:
+        return hit
+
+    md = _read_disk_cache(key, mtime)
+    if md is None:
+        md = parse(key)
+        md.mtime = mtime
+        _write_disk_cache(key, md)
+
+    _memo[key] = md
+    return md
+
+
+def parse(path):
+    """
+    Parses the IMD block of path in a single iterparse pass.  Raises
+    ValueError if the document has no DG IMD element.
+    """
+    md = DGMetadata(path)
+    bands = []
+    tdilevels = []
+    corners = {}
+    stack = []
+    imd_depth = None
+
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            stack.append(elem.tag)
+            if imd_depth is None and elem.tag == "IMD" and len(stack) > 1 and stack[-2] in IMD_PARENTS:
+                imd_depth = len(stack)
+            continue
+
+        depth = len(stack)
+        stack.pop()
+        if imd_depth is None:
+            continue
+
+        if depth == imd_depth:
+            #### End of the IMD block, nothing else we need is in the file
+            break
+
+        text = elem.text.strip() if elem.text else None
+        parent = stack[-1]
+
+        if depth == imd_depth + 1:
+            if elem.tag.startswith("BAND_"):
+                bands.append(elem.tag)
+            elif elem.tag in IMD_TAGS and text:
+                attr, conv = IMD_TAGS[elem.tag]
+                setattr(md, attr, conv(text))
+
+        elif depth == imd_depth + 2 and text:
+            if parent == "IMAGE" and elem.tag in IMAGE_TAGS:
+                attr, conv = IMAGE_TAGS[elem.tag]
+                if getattr(md, attr) is None or elem.tag.startswith("MEAN"):
+                    setattr(md, attr, conv(text))
+            elif parent.startswith("BAND_"):
+                if elem.tag == "ABSCALFACTOR":
+                    md.abscalfactor[parent] = float(text)
+                elif elem.tag == "EFFECTIVEBANDWIDTH":
+                    md.effectivebandwidth[parent] = float(text)
+                elif elem.tag in CORNER_TAGS and not bands:
+                    corners[elem.tag] = float(text)
+
+        if elem.tag == "TDILEVEL" and text:
+            tdilevels.append(float(text))
+            if parent.startswith("BAND_"):
+                md.tdilevel[parent] = int(float(text))
+
+        elem.clear()
+
+    if imd_depth is None:
+        raise ValueError(
+            "unrecognized .xml format - no IMD element under one of (%s): %s" %
+            (", ".join(IMD_PARENTS), path)
+        )
+
+    md.bands = tuple(bands)
+    md.tdilevels = tuple(tdilevels)
+    if len(corners) == len(CORNER_TAGS):
+        md.footprint = tuple(
+            (corners[c + "LON"], corners[c + "LAT"]) for c in ("UL", "UR", "LR", "LL")
+        )
+    return md
+
+
+def _cache_file(path):
+    return os.path.join(_cache_dir, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json")
+
+
+def _read_disk_cache(path, mtime):
+    if not _cache_dir:
+        return None
+    fp = _cache_file(path)
+    try:
+        with open(fp) as f:
+            d = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if d.get("path") != path or d.get("mtime") != mtime:
+        return None
+    return DGMetadata.from_dict(d)
+
+
+def _write_disk_cache(path, md):
+    if not _cache_dir:
+        return
+    fp = _cache_file(path)
+    tmp = "%s.%d.tmp" % (fp, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump(md.to_dict(), f)
+        os.rename(tmp, fp)
+    except (IOError, OSError) as e:
+        logger.debug("Cannot write metadata cache file %s: %s" % (fp, e))
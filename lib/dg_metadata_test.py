@@ -0,0 +1,65 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import dg_metadata
+
+DG_XML = "test_data/xml/from_digital_globe.xml"
+PGC_XML = "test_data/xml/post_pgc_ortho.xml"
+
+
+class Test_dg_metadata(TestCase):
+    def setUp(self):
+        dg_metadata.clear_memo()
+        dg_metadata.set_cache_dir(None)
+
+    def test_dig_globe_xml_parse(self):
+        """parse IMD fields from digital globe xml."""
+        md = dg_metadata.parse(DG_XML)
+        self.assertEqual(md.satid, "WV02")
+        self.assertEqual(md.catid, "103001002E9AC500")
+        self.assertEqual((md.numrows, md.numcolumns), (8192, 9216))
+        self.assertEqual(md.cloudcover, 1.5e-02)
+        self.assertEqual(md.sunel, 47.6)
+        self.assertEqual(len(md.bands), 8)
+        self.assertEqual(md.abscalfactor["BAND_C"], 9.295654e-03)
+        self.assertEqual(md.effectivebandwidth["BAND_C"], 4.73e-02)
+        self.assertEqual(md.tdilevel["BAND_C"], 24)
+        self.assertEqual(md.footprint[0], (-84.67998983, 30.39360758))
+
+    def test_pgc_ortho_xml_matches_source(self):
+        """xml post pgc ortho yields the same record as the source xml."""
+        dg = dg_metadata.parse(DG_XML).to_dict()
+        pgc = dg_metadata.parse(PGC_XML).to_dict()
+        del dg["path"], pgc["path"]
+        self.assertEqual(dg, pgc)
+
+    def test_read_is_memoized_per_mtime(self):
+        """read() reuses the record until the file mtime changes."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            xml = os.path.join(tmpdir, "scene.xml")
+            shutil.copy(PGC_XML, xml)
+            md = dg_metadata.read(xml)
+            self.assertIs(dg_metadata.read(xml), md)
+            os.utime(xml, (md.mtime + 10, md.mtime + 10))
+            self.assertIsNot(dg_metadata.read(xml), md)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_disk_cache_roundtrip(self):
+        """records written to the disk cache are read back unchanged."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dg_metadata.set_cache_dir(tmpdir)
+            md = dg_metadata.read(PGC_XML)
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+            dg_metadata.clear_memo()
+            cached = dg_metadata.read(PGC_XML)
+            self.assertIsNot(cached, md)
+            self.assertEqual(cached.to_dict(), md.to_dict())
+        finally:
+            dg_metadata.set_cache_dir(None)
+            shutil.rmtree(tmpdir)
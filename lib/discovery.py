@@ -0,0 +1,182 @@
+"""
+Image discovery for large archives.
+
+find_files() crawls a directory tree with scandir, listing the directories
+of each level on a thread pool (listing is I/O bound and releases the GIL).
+With a manifest path, each directory's mtime, subdirectories and matching
+files are saved as JSON; later runs stat every directory but only list the
+ones whose mtime changed.  A directory's mtime changes when entries are
+added, removed or renamed in it, which is all discovery needs.
+
+get_sensor() matches file names against precompiled vendor patterns and
+stops at the first match.
+"""
+
+import os, re, json, time, logging
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger("logger")
+
+THREADS = 8
+MANIFEST_VERSION = 1
+#### Directories changed this recently are listed again next time, since a
+#### later change within the mtime resolution would not be noticed
+MIN_AGE = 2.0
+
+RAW_DG = r"(?P<ts>\d\d[a-z]{3}\d{8})-(?P<prod>\w{4})?(?P<tile>\w+)?-(?P<oid>\d{12}_\d\d)_(?P<pnum>p\d{3})"
+RENAMED_DG = r"(?P<snsr>\w\w\d\d)_(?P<ts>\d\d[a-z]{3}\d{9})-(?P<prod>\w{4})?(?P<tile>\w+)?-(?P<catid>[a-z0-9]+)"
+RENAMED_DG2 = r"(?P<snsr>\w\w\d\d)_(?P<ts>\d{14})_(?P<catid>[a-z0-9]{16})"
+RAW_GE = r"(?P<snsr>\d[a-z])(?P<ts>\d{6})(?P<band>[a-z])(?P<said>\d{9})(?P<prod>\d[a-z])(?P<pid>\d{3})(?P<siid>\d{8})(?P<ver>\d)(?P<mono>[a-z0-9])_(?P<pnum>\d{8,9})"
+RENAMED_GE = r"(?P<snsr>\w\w\d\d)_(?P<ts>\d{6})(?P<band>\w)(?P<said>\d{9})(?P<prod>\d\w)(?P<pid>\d{3})(?P<siid>\d{8})(?P<ver>\d)(?P<mono>\w)_(?P<pnum>\d{8,9})"
+RAW_IK = r"po_(?P<po>\d{5,7})_(?P<band>[a-z]+)_(?P<cmp>\d+)"
+RENAMED_IK = r"(?P<snsr>[a-z]{2}\d\d)_(?P<ts>\d{12})(?P<siid>\d+)_(?P<band>[a-z]+)_(?P<lat>\d{4}[ns])"
+
+#### (pattern, vendor, satellite); a satellite of None is taken from the
+#### snsr group.  Ordered so the first match gives the same answer as the
+#### old getSensor, where IKONOS beat GeoEye beat DigitalGlobe and later
+#### patterns of a vendor beat earlier ones.
+SENSOR_PATTERNS = [(re.compile(p), vendor, sat) for p, vendor, sat in [
+    (RENAMED_IK, "GeoEye", "IK01"),
+    (RAW_IK, "GeoEye", "IK01"),
+    (RENAMED_GE, "GeoEye", "GE01"),
+    (RAW_GE, "GeoEye", "GE01"),
+    (RENAMED_DG2, "DigitalGlobe", None),
+    (RENAMED_DG, "DigitalGlobe", None),
+    (RAW_DG, "DigitalGlobe", None),
+]]
+
+
+def get_sensor(srcfn):
+    """Returns (vendor, satellite) of an image file name, (None, None) if unknown."""
+    name = srcfn.lower()
+    for p, vendor, sat in SENSOR_PATTERNS:
+        m = p.search(name)
+        if m is not None:
+            return vendor, sat or m.groupdict().get("snsr")
+    return None, None
+
+
+def _list(path):
+    """Returns (mtime, subdirectory names, file names) of a directory."""
+    dirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    #### like os.walk, symlinked directories are not followed
+                    if not entry.is_symlink():
+                        dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            fp = os.path.join(path, name)
+            if os.path.isdir(fp):
+                if not os.path.islink(fp):
+                    dirs.append(name)
+            else:
+                files.append(name)
+    return os.stat(path).st_mtime, dirs, files
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load_manifest(path, root, exts):
+    """Directory entries of a manifest written for root and exts, else {}."""
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable discovery manifest %s: %s" % (path, e))
+        return {}
+    if (manifest.get("version") != MANIFEST_VERSION or manifest.get("root") != root
+            or sorted(manifest.get("exts", [])) != sorted(exts)):
+        return {}
+    return manifest.get("dirs", {})
+
+
+def save_manifest(path, root, exts, dirs):
+    now = time.time()
+    for entry in dirs.values():
+        if entry["mtime"] is not None and now - entry["mtime"] < MIN_AGE:
+            entry["mtime"] = None
+    manifest = {"version": MANIFEST_VERSION, "root": root, "exts": sorted(exts), "dirs": dirs}
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.warning("Cannot write discovery manifest %s: %s" % (path, e))
+
+
+def find_files(root, exts, manifest=None, threads=THREADS):
+    """
+    Sorted paths of the files under root with one of exts (lower case, with
+    the dot), joined to root as given like os.walk does.  manifest is an
+    optional JSON path used to skip unchanged directories and updated at
+    the end.
+    """
+    top = root
+    root = os.path.abspath(root)
+    exts = [e.lower() for e in exts]
+    cached = load_manifest(manifest, root, exts)
+    dirs = {}
+    reused = 0
+
+    def visit(path):
+        entry = cached.get(path)
+        if entry is not None and entry["mtime"] is not None and _mtime(path) == entry["mtime"]:
+            return path, entry, True
+        try:
+            mtime, subdirs, names = _list(path)
+        except OSError as e:
+            logger.warning("Cannot list %s: %s" % (path, e))
+            return path, None, False
+        files = sorted([n for n in names if os.path.splitext(n)[1].lower() in exts])
+        return path, {"mtime": mtime, "dirs": sorted(subdirs), "files": files}, False
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        level = [root]
+        while level:
+            next_level = []
+            for path, entry, hit in pool.map(visit, level):
+                if entry is None:
+                    continue
+                dirs[path] = entry
+                reused += hit
+                next_level.extend([os.path.join(path, d) for d in entry["dirs"]])
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.debug("Discovery of %s: %i directories, %i unchanged" % (root, len(dirs), reused))
+    if manifest:
+        save_manifest(manifest, root, exts, dirs)
+
+    paths = []
+    for path in sorted(dirs):
+        rel = os.path.relpath(path, root)
+        base = top if rel == os.curdir else os.path.join(top, rel)
+        paths.extend([os.path.join(base, f).replace("\\", "/") for f in dirs[path]["files"]])
+    return paths
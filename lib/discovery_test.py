@@ -0,0 +1,46 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import discovery
+
+
+class Test_discovery(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for d in ("a", os.path.join("a", "b"), "c"):
+            os.mkdir(os.path.join(self.tmpdir, d))
+        for f in ("x.ntf", os.path.join("a", "y.TIF"), os.path.join("a", "b", "z.ntf"), os.path.join("c", "skip.xml")):
+            open(os.path.join(self.tmpdir, f), "w").close()
+        self.manifest = os.path.join(self.tmpdir, "manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_sensor(self):
+        """patterns short-circuit with the same answers as before."""
+        self.assertEqual(discovery.get_sensor("WV02_20120206131504_10300100106FC100_12FEB06131504-P1BS-052754253040_01_P001.ntf"),
+                         ("DigitalGlobe", "wv02"))
+        self.assertEqual(discovery.get_sensor("12FEB06131504-P1BS-052754253040_01_P001.ntf"), ("DigitalGlobe", None))
+        self.assertEqual(discovery.get_sensor("po_123456_pan_0000000.ntf"), ("GeoEye", "IK01"))
+        self.assertEqual(discovery.get_sensor("unknown.tif"), (None, None))
+
+    def test_find_files(self):
+        """files with the extensions are found in every subdirectory."""
+        found = discovery.find_files(self.tmpdir, [".ntf", ".tif"], threads=2)
+        self.assertEqual([os.path.relpath(f, self.tmpdir) for f in found],
+                         ["x.ntf", os.path.join("a", "y.TIF"), os.path.join("a", "b", "z.ntf")])
+
+    def test_manifest_skips_unchanged(self):
+        """only directories whose mtime changed are listed again."""
+        b = os.path.join(self.tmpdir, "a", "b")
+        os.utime(b, (1000000000, 1000000000))
+        discovery.find_files(self.tmpdir, [".ntf"], self.manifest)
+        open(os.path.join(b, "hidden.ntf"), "w").close()
+        os.utime(b, (1000000000, 1000000000))
+        open(os.path.join(self.tmpdir, "c", "new.ntf"), "w").close()
+        found = [os.path.basename(f) for f in discovery.find_files(self.tmpdir, [".ntf"], self.manifest)]
+        self.assertIn("new.ntf", found)
+        self.assertNotIn("hidden.ntf", found)
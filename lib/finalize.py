@@ -0,0 +1,79 @@
+"""
+In-process finishing of output rasters: overviews, then band statistics.
+
+run() replaces the "gdal_translate -stats" + "gdaladdo" pair the scripts used
+after writing an output.  -stats re-read the new file for exact statistics and
+gdaladdo read it again in another process.  Here the file is opened once,
+overviews are built with GDAL_NUM_THREADS set, and statistics are computed
+afterwards, so approximate statistics come from an overview instead of the
+full-resolution data.  Bands that already carry statistics (set while the
+file was written) are left alone.
+"""
+
+import logging
+
+import gdal, gdalconst
+
+logger = logging.getLogger("logger")
+
+LEVELS = [2, 4, 8, 16]
+RESAMPLING = ["nearest", "average", "gauss", "cubic", "cubicspline", "lanczos", "mode"]
+
+
+def add_arguments(parser, levels=LEVELS):
+    parser.add_argument("--pyramid_levels", type=int, nargs="+", default=list(levels),
+                        help="output pyramid levels (default %s)" % " ".join([str(l) for l in levels]))
+    parser.add_argument("--pyramid_resampling", choices=RESAMPLING, default="nearest",
+                        help="output pyramid resampling (default nearest)")
+    parser.add_argument("--approx_stats", action="store_true", default=False,
+                        help="compute approximate output stats from the pyramids instead of exact stats")
+
+
+def _open(path):
+    """Opens path for update so overviews are internal, else read-only (.ovr and .aux.xml)."""
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    ds = gdal.Open(path, gdalconst.GA_Update)
+    gdal.PopErrorHandler()
+    if ds is None:
+        ds = gdal.Open(path, gdalconst.GA_ReadOnly)
+    return ds
+
+
+def has_stats(band):
+    return band.GetMetadataItem("STATISTICS_MEAN") is not None
+
+
+def run(path, levels=LEVELS, resampling="nearest", stats=True, approx=False, threads=1, overviews=True):
+    """
+    Builds overviews (if overviews and levels) and band statistics (if stats)
+    for path.  Returns 0 on success, 1 on failure.
+    """
+    ds = _open(path)
+    if ds is None:
+        logger.error("Cannot open output to finish: %s" % path)
+        return 1
+
+    rc = 0
+    if overviews and levels:
+        logger.info("Building pyramids %s (%s, %i threads): %s" % (" ".join([str(l) for l in levels]), resampling, threads, path))
+        saved = gdal.GetConfigOption("GDAL_NUM_THREADS")
+        gdal.SetConfigOption("GDAL_NUM_THREADS", str(max(1, threads)))
+        try:
+            if ds.BuildOverviews(resampling.upper(), list(levels)) != 0:
+                logger.error("Building pyramids failed: %s" % path)
+                rc = 1
+        finally:
+            gdal.SetConfigOption("GDAL_NUM_THREADS", saved)
+
+    if stats and rc == 0:
+        for b in range(1, ds.RasterCount + 1):
+            band = ds.GetRasterBand(b)
+            if has_stats(band):
+                continue
+            band.ComputeStatistics(approx)
+            if not has_stats(band):
+                logger.error("Computing stats failed for band %i: %s" % (b, path))
+                rc = 1
+
+    ds = None
+    return rc
@@ -0,0 +1,75 @@
+# std modules:
+from unittest import TestCase, skipIf
+import os
+import shutil
+import tempfile
+
+import numpy
+
+try:
+    import gdal
+    from lib import finalize
+except ImportError:
+    gdal = None
+
+
+@skipIf(gdal is None, "GDAL is not installed")
+class Test_finalize(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        #### 0/255 checkerboard: every 2 x 2 block averages to 127.5
+        rows, cols = numpy.indices((128, 128))
+        self.data = numpy.where((rows + cols) % 2, 255, 0).astype(numpy.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def image(self, name="out", bands=1):
+        path = os.path.join(self.tmpdir, name + ".tif")
+        ds = gdal.GetDriverByName("GTiff").Create(path, 128, 128, bands, gdal.GDT_Byte)
+        ds.SetGeoTransform((0, 1, 0, 128, 0, -1))
+        for b in range(bands):
+            ds.GetRasterBand(b + 1).WriteArray(self.data)
+        ds = None
+        return path
+
+    def test_levels_and_resampling(self):
+        """one overview per level, built with the requested resampling."""
+        path = self.image()
+        self.assertEqual(finalize.run(path, [2, 4], "average", stats=False), 0)
+        band = gdal.Open(path).GetRasterBand(1)
+        self.assertEqual(band.GetOverviewCount(), 2)
+        self.assertEqual([(band.GetOverview(i).XSize, band.GetOverview(i).YSize) for i in range(2)], [(64, 64), (32, 32)])
+        ov = band.GetOverview(0).ReadAsArray()
+        self.assertTrue(((ov == 127) | (ov == 128)).all())
+        self.assertFalse(band.GetMetadataItem("STATISTICS_MEAN"))
+
+    def test_exact_stats(self):
+        """exact stats see every full-resolution pixel."""
+        path = self.image()
+        self.assertEqual(finalize.run(path, [2], "average"), 0)
+        band = gdal.Open(path).GetRasterBand(1)
+        self.assertEqual(float(band.GetMetadataItem("STATISTICS_MINIMUM")), 0)
+        self.assertEqual(float(band.GetMetadataItem("STATISTICS_MAXIMUM")), 255)
+        self.assertAlmostEqual(float(band.GetMetadataItem("STATISTICS_MEAN")), 127.5, places=4)
+
+    def test_approximate_stats_from_overview(self):
+        """approximate stats are read from the averaged overview."""
+        path = self.image()
+        self.assertEqual(finalize.run(path, [2], "average", approx=True), 0)
+        band = gdal.Open(path).GetRasterBand(1)
+        self.assertGreater(float(band.GetMetadataItem("STATISTICS_MINIMUM")), 0)
+        self.assertLess(float(band.GetMetadataItem("STATISTICS_MAXIMUM")), 255)
+
+    def test_existing_stats_are_kept(self):
+        """bands with stats written earlier are skipped, the others computed."""
+        path = self.image(bands=2)
+        ds = gdal.Open(path, gdal.GA_Update)
+        for key, value in (("MINIMUM", "1"), ("MAXIMUM", "2"), ("MEAN", "42"), ("STDDEV", "3")):
+            ds.GetRasterBand(1).SetMetadataItem("STATISTICS_" + key, value)
+        ds = None
+        self.assertEqual(finalize.run(path, [], stats=True), 0)
+        ds = gdal.Open(path)
+        self.assertEqual(ds.GetRasterBand(1).GetMetadataItem("STATISTICS_MEAN"), "42")
+        self.assertAlmostEqual(float(ds.GetRasterBand(2).GetMetadataItem("STATISTICS_MEAN")), 127.5, places=4)
+        self.assertEqual(ds.GetRasterBand(1).GetOverviewCount(), 0)
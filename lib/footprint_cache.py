@@ -0,0 +1,151 @@
+"""
+Persistent cache of image geometry for mosaicking.
+
+Mosaic runs open every input to read its size, projection and corners, and
+pgc_mosaic_build_cutlines traces every input's exact footprint, although the
+inputs rarely change between iterations of a mosaic.  With --footprint_cache
+both are kept in a SQLite file, keyed by the image path and validated
+against its size and mtime: a changed or replaced image misses the cache
+and its entry is overwritten.  Footprints are also keyed by the trace
+parameters (step, tolerance and max_error).  Geometries are stored as WKB.
+
+Like the run state, the file can be shared by concurrent jobs; writers wait
+up to TIMEOUT seconds for the lock.
+"""
+
+import os, json, sqlite3, logging, threading
+
+logger = logging.getLogger("logger")
+
+TIMEOUT = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rasters (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    props TEXT NOT NULL,
+    geom BLOB
+);
+CREATE TABLE IF NOT EXISTS footprints (
+    path TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    tolerance REAL NOT NULL,
+    max_error REAL NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    geom BLOB,
+    xs TEXT,
+    ys TEXT,
+    PRIMARY KEY (path, step, tolerance, max_error)
+);
+"""
+
+_memo = {}
+
+
+def add_arguments(parser):
+    parser.add_argument("--footprint_cache",
+                        help="SQLite file caching image properties and exact footprints between mosaic runs; entries "
+                        "of images whose size or mtime changed are recomputed")
+
+
+def get(path):
+    """
+    Returns the FootprintCache for path, or None if path is None.  SQLite
+    connections cannot be shared, so there is one per process and thread.
+    """
+    if not path:
+        return None
+    key = (os.getpid(), threading.current_thread().ident, os.path.abspath(path))
+    cache = _memo.get(key)
+    if cache is None:
+        cache = FootprintCache(key[2])
+        _memo[key] = cache
+    return cache
+
+
+def _stat(path):
+    """(abspath, size, mtime) of path, or None if it cannot be stat-ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_size, st.st_mtime
+
+
+def _blob(wkb):
+    return None if wkb is None else sqlite3.Binary(wkb)
+
+
+def _bytes(blob):
+    return None if blob is None else bytes(blob)
+
+
+class FootprintCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=TIMEOUT)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_raster(self, path):
+        """(props dict, geom WKB) cached for path if it is unchanged, else None."""
+        key = _stat(path)
+        if key is None:
+            return None
+        row = self.conn.execute("SELECT size, mtime, props, geom FROM rasters WHERE path = ?", key[:1]).fetchone()
+        if row is None or (row[0], row[1]) != key[1:]:
+            return None
+        return json.loads(row[2]), _bytes(row[3])
+
+    def put_raster(self, path, props, wkb):
+        """Caches props (a JSON-serializable dict) and the WKB geometry of path."""
+        key = _stat(path)
+        if key is None:
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rasters (path, size, mtime, props, geom) VALUES (?, ?, ?, ?, ?)",
+                key + (json.dumps(props), _blob(wkb))
+            )
+
+    def get_footprint(self, path, step, tolerance, max_error=0):
+        """(geom WKB or None, xs, ys) cached for path and the trace parameters, else None."""
+        key = _stat(path)
+        if key is None:
+            return None
+        row = self.conn.execute(
+            "SELECT size, mtime, geom, xs, ys FROM footprints WHERE path = ? AND step = ? AND tolerance = ? AND max_error = ?",
+            (key[0], step, tolerance, max_error)
+        ).fetchone()
+        if row is None or (row[0], row[1]) != key[1:]:
+            return None
+        return _bytes(row[2]), json.loads(row[3]), json.loads(row[4])
+
+    def put_footprint(self, path, step, tolerance, max_error, wkb, xs, ys):
+        key = _stat(path)
+        if key is None:
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO footprints (path, step, tolerance, max_error, size, mtime, geom, xs, ys) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key[0], step, tolerance, max_error) + key[1:] + (_blob(wkb), json.dumps(list(xs)), json.dumps(list(ys)))
+            )
+
+    def purge(self):
+        """Removes the entries of images that no longer exist or changed.  Returns the number removed."""
+        removed = 0
+        with self.conn:
+            for table in ("rasters", "footprints"):
+                stale = [row for row in self.conn.execute("SELECT DISTINCT path, size, mtime FROM %s" % table)
+                         if _stat(row[0]) != tuple(row)]
+                for path, size, mtime in stale:
+                    removed += self.conn.execute(
+                        "DELETE FROM %s WHERE path = ? AND size = ? AND mtime = ?" % table, (path, size, mtime)).rowcount
+        return removed
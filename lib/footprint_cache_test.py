@@ -0,0 +1,47 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import footprint_cache
+
+
+class Test_footprint_cache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = footprint_cache.FootprintCache(os.path.join(self.tmpdir, "footprints.db"))
+        self.image = os.path.join(self.tmpdir, "WV02_20140101000000_1030010000000000_u08rf3413.tif")
+        with open(self.image, "w") as f:
+            f.write("raster")
+        os.utime(self.image, (1400000000, 1400000000))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_raster_roundtrip(self):
+        """cached properties and geometry come back unchanged."""
+        self.assertIsNone(self.cache.get_raster(self.image))
+        self.cache.put_raster(self.image, {"xsize": 100, "proj": "EPSG:3413"}, b"\x01\x03wkb")
+        props, wkb = self.cache.get_raster(self.image)
+        self.assertEqual(props, {"xsize": 100, "proj": "EPSG:3413"})
+        self.assertEqual(wkb, b"\x01\x03wkb")
+
+    def test_footprint_keyed_by_parameters(self):
+        """footprints traced with other parameters miss the cache."""
+        self.cache.put_footprint(self.image, 2, 1.0, 0, None, [1.0, 2.0], [3.0, 4.0])
+        self.assertEqual(self.cache.get_footprint(self.image, 2, 1.0), (None, [1.0, 2.0], [3.0, 4.0]))
+        self.assertIsNone(self.cache.get_footprint(self.image, 512, 1.0))
+        self.assertIsNone(self.cache.get_footprint(self.image, 2, 1.0, 4.0))
+
+    def test_changed_image_is_invalidated(self):
+        """a rewritten image misses the cache and purge removes its entries."""
+        self.cache.put_raster(self.image, {"xsize": 100}, None)
+        self.cache.put_footprint(self.image, 2, 1.0, 0, None, [], [])
+        with open(self.image, "w") as f:
+            f.write("rewritten raster")
+        os.utime(self.image, (1400000100, 1400000100))
+        self.assertIsNone(self.cache.get_raster(self.image))
+        self.assertIsNone(self.cache.get_footprint(self.image, 2, 1.0))
+        self.assertEqual(self.cache.purge(), 2)
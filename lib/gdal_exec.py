@@ -0,0 +1,231 @@
+"""
+In-process execution of GDAL utility command lines.
+
+ExecGdalCmd takes the same gdalwarp / gdal_translate / gdaladdo command
+strings the scripts have always built and runs them through the GDAL Python
+API (gdal.Warp, gdal.Translate, Dataset.BuildOverviews) instead of spawning a
+shell, so each step skips process startup and reuses the block cache.  It
+returns the same (err, so, se) tuple as ExecCmd.  Commands it cannot run
+in-process (other programs, bindings older than GDAL 2.1, or
+PGC_GDAL_EXEC=shell in the environment) are handed to the shell fallback.
+
+Commands must end with "<src> <dst>" (gdalwarp, gdal_translate) or be
+"gdaladdo [options] <file> <levels>", which is how every caller builds them.
+"""
+
+import os, shlex, logging
+
+import gdal, gdalconst
+
+logger = logging.getLogger("logger")
+
+MODE_ENV_VAR = "PGC_GDAL_EXEC"
+
+
+class Unsupported(Exception):
+    """Raised while parsing a command that cannot be run in-process."""
+
+
+class _ErrorLog(object):
+    """GDAL error handler collecting messages into a stderr-like string."""
+
+    def __init__(self):
+        self.messages = []
+        self.failed = False
+
+    def __call__(self, err_class, err_no, msg):
+        if err_class >= gdal.CE_Failure:
+            self.failed = True
+            self.messages.append("ERROR %d: %s" % (err_no, msg))
+        else:
+            self.messages.append("Warning %d: %s" % (err_no, msg))
+
+    def text(self):
+        return "\n".join(self.messages)
+
+
+class _Progress(object):
+    """Progress callback logging every 10 percent."""
+
+    def __init__(self, label):
+        self.label = label
+        self.last = -1
+
+    def __call__(self, complete, message, data):
+        pct = int(complete * 10) * 10
+        if pct > self.last:
+            self.last = pct
+            logger.debug("%s: %d%%" % (self.label, pct))
+        return 1
+
+
+def inprocess_available():
+    return hasattr(gdal, "Warp") and os.environ.get(MODE_ENV_VAR, "").lower() != "shell"
+
+
+def ExecGdalCmd(cmd, fallback):
+    """
+    Runs a GDAL utility command line in-process when possible, otherwise
+    with fallback(cmd).  Returns (err, so, se) like ExecCmd.
+    """
+    if not inprocess_available():
+        return fallback(cmd)
+
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        return fallback(cmd)
+    if len(tokens) < 2:
+        return fallback(cmd)
+
+    prog = os.path.splitext(os.path.basename(tokens[0]))[0]
+    parser = _PARSERS.get(prog)
+    if parser is None:
+        return fallback(cmd)
+
+    config, args = _split_config(tokens[1:])
+    try:
+        run = parser(args)
+    except Unsupported as e:
+        logger.debug("Running %s in a shell: %s" % (prog, e))
+        return fallback(cmd)
+
+    logger.info(cmd)
+    errors = _ErrorLog()
+    saved = _apply_config(config)
+    gdal.PushErrorHandler(errors)
+    try:
+        ok = run(_Progress(prog))
+    except Exception as e:
+        errors.failed = True
+        errors.messages.append(str(e))
+        ok = False
+    finally:
+        gdal.PopErrorHandler()
+        _apply_config(saved)
+
+    err = 0 if ok and not errors.failed else 1
+    if err == 1:
+        logger.error("Error found - in-process %s failed:  %s" % (prog, cmd))
+    else:
+        logger.debug("In-process %s succeeded:  %s" % (prog, cmd))
+    se = errors.text()
+    logger.debug("STDERR:  " + se)
+    return (err, "", se)
+
+
+def _split_config(args):
+    """Pulls --config KEY VALUE pairs out of an argument list."""
+    config = []
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i] == "--config" and i + 2 < len(args):
+            config.append((args[i + 1], args[i + 2]))
+            i += 3
+        else:
+            rest.append(args[i])
+            i += 1
+    return config, rest
+
+
+def _apply_config(config):
+    """
+    Sets config options, returning the previous values so they can be
+    restored.  GDAL_CACHEMAX is applied with SetCacheMax since the block
+    cache size is read only once per process.
+    """
+    saved = []
+    for key, value in config:
+        if key.upper() == "GDAL_CACHEMAX":
+            saved.append((key, str(gdal.GetCacheMax())))
+            size = int(value)
+            gdal.SetCacheMax(size * 1024 * 1024 if size < 100000 else size)
+        else:
+            saved.append((key, gdal.GetConfigOption(key)))
+            gdal.SetConfigOption(key, value)
+    return saved
+
+
+def _parse_warp(args):
+    if len(args) < 2:
+        raise Unsupported("gdalwarp needs a source and destination")
+    options, src, dst = args[:-2], args[-2], args[-1]
+
+    def run(progress):
+        dst_ds = dst
+        if os.path.isfile(dst) and "-overwrite" not in options:
+            #### like the utility, warp into an existing destination
+            dst_ds = gdal.Open(dst, gdalconst.GA_Update)
+            if dst_ds is None:
+                return False
+        ds = gdal.Warp(dst_ds, src, options=options, callback=progress)
+        ok = ds is not None
+        ds = None
+        dst_ds = None
+        return ok
+    return run
+
+
+def _parse_translate(args):
+    if len(args) < 2:
+        raise Unsupported("gdal_translate needs a source and destination")
+    options, src, dst = args[:-2], args[-2], args[-1]
+
+    def run(progress):
+        ds = gdal.Translate(dst, src, options=options, callback=progress)
+        ok = ds is not None
+        ds = None
+        return ok
+    return run
+
+
+def _parse_addo(args):
+    resampling = "NEAREST"
+    readonly = False
+    path = None
+    levels = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == "-r" and i + 1 < len(args):
+            resampling = args[i + 1].upper()
+            i += 2
+            continue
+        elif a == "-ro":
+            readonly = True
+        elif a.startswith("-"):
+            raise Unsupported("gdaladdo option %s" % a)
+        elif path is None:
+            path = a
+        else:
+            try:
+                levels.append(int(a))
+            except ValueError:
+                raise Unsupported("gdaladdo level %s" % a)
+        i += 1
+    if path is None or not levels:
+        raise Unsupported("gdaladdo needs a file and overview levels")
+
+    def run(progress):
+        ds = None
+        if not readonly:
+            #### internal overviews if writable, else .ovr like gdaladdo -ro
+            gdal.PushErrorHandler("CPLQuietErrorHandler")
+            ds = gdal.Open(path, gdalconst.GA_Update)
+            gdal.PopErrorHandler()
+        if ds is None:
+            ds = gdal.Open(path, gdalconst.GA_ReadOnly)
+        if ds is None:
+            return False
+        rc = ds.BuildOverviews(resampling, levels, progress)
+        ds = None
+        return rc == 0
+    return run
+
+
+_PARSERS = {
+    "gdalwarp": _parse_warp,
+    "gdal_translate": _parse_translate,
+    "gdaladdo": _parse_addo,
+}
@@ -1,4 +1,4 @@
-import os, string, sys, shutil, glob, re, tarfile, logging, argparse, signal
+import os, string, sys, shutil, glob, re, tarfile, logging, argparse, signal, struct
 from datetime import *
 from subprocess import *
 from math import *
@@ -6,6 +6,14 @@ from xml.etree import cElementTree as ET
 
 import gdal, ogr,osr, gdalconst
 import numpy
+from multiprocessing.pool import ThreadPool
+
+from lib import dg_metadata
+from lib import finalize
+from lib import footprint_cache
+from lib import run_state
+from lib import gdal_exec
+from lib import spatial_index
 
 logger = logging.getLogger("logger")
 logger.setLevel(logging.DEBUG)
@@ -14,6 +22,10 @@ logger.setLevel(logging.DEBUG)
 MODES = ["ALL","MOSAIC","SHP","TEST"]
 EXTS = [".tif"]
 GTIFF_COMPRESSIONS = ["jpeg95","lzw"]
+#### ImageInfo attributes read from an image file and kept in the footprint cache
+CACHED_ATTRIBUTES = ["xsize","ysize","proj","bands","datatype","datatype_readable","xres","yres","xs","ys"]
+#### Pixels per window read when tracing footprints
+FOOTPRINT_READ_PIXELS = 16 * 1024 * 1024
 
 #class Attribs:
 #    def __init__(self,dAttribs):
@@ -72,17 +84,20 @@ def buildMosaicParentArgumentParser():
                         help="use exposure settings in metadata to inform score")
     parser.add_argument("--exclude",
                         help="file of file name patterns (text only, no wildcards or regexs) to exclude")
+    finalize.add_arguments(parser, levels=[2,4,8,16,30])
+    run_state.add_arguments(parser)
+    footprint_cache.add_arguments(parser)
 
     return parser
 
 
 class ImageInfo:
-    def __init__(self,src,frmt,srs=None):
+    def __init__(self,src,frmt,srs=None,cache=None):
         
         self.frmt = frmt  #image format (IMAGE,RECORD)
         
         if frmt == 'IMAGE':
-            self.get_attributes_from_file(src)
+            self.get_attributes_from_file(src,cache)
         elif frmt == 'RECORD':
             self.get_attributes_from_record(src,srs)
         else:
@@ -184,12 +199,19 @@ class ImageInfo:
         self.geom = geom.Clone()
         
     
-    def get_attributes_from_file(self, srcfp):
+    def get_attributes_from_file(self, srcfp, cache=None):
         self.srcfp = srcfp
         self.srcdir, self.srcfn = os.path.split(srcfp)
         
-        ds = gdal.Open(self.srcfp)
-        if ds is not None:
+        cached = cache.get_raster(self.srcfp) if cache is not None else None
+        ds = gdal.Open(self.srcfp) if cached is None else None
+        if cached is not None:
+            props, wkb = cached
+            for k, v in props.items():
+                setattr(self, k, str(v) if isinstance(v, unicode) else v)
+            self.geom = ogr.CreateGeometryFromWkb(wkb) if wkb is not None else None
+            
+        elif ds is not None:
             self.xsize = ds.RasterXSize
             self.ysize = ds.RasterYSize
             self.proj = ds.GetProjectionRef() if ds.GetProjectionRef() != '' else ds.GetGCPProjection()
@@ -246,6 +268,9 @@ class ImageInfo:
             self.geom = ogr.CreateGeometryFromWkt(poly_wkt)
             self.xs = [ulx,urx,lrx,llx]
             self.ys = [uly,ury,lry,lly]
+            
+            if cache is not None:
+                cache.put_raster(self.srcfp, dict((k, getattr(self, k)) for k in CACHED_ATTRIBUTES), self.geom.ExportToWkb())
                 
                 
         else:
@@ -323,30 +348,41 @@ class ImageInfo:
         
         else:
             metad = None
-            
-            #### if xml format
+
+            #### if xml format, use the cached single-pass IMD reader
             if os.path.splitext(metapath)[1].lower() == '.xml':
                 try:
-                    metad = ET.parse(metapath)
-                except ET.ParseError, err:
+                    md = dg_metadata.read(metapath)
+                except Exception, err:
                     logger.debug("ERROR parsing metadata: %s, %s" %(err,metapath))
-            
+                else:
+                    metad = {
+                        "CATID":[md.catid],
+                        "SATID":[md.satid],
+                        "CLOUDCOVER":[md.cloudcover],
+                        "MEANSUNEL":[md.sunel],
+                        "MEANOFFNADIRVIEWANGLE":[md.offnadir],
+                        "FIRSTLINETIME":[md.firstlinetime],
+                        "TDILEVEL":list(md.tdilevels),
+                    }
+
             else:
                 try:
-                    metad = getGEMetadataAsXml(metapath)
+                    tree = getGEMetadataAsXml(metapath)
                 except Exception, err:
                     logger.debug("ERROR parsing metadata: %s, %s" %(err,metapath))
-                #### Write IK01 code 
-        
+                else:
+                    if tree is not None:
+                        metad = dict((tag,[elem.text for elem in tree.findall(".//%s"%tag)]) for tag in dTags)
+                #### Write IK01 code
+
             if metad is not None:
-                
+
                 for tag in dTags:
-                    taglist = metad.findall(".//%s"%tag)
+                    taglist = [text for text in metad.get(tag,[]) if text is not None]
                     vallist = []
-                    for elem in taglist:
-                        
-                        text = elem.text
-                    
+                    for text in taglist:
+
                         if text is not None:
                             try:
                                 if tag == "firstLineElevationAngle":
@@ -551,6 +587,47 @@ def filterMatchingImages(imginfo_list,params):
     return imginfo_list2
 
 
+def GetContributors(imginfo_list,extent_geom):
+    """
+    Overlays the geoms of imginfo_list, ordered from lowest to highest
+    priority (later images cover earlier ones), and returns (iinfo, geom) of
+    the images that contribute to extent_geom, in list order.  Each image
+    contributes its geom minus the higher priority geoms, clipped to
+    extent_geom.  Only the higher priority images whose bounding boxes
+    overlap are candidates for the difference, found through an STR tree, so
+    each image costs a handful of geometry operations against its
+    neighbours instead of one against every later image.
+    """
+    index = spatial_index.STRtree([(iinfo.geom.GetEnvelope(), n) for n, iinfo in enumerate(imginfo_list)])
+    contribs = []
+
+    for n, iinfo in enumerate(imginfo_list):
+        basegeom = iinfo.geom
+        for m in index.query(iinfo.geom.GetEnvelope()):
+            if m <= n:
+                continue
+            geom2 = imginfo_list[m].geom
+            if basegeom.Intersects(geom2):
+                basegeom = basegeom.Difference(geom2)
+                if basegeom is None or basegeom.IsEmpty():
+                    break
+
+        if basegeom is None:
+            logger.debug("Function Error: %s" %iinfo.srcfp)
+        elif basegeom.IsEmpty():
+            logger.debug("Removing non-contributing image: %s" %iinfo.srcfp)
+        else:
+            basegeom = basegeom.Intersection(extent_geom)
+            if basegeom is None:
+                logger.debug("Function Error: %s" %iinfo.srcfp)
+            elif basegeom.IsEmpty():
+                logger.debug("Removing non-contributing image: %s" %iinfo.srcfp)
+            else:
+                contribs.append((iinfo,basegeom))
+
+    return contribs
+
+
 def getMosaicParameters(iinfo,options):
     
     params = MosaicParams()
@@ -595,83 +672,146 @@ def getMosaicParameters(iinfo,options):
     return params
 
 
-def GetExactTrimmedGeom(image, step=2, tolerance=1):
-    
+def _footprintBand(ds, max_error):
+    """
+    Band 1 of ds, or its coarsest overview whose pixels are no larger than
+    max_error (georeferenced units) in x and y, with that band's geotransform.
+    """
+    band = ds.GetRasterBand(1)
+    gtf = ds.GetGeoTransform()
+    best = (band, gtf)
+    if max_error:
+        for k in range(band.GetOverviewCount()):
+            ov = band.GetOverview(k)
+            fx = band.XSize / float(ov.XSize)
+            fy = band.YSize / float(ov.YSize)
+            ovgtf = (gtf[0], gtf[1] * fx, gtf[2], gtf[3], gtf[4], gtf[5] * fy)
+            if abs(ovgtf[1]) <= max_error and abs(ovgtf[5]) <= max_error and ov.XSize < best[0].XSize:
+                best = (ov, ovgtf)
+    return best
+
+
+def _footprintRows(band, nd, step):
+    """
+    (lines, first, last) arrays: the first and last data column of every
+    step-th line that has data.  Lines are read in block-aligned windows of
+    up to FOOTPRINT_READ_PIXELS pixels, or only the block rows holding a
+    sampled line when step skips whole blocks.
+    """
+    xsize, ysize = band.XSize, band.YSize
+    blocky = max(1, band.GetBlockSize()[1])
+    if step >= 2 * blocky:
+        window = blocky
+    else:
+        window = max(blocky, FOOTPRINT_READ_PIXELS // xsize // blocky * blocky)
+
+    lines, first, last = [], [], []
+    y0 = 0
+    while y0 < ysize:
+        if window == blocky:
+            nxt = (y0 + step - 1) // step * step
+            if nxt >= ysize:
+                break
+            y0 = nxt // blocky * blocky
+        h = min(window, ysize - y0)
+        rows = numpy.arange((step - y0 % step) % step, h, step)
+        data = band.ReadAsArray(0, y0, xsize, h)[rows] != nd
+        has = data.any(axis=1)
+        lines.append(rows[has] + y0)
+        first.append(data.argmax(axis=1)[has])
+        last.append(xsize - 1 - data[:, ::-1].argmax(axis=1)[has])
+        y0 += h
+
+    if not lines:
+        return numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0, int)
+    return numpy.concatenate(lines), numpy.concatenate(first), numpy.concatenate(last)
+
+
+def GetExactTrimmedGeom(image, step=2, tolerance=1, max_error=0):
+    """
+    Footprint of the data pixels of image: a polygon through the right edge
+    of the last data pixel of every step-th line, top to bottom, then the
+    left edge of the first data pixel, bottom to top, simplified with
+    tolerance.  With max_error, lines are read from the coarsest overview
+    whose pixel size is within max_error.  Returns (geom, xs, ys).
+    """
     geom2 = None
-    geom = None
     xs,ys = [],[]
     ds = gdal.Open(image)
     if ds is not None:
         if ds.RasterCount > 0:
-            
-            inband = ds.GetRasterBand(1)
-            
-            nd = inband.GetNoDataValue()
+
+            nd = ds.GetRasterBand(1).GetNoDataValue()
             if nd is None:
                 nd = 0
-            
-            #print ("Image NoData Value: %d" %nd )
-            
-            gtf = ds.GetGeoTransform()
-        
-            pixelst = []
-            pixelsb = []
-            pts = []
-            
-            #### For every other line, find first and last data pixel
-            lines = xrange(0, inband.YSize, step)
-            
-            xsize = inband.XSize
-            npflatnonzero = numpy.flatnonzero
-            bandReadAsArray = inband.ReadAsArray
-            
-            lines_flatnonzero = [npflatnonzero(bandReadAsArray(0,l,xsize,1) != nd) for l in lines]
-            i = 0
-            
-            for nz in lines_flatnonzero:
-                
-                nzmin = nz[0] if nz.size > 0 else 0
-                nzmax = nz[-1] if nz.size > 0 else 0
-                
-                if nz.size > 0:
-                    pixelst.append((nzmax+1,i))
-                    pixelsb.append((nzmin,i))           
-                i += step
-                
-            pixelsb.reverse()
-            pixels = pixelst + pixelsb
-            
-            #print len(pixels)
-            
-            for px in pixels:
-                x,y = pl2xy(gtf,inband,px[0],px[1])
-                xs.append(x)
-                ys.append(y)
-                pts.append((x,y))
-                #print px[0],px[1],x,y
-            
-            #### create geometry
-            poly_vts = []
-            for pt in pts:
-                poly_vts.append("%.16f %.16f" %(pt[0],pt[1]))
-            if len(pts) > 0:
-                poly_vts.append("%.16f %.16f" %(pts[0][0],pts[0][1]))
-            
-            if len(poly_vts) > 0:
-                poly_wkt = 'POLYGON (( %s ))' %(string.join(poly_vts,", "))
-                #print poly_wkt
-                
-                geom = ogr.CreateGeometryFromWkt(poly_wkt)
-                #print geom
-                #### Simplify geom
-                #logger.debug("Simplification tolerance: %.10f" %tolerance)
+
+            inband, gtf = _footprintBand(ds, max_error)
+            ovstep = max(1, int(round(step * inband.YSize / float(ds.RasterYSize))))
+            lines, first, last = _footprintRows(inband, nd, ovstep)
+
+            if lines.size > 0:
+                #### right edges top to bottom, then left edges bottom to top, at line centers
+                p = numpy.concatenate((last + 1, first[::-1]))
+                l = numpy.concatenate((lines, lines[::-1]))
+                x = gtf[0] + gtf[1] * p
+                y = gtf[3] + gtf[5] * (l + 0.5)
+                xs = x.tolist()
+                ys = y.tolist()
+
+                #### build the ring as WKB straight from the coordinate arrays
+                ring = numpy.empty((p.size + 1, 2), "<f8")
+                ring[:-1, 0] = x
+                ring[:-1, 1] = y
+                ring[-1] = ring[0]
+                wkb = struct.pack("<BIII", 1, ogr.wkbPolygon, 1, len(ring)) + ring.tobytes()
+                geom = ogr.CreateGeometryFromWkb(wkb)
                 if geom is not None:
-                    geom2  = geom.Simplify(tolerance)
-            
-            
+                    geom2 = geom.Simplify(tolerance)
+
         ds = None
 
-    return geom2,xs,ys 
+    return geom2,xs,ys
+
+
+def GetExactTrimmedGeoms(images, step=2, tolerance=1, max_error=0, threads=1, cache=None):
+    """
+    GetExactTrimmedGeom for each of images, on up to threads threads (GDAL
+    reads and the NumPy scans release the GIL).  Results are in image order.
+    With a FootprintCache, footprints of unchanged images are taken from it
+    and new ones are added.
+    """
+    def footprint(image):
+        return GetExactTrimmedGeom(image, step, tolerance, max_error)
+
+    results = [None] * len(images)
+    missing = []
+    for n, image in enumerate(images):
+        hit = cache.get_footprint(image, step, tolerance, max_error) if cache is not None else None
+        if hit is None:
+            missing.append(n)
+        else:
+            wkb, xs, ys = hit
+            results[n] = (ogr.CreateGeometryFromWkb(wkb) if wkb is not None else None, xs, ys)
+    if cache is not None:
+        logger.info("Footprints cached for %i of %i images" %(len(images) - len(missing), len(images)))
+
+    todo = [images[n] for n in missing]
+    if threads <= 1 or len(todo) <= 1:
+        computed = [footprint(image) for image in todo]
+    else:
+        pool = ThreadPool(min(threads, len(todo)))
+        try:
+            computed = pool.map(footprint, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    for n, result in zip(missing, computed):
+        results[n] = result
+        #### images that could not be traced are retried next time
+        if cache is not None and result[0] is not None:
+            cache.put_footprint(images[n], step, tolerance, max_error, result[0].ExportToWkb(), result[1], result[2])
+    return results
 
     
 def findVertices(xoff, yoff, xsize, ysize, band, nd):
@@ -752,6 +892,14 @@ def ExecCmd(cmd):
      
 
 
+def ExecGdalCmd(cmd):
+    """
+    Run a gdalwarp, gdal_translate or gdaladdo command line in-process via the
+    GDAL API, falling back to ExecCmd for anything else.
+    """
+    return gdal_exec.ExecGdalCmd(cmd, ExecCmd)
+
+
 def ExecCmd_mp(job):
     job_name, cmd = job
     logger.info('Running job: {0}'.format(job_name))
@@ -0,0 +1,68 @@
+# std modules:
+from unittest import TestCase, skipIf
+
+try:
+    import ogr
+    from lib import mosaic
+#### lib.mosaic is Python 2 only
+except (ImportError, SyntaxError):
+    ogr = None
+
+
+class Image(object):
+    def __init__(self, name, wkt):
+        self.srcfp = name
+        self.geom = ogr.CreateGeometryFromWkt(wkt)
+
+
+def box(xmin, ymin, xmax, ymax):
+    return "POLYGON ((%s %s, %s %s, %s %s, %s %s, %s %s))" % (
+        xmin, ymin, xmin, ymax, xmax, ymax, xmax, ymin, xmin, ymin)
+
+
+def pairwise_contributors(imginfo_list, extent_geom):
+    """The double loop GetContributors replaced: each geom minus every later one."""
+    contribs = []
+    for i, iinfo in enumerate(imginfo_list):
+        basegeom = iinfo.geom
+        for iinfo2 in imginfo_list[i + 1:]:
+            if basegeom.Intersects(iinfo2.geom):
+                basegeom = basegeom.Difference(iinfo2.geom)
+                if basegeom.IsEmpty():
+                    break
+        if not basegeom.IsEmpty():
+            basegeom = basegeom.Intersection(extent_geom)
+            if not basegeom.IsEmpty():
+                contribs.append((iinfo, basegeom))
+    return contribs
+
+
+@skipIf(ogr is None, "GDAL is not installed")
+class Test_GetContributors(TestCase):
+    def setUp(self):
+        self.extent = ogr.CreateGeometryFromWkt(box(0, 0, 20, 10))
+        self.images = [
+            Image("low", box(0, 0, 12, 10)),
+            Image("covered", box(2, 2, 4, 4)),
+            Image("left", box(1, 1, 6, 9)),
+            Image("diagonal", "POLYGON ((5 0, 10 5, 5 10, 0 5, 5 0))"),
+            Image("outside", box(30, 0, 40, 10)),
+            Image("right", box(8, -2, 22, 6)),
+            Image("top", box(3, 7, 18, 12)),
+        ]
+
+    def test_matches_pairwise_overlay(self):
+        """contributors and their geometries match the pairwise differences."""
+        expected = pairwise_contributors(self.images, self.extent)
+        result = mosaic.GetContributors(self.images, self.extent)
+        self.assertEqual([i.srcfp for i, g in result], [i.srcfp for i, g in expected])
+        for (iinfo, geom), (_, ref) in zip(result, expected):
+            self.assertAlmostEqual(geom.SymmetricDifference(ref).GetArea(), 0, places=9)
+            self.assertAlmostEqual(geom.GetArea(), ref.GetArea(), places=9)
+
+    def test_hidden_and_outside_images_dropped(self):
+        """fully covered images and images outside the extent do not contribute."""
+        names = [i.srcfp for i, g in mosaic.GetContributors(self.images, self.extent)]
+        self.assertNotIn("covered", names)
+        self.assertNotIn("outside", names)
+        self.assertEqual(names[-1], "top")
@@ -1,14 +1,26 @@
-import os, string, sys, shutil, math, glob, re, tarfile, logging, shlex, platform, argparse, signal
+import os, string, sys, shutil, math, glob, re, logging, shlex, platform, argparse, signal
 from datetime import datetime, timedelta
 
 from subprocess import *
-from xml.dom import minidom
 from xml.etree import cElementTree as ET
 
 import gdal, ogr,osr, gdalconst
 
+from lib import dg_metadata
+from lib import aoi
+from lib import catalog
+from lib import dem_cache
+from lib import discovery
+from lib import finalize
+from lib import gdal_exec
+from lib import resources
+from lib import run_state
+from lib import staging
+from lib import tar_index
+
 DGbandList = ['BAND_P','BAND_C','BAND_B','BAND_G','BAND_Y','BAND_R','BAND_RE','BAND_N','BAND_N2','BAND_S1','BAND_S2','BAND_S3','BAND_S4','BAND_S5','BAND_S6','BAND_S7','BAND_S8']
 formats = {'GTiff':'.tif','JP2OpenJPEG':'.jp2','ENVI':'.envi','HFA':'.img'}
+SINGLE_PASS_FORMATS = ['GTiff','ENVI','HFA']
 outtypes = ['Byte','UInt16','Float32']
 stretches = ["ns","rf","mr","rd"]
 resamples = ["near","bilinear","cubic","cubicspline","lanczos"]
@@ -105,7 +117,7 @@ def buildParentArgumentParser():
     parser = argparse.ArgumentParser(add_help=False)
 
     #### Positional Arguments
-    parser.add_argument("src", help="source image, text file, or directory")
+    parser.add_argument("src", help="source image, text file, directory, or scene catalog")
     parser.add_argument("dst", help="destination directory")
     pos_arg_keys = ["src","dst"]
 
@@ -139,12 +151,45 @@ def buildParentArgumentParser():
                       help="skip warping step")
     parser.add_argument("--no_pyramids", action='store_true', default=False, help='suppress calculation of output image pyramids and stats')
     parser.add_argument("--ortho_height", type=long, help='constant elevation to use for orthorectification (value should be in meters above the wgs84 ellipoid)')
+    parser.add_argument("--warp_threads", type=int,
+                      help="threads gdalwarp uses per image (default is the job's cpus divided by the number of concurrent images)")
+    parser.add_argument("--warp_memory", type=int,
+                      help="gdalwarp working memory per image in MB (default is derived from the job's memory limit and the number of concurrent images)")
+    parser.add_argument("--staging", choices=staging.MODES, default="auto",
+                      help="how source files are made available in the working dir: auto (default) picks inplace, hardlink, "
+                      "symlink or copy from the source and working dir filesystems")
+    parser.add_argument("--prefetch", type=int, default=0,
+                      help="with --wd, stage this many upcoming images into the working dir while the current one "
+                      "processes, and copy outputs back in the background (pgc_ortho.py only, default 0)")
+    parser.add_argument("--scratch_reserve", type=int, default=2048,
+                      help="free space in MB to keep in the working dir; prefetching, and queuing more background copies, wait while there is less (default 2048)")
+    parser.add_argument("--aoi",
+                      help="area of interest, a vector file or a geographic bbox xmin,xmax,ymin,ymax; images are clipped to it "
+                      "and images that do not intersect it are skipped")
+    parser.add_argument("--dem_cache",
+                      help="directory of per-scene DEM crops shared between jobs; with --dem, each image is warped against "
+                      "a crop of the DEM around its footprint instead of the full DEM")
+    parser.add_argument("--dem_cache_size", type=int, default=4096,
+                      help="size limit of the DEM crop cache in MB, least recently used crops are removed first (default 4096)")
+    parser.add_argument("--dem_cache_epsg", type=int,
+                      help="reproject DEM crops to this EPSG code (default is to keep the DEM's projection)")
+    parser.add_argument("--tar_input", action='store_true', default=False,
+                      help="also process NTF/TIF images inside .tar archives found in src, read in place through /vsitar/")
+    parser.add_argument("--discovery_manifest",
+                      help="JSON file recording the directories of src; when src is a directory, later runs only list "
+                      "directories that changed since")
+    parser.add_argument("--single_pass", action='store_true', default=False,
+                      help="apply the stretch while warping instead of writing an intermediate warped image (%s output only; "
+                      "with non-nearest resampling the mr stretch is applied before interpolation)" %string.join(SINGLE_PASS_FORMATS,','))
+    finalize.add_arguments(parser)
+    run_state.add_arguments(parser)
+    catalog.add_query_arguments(parser)
 
 
     return parser, pos_arg_keys
 
 
-def processImage(srcfp,dstfp,opt):
+def processImage(srcfp,dstfp,opt,manager=None):
 
     err = 0
 
@@ -177,6 +222,18 @@ def processImage(srcfp,dstfp,opt):
     info.warpfile = os.path.splitext(info.localsrc)[0] + "_warp.tif"
     info.vrtfile = os.path.splitext(info.localsrc)[0] + "_vrt.vrt"
 
+    #### With a run state, outputs of interrupted attempts are not done: remove them
+    state = run_state.get(opt.run_state)
+    scene = run_state.scene_name(srcfp)
+    if state is not None:
+        if state.is_done(scene,"stretched",dstfp):
+            LogMsg("Image is recorded as done: %s" %info.srcfn)
+            return 0
+        deleteTempFiles([dstfp,info.localdst])
+        if not state.is_done(scene,"warped",info.warpfile):
+            deleteTempFiles([info.warpfile])
+        state.start(scene,"stretched")
+
     #### Verify EPSG
     try:
         spatial_ref = SpatialRef(opt.epsg)
@@ -190,6 +247,19 @@ def processImage(srcfp,dstfp,opt):
     if opt.dem is not None and opt.ortho_height is not None:
         logger.error("--dem and --ortho_height options are mutually exclusive.  Please choose only one.")
         err = 1
+
+    if opt.dem_cache is not None and opt.dem is None:
+        logger.warning("--dem_cache has no effect without --dem")
+
+    if opt.aoi is not None:
+        try:
+            aoi.load(opt.aoi)
+        except ValueError, e:
+            logger.error(e)
+            err = 1
+
+    if opt.single_pass and not UseSinglePass(opt):
+        logger.warning("--single_pass is not supported for %s output, warping and stretching in two passes" %opt.format)
         
     #### Check if image is level 2A and tiled, raise error
     p = re.compile("-(?P<prod>\w{4})?(_(?P<tile>\w+))?-\w+?(?P<ext>\.\w+)")
@@ -220,11 +290,20 @@ def processImage(srcfp,dstfp,opt):
             err = 1
         else:
             info.metapath = metafile
+
+    #### Skip images outside the AOI before staging them
+    if not err == 1 and opt.aoi is not None:
+        if not aoi.intersects_metadata(opt.aoi, info.metapath):
+            LogMsg("Image does not intersect the AOI, skipping: %s" %info.srcfn)
+            if state is not None:
+                state.finish(scene,"stretched")
+            return 0
             
-    #### Check If Image is IKONOS msi that does not exist, if so, stack to dstdir, else, copy srcfn to dstdir        
+    #### Check If Image is IKONOS msi that does not exist, if so, stack to a VRT in wd, else, copy srcfn to dstdir        
     if not err == 1:
         if "IK01" in info.srcfn and "msi" in info.srcfn and not os.path.isfile(info.srcfp):
-            LogMsg("Converting IKONOS band images to composite image")
+            LogMsg("Stacking IKONOS band images to a composite VRT")
+            info.localsrc = os.path.splitext(info.localsrc)[0] + ".vrt"
             members = [os.path.join(info.srcdir,info.srcfn.replace("msi",b)) for b in ikMsiBands]
             status = [os.path.isfile(member) for member in members]
             if sum(status) != 4:
@@ -239,14 +318,17 @@ def processImage(srcfp,dstfp,opt):
                     err = 1
 
         else:
-            if os.path.isfile(info.srcfp):
-                LogMsg("Copying image to working directory")
-                copy_list = glob.glob("%s.*" %os.path.splitext(info.srcfp)[0])
-                #copy_list.append(info.metapath)
-                for fpi in copy_list:
-                    fpo = os.path.join(wd,os.path.basename(fpi))
-                    if not os.path.isfile(fpo):
-                        shutil.copy(fpi,fpo)
+            if tar_index.is_vsitar(info.srcfp) and tar_index.exists(info.srcfp):
+                LogMsg("Reading image from tar archive")
+                info.localsrc = info.srcfp
+            elif os.path.isfile(info.srcfp):
+                LogMsg("Staging image to working directory")
+                if manager is not None:
+                    mode, info.localsrc = manager.acquire(info.srcfp)
+                else:
+                    mode, info.localsrc = staging.stage(info.srcfp,wd,opt.staging)
+                if state is not None:
+                    state.finish(scene,"staged")
                
             else:
                 LogMsg("Source images does not exist: %s" %info.srcfp)
@@ -269,10 +351,23 @@ def processImage(srcfp,dstfp,opt):
     
     #### Warp Image
     if not err == 1 and not os.path.isfile(info.warpfile):
+        if state is not None:
+            state.start(scene,"warped")
         rc = WarpImage(opt,info)
         if rc == 1:
             err = 1
             LogMsg("ERROR in image warping")
+            if state is not None:
+                state.fail(scene,"warped","Warp failed")
+        elif state is not None:
+            state.finish(scene,"warped",info.localdst if UseSinglePass(opt) else info.warpfile)
+
+    #### Single pass: the warp wrote the stretched output, finish it in place
+    if not err == 1 and UseSinglePass(opt) and os.path.isfile(info.localdst):
+        rc = FinishOutput(opt,info)
+        if rc == 1:
+            err = 1
+            LogMsg("ERROR in image calculation")
 
     #### Calculate Output File
     if not err == 1 and os.path.isfile(info.warpfile):
@@ -289,29 +384,52 @@ def processImage(srcfp,dstfp,opt):
 #            LogMsg("ERROR in writing metadata file")
     
     #### Copy image to final location if working dir is used
+    #### With a staging manager the copy runs in the background and finishes the image
+    deferred = False
     if opt.wd is not None:
         if not err == 1:
-            LogMsg("Copying to destination directory")
-            for fpi in glob.glob("%s.*" %os.path.splitext(info.localdst)[0]):
-                fpo = os.path.join(info.dstdir,os.path.basename(fpi))
-                if not os.path.isfile(fpo):
-                    shutil.copy(fpi,fpo)
-        if not opt.save_temps:
+            outputs = glob.glob("%s.*" %os.path.splitext(info.localdst)[0])
+            if manager is not None:
+                LogMsg("Copying to destination directory in the background")
+                manager.copy_back(outputs,info.dstdir,lambda ok: FinishCopyBack(ok,opt,info,scene),info.srcfp)
+                deferred = True
+            else:
+                LogMsg("Copying to destination directory")
+                for fpi in outputs:
+                    fpo = os.path.join(info.dstdir,os.path.basename(fpi))
+                    if not os.path.isfile(fpo):
+                        shutil.copy(fpi,fpo)
+        if not opt.save_temps and not deferred:
             deleteTempFiles([info.localdst])
 
     #### Check If Done, Delete Temp Files
-    done = os.path.isfile(info.dstfp)
+    #### A deferred copy is checked when it completes: the manager reports failures by source image
+    done = deferred or os.path.isfile(info.dstfp)
     if done is False:
         err = 1
         LogMsg("ERROR: final image not present")
 
+    #### Never delete a source read in place
+    temp_files = [info.rawvrt,info.warpfile,info.vrtfile]
+    if os.path.abspath(info.localsrc) != os.path.abspath(info.srcfp):
+        temp_files.append(info.localsrc)
+
     if err == 1:
         LogMsg("Processing failed: %s" %info.srcfn)
         if not opt.save_temps:
-            deleteTempFiles([dstfp,info.rawvrt,info.warpfile,info.vrtfile,info.localsrc])
+            deleteTempFiles([dstfp] + temp_files)
     
     elif not opt.save_temps:
-        deleteTempFiles([info.rawvrt,info.warpfile,info.vrtfile,info.localsrc])
+        deleteTempFiles(temp_files)
+
+    if manager is not None:
+        manager.release(info.srcfp,not opt.save_temps)
+
+    if state is not None and not deferred:
+        if err == 1:
+            state.fail(scene,"stretched","Processing failed")
+        else:
+            state.finish(scene,"stretched",dstfp)
         
     #### Calculate Total Time
     endtime = datetime.today()
@@ -321,7 +439,31 @@ def processImage(srcfp,dstfp,opt):
     return err
 
 
+def FinishCopyBack(ok,opt,info,scene):
+    """
+    Runs in the staging manager's copy thread once the outputs of info are
+    in the destination: removes them from wd and records the image.
+    """
+    if not opt.save_temps:
+        deleteTempFiles([info.localdst])
+    state = run_state.get(opt.run_state)
+    if ok and os.path.isfile(info.dstfp):
+        LogMsg("Copied to destination directory: %s" %info.dstfn)
+        if state is not None:
+            state.finish(scene,"stretched",info.dstfp)
+    else:
+        LogMsg("ERROR: final image not present: %s" %info.dstfp)
+        if state is not None:
+            state.fail(scene,"stretched","Copy to destination failed")
+
+
 def stackIkBands(dstfp, members):
+    """
+    Stacks the IKONOS blu/grn/red/nir band images into the VRT dstfp with
+    the color interpretation, RPCs and cleaned NITF metadata of the blue
+    band, so the bands are warped directly instead of being rewritten to a
+    composite image first.
+    """
 
     rc = 0
 
@@ -332,9 +474,8 @@ def stackIkBands(dstfp, members):
     srcfp = members[0]
     srcdir,srcfn = os.path.split(srcfp)
     dstdir,dstfn = os.path.split(dstfp)
-    vrt = os.path.splitext(dstfp)[0]+ "_merge.vrt"
 
-    #### Gather metadata from original blue image and save as strings for merge command
+    #### Gather metadata from original blue image
     LogMsg("Stacking IKONOS MSI bands")
     src_ds = gdal.Open(srcfp,gdalconst.GA_ReadOnly)
     if src_ds is not None:
@@ -346,52 +487,25 @@ def stackIkBands(dstfp, members):
             proj = src_ds.GetGCPProjection()
         else:
             proj = src_ds.GetProjectionRef()
-        s_srs = osr.SpatialReference(proj)
-        s_srs_proj4 = s_srs.ExportToProj4()
+        rpc = src_ds.GetMetadata("RPC")
 
         #### Remove keys we want to leave or set ourselves
         for k in remove_keys:
             if k in m:
                 del m[k]
-        #### Make the dictionary into a list and append the ones we set ourselves
-        m_list = []
-        keys = m.keys()
-        keys.sort()
-        for k in keys:
-            if not '"' in m[k]:
-                m_list.append('-co "%s=%s"' %(k.replace("NITF_",""),m[k]))
-        for k in meta_dict.keys():
-            if not '"' in meta_dict[k]:
-                m_list.append('-co "%s=%s"' %(k.replace("NITF_",""),meta_dict[k]))
-
-        #### Get the TRE metadata
-        tres = src_ds.GetMetadata("TRE")
-        #### Make the dictionary into a list
-        tre_list = []
-        for k in tres.keys():
-            if not '"' in tres[k]:
-                tre_list.append('-co "TRE=%s=%s"' %(k,src_ds.GetMetadataItem(k,"TRE")))
-
+        m.update(meta_dict)
 
         #### Close the source dataset
         src_ds = None
 
-        #print "Merging bands"
-        cmd = 'gdalbuildvrt -separate "%s" "%s"' %(vrt,'" "'.join(members))
-
-        #
-        (err,so,se) = ExecCmd(cmd)
-        if err == 1:
-            rc = 1
-
-        cmd = 'gdal_translate -a_srs "%s" -of NITF -co "IC=NC" %s %s "%s" "%s"' %(s_srs_proj4,string.join(m_list, " "), string.join(tre_list, " "), vrt, dstfp )
+        cmd = 'gdalbuildvrt -separate "%s" "%s"' %(dstfp,'" "'.join(members))
 
         (err,so,se) = ExecCmd(cmd)
         if err == 1:
             rc = 1
 
         #print "Writing metadata to output"
-        dst_ds = gdal.Open(dstfp,gdalconst.GA_ReadOnly)
+        dst_ds = gdal.Open(dstfp,gdalconst.GA_Update)
         if dst_ds is not None:
             #### check that ds has correct number of bands
             if not dst_ds.RasterCount == len(band_dict):
@@ -404,7 +518,16 @@ def stackIkBands(dstfp, members):
                     rb = dst_ds.GetRasterBand(key)
                     rb.SetColorInterpretation(band_dict[key])
 
-        #### Close Image
+                #### Carry the projection, NITF metadata and RPCs of the blue band
+                dst_ds.SetProjection(proj)
+                dst_ds.SetMetadata(m)
+                if rpc:
+                    dst_ds.SetMetadata(rpc,"RPC")
+
+        else:
+            rc = 1
+
+        #### Close Image, writing the VRT
         dst_ds = None
 
         #### also copy blue and rgb aux files
@@ -423,22 +546,10 @@ def stackIkBands(dstfp, members):
 
     else:
         rc = 1
-    try:
-        os.remove(vrt)
-    except Exception, e:
-        logger.warning("Cannot remove file: %s, %s" %(vrt,e))
     return rc
 
 
-def calcStats(opt,info):
-
-    LogMsg("Calculating image with stats")
-
-    rc = 0
-
-    #### Get Well-known Text String of Projection from EPSG Code
-    p = opt.spatial_ref.srs
-    prj = p.ExportToWkt()
+def GetStretchParams(opt,info):
 
     imax = 2047.0
 
@@ -458,65 +569,98 @@ def calcStats(opt,info):
             omax = 1.0
 
     #### Stretch
+    CFlist = []
     if info.stretch != "ns":
         CFlist = GetCalibrationFactors(info)
         if len(CFlist) == 0:
             LogMsg("Cannot get image calibration factors from metadata")
-            return 1
+            return None
         
         if len(CFlist) < info.bands:
             LogMsg("Metadata image calibration factors have fewer bands than the image")
-            return 1
-    
-    wds = gdal.Open(info.warpfile,gdalconst.GA_ReadOnly)
-    if wds is not None:
-
-        xsize = wds.RasterXSize
-        ysize = wds.RasterYSize
-
-        vds = VRTdriver.CreateCopy(info.vrtfile,wds,0)
-        if vds is not None:
-
-            for band in range(1,vds.RasterCount+1):
-
-                if info.stretch == "ns":
-                    LUT = "0:0,%f:%f" %(imax,omax)
-                elif info.stretch == "rf":
-                    LUT = "0:0,%f:%f" %(imax,omax*imax*CFlist[band-1])
-                elif info.stretch == "rd":
-                    LUT = "0:0,%f:%f" %(imax,imax*CFlist[band-1])
-                elif info.stretch == "mr":
-                    iLUT = [0, 0.125, 0.25, 0.375, 0.625, 1]
-                    oLUT = [0, 0.375, 0.625, 0.75, 0.875, 1]
-                    lLUT = map(lambda x: "%f:%f"%(iLUT[x]/CFlist[band-1],oLUT[x]*omax), range(len(iLUT)))
-                    LUT = ",".join(lLUT)
-
-                if info.stretch != "ns":
-                    logger.debug("Band Calibration Factors: %i %f" %(band, CFlist[band-1]))
-                logger.debug("Band stretch parameters: %i %s" %(band, LUT))
-
-                ComplexSourceXML = ('<ComplexSource>'
-                                    '   <SourceFilename relativeToVRT="0">%s</SourceFilename>'
-                                    '   <SourceBand>%s</SourceBand>'
-                                    '   <ScaleOffset>0</ScaleOffset>'
-                                    '   <ScaleRatio>1</ScaleRatio>'
-                                    '   <LUT>%s</LUT>'
-                                    '   <NODATA>0</NODATA>'
-                                    '   <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>'
-                                    '   <DstRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>'
-                                    '</ComplexSource>)' %(info.warpfile,band,LUT,xsize,ysize,xsize,ysize))
-
-                vds.GetRasterBand(band).SetMetadataItem("source_0", ComplexSourceXML, "new_vrt_sources")
-                if vds.GetRasterBand(band).GetColorInterpretation() == gdalconst.GCI_AlphaBand:
-                    vds.GetRasterBand(band).SetColorInterpretation(gdalconst.GCI_Undefined)
-        else:
-            LogMsg("Cannot create virtual dataset: %s" %info.vrtfile)
+            return None
 
-    else:
-        LogMsg("Cannot open dataset: %s" %wds_fp)
+    return imax, omax, CFlist
+
+
+def BuildStretchVrt(opt,info,srcfile,vrtfile,band_list=None):
+    """
+    Write a VRT over srcfile whose bands apply the stretch LUT to the source
+    bands in band_list (default all).  Georeferencing, GCPs and RPC metadata
+    are carried over so the VRT can be warped directly.
+    """
+
+    params = GetStretchParams(opt,info)
+    if params is None:
+        return 1
+    imax, omax, CFlist = params
+
+    wds = gdal.Open(srcfile,gdalconst.GA_ReadOnly)
+    if wds is None:
+        LogMsg("Cannot open dataset: %s" %srcfile)
+        return 1
+
+    xsize = wds.RasterXSize
+    ysize = wds.RasterYSize
+    if band_list is None:
+        band_list = range(1,wds.RasterCount+1)
+
+    vds = VRTdriver.Create(vrtfile,xsize,ysize,0)
+    if vds is None:
+        LogMsg("Cannot create virtual dataset: %s" %vrtfile)
+        wds = None
+        return 1
+
+    vds.SetProjection(wds.GetProjectionRef())
+    vds.SetGeoTransform(wds.GetGeoTransform())
+    if wds.GetGCPCount() > 0:
+        vds.SetGCPs(wds.GetGCPs(),wds.GetGCPProjection())
+    rpc = wds.GetMetadata("RPC")
+    if rpc:
+        vds.SetMetadata(rpc,"RPC")
+
+    for i,band in enumerate(band_list):
+
+        vds.AddBand(gdal.GetDataTypeByName(opt.outtype))
+        vband = vds.GetRasterBand(i+1)
+
+        if info.stretch == "ns":
+            LUT = "0:0,%f:%f" %(imax,omax)
+        elif info.stretch == "rf":
+            LUT = "0:0,%f:%f" %(imax,omax*imax*CFlist[band-1])
+        elif info.stretch == "rd":
+            LUT = "0:0,%f:%f" %(imax,imax*CFlist[band-1])
+        elif info.stretch == "mr":
+            iLUT = [0, 0.125, 0.25, 0.375, 0.625, 1]
+            oLUT = [0, 0.375, 0.625, 0.75, 0.875, 1]
+            lLUT = map(lambda x: "%f:%f"%(iLUT[x]/CFlist[band-1],oLUT[x]*omax), range(len(iLUT)))
+            LUT = ",".join(lLUT)
+
+        if info.stretch != "ns":
+            logger.debug("Band Calibration Factors: %i %f" %(band, CFlist[band-1]))
+        logger.debug("Band stretch parameters: %i %s" %(band, LUT))
+
+        ComplexSourceXML = ('<ComplexSource>'
+                            '   <SourceFilename relativeToVRT="0">%s</SourceFilename>'
+                            '   <SourceBand>%s</SourceBand>'
+                            '   <ScaleOffset>0</ScaleOffset>'
+                            '   <ScaleRatio>1</ScaleRatio>'
+                            '   <LUT>%s</LUT>'
+                            '   <NODATA>0</NODATA>'
+                            '   <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>'
+                            '   <DstRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>'
+                            '</ComplexSource>)' %(srcfile,band,LUT,xsize,ysize,xsize,ysize))
+
+        vband.SetMetadataItem("source_0", ComplexSourceXML, "new_vrt_sources")
+        if vband.GetColorInterpretation() == gdalconst.GCI_AlphaBand:
+            vband.SetColorInterpretation(gdalconst.GCI_Undefined)
 
     vds = None
     wds = None
+    return 0
+
+
+def GetCreationOptions(opt):
 
     if opt.format == 'GTiff':
         if opt.gtiff_compression == 'lzw':
@@ -533,21 +677,35 @@ def calcStats(opt,info):
     else:
         co = ''
 
+    return co
+
+
+def UseSinglePass(opt):
+    """
+    True if the stretch should be applied in the warp itself (--single_pass).
+    Needs an output driver gdalwarp can create directly.
+    """
+    return opt.single_pass and opt.format in SINGLE_PASS_FORMATS
+
+
+def calcStats(opt,info):
+
+    LogMsg("Calculating image with stats")
+
+    rc = 0
+
+    if BuildStretchVrt(opt,info,info.warpfile,info.vrtfile) == 1:
+        return 1
+
+    co = GetCreationOptions(opt)
+
     pf = platform.platform()
     if pf.startswith("Linux"):
         config_options = '--config GDAL_CACHEMAX 2048'
     else:
         config_options = ''
 
-    if opt.no_pyramids:
-        base_cmd = 'gdal_translate'
-    else:
-        base_cmd = 'gdal_translate -stats'
-
-
-
-    cmd = ('%s %s -ot %s -a_srs "%s" %s%s-of %s "%s" "%s"' %(
-        base_cmd,
+    cmd = ('gdal_translate %s -ot %s -a_srs "%s" %s%s-of %s "%s" "%s"' %(
         config_options,
         opt.outtype,
         opt.spatial_ref.proj4,
@@ -558,29 +716,42 @@ def calcStats(opt,info):
         info.localdst
         ))
 
-    (err,so,se) = ExecCmd(cmd)
+    (err,so,se) = ExecGdalCmd(cmd)
     if err == 1:
         rc = 1
 
-    #### Calculate Pyramids
-    if not opt.no_pyramids:
-        if opt.format in ["GTiff"]:
-            if os.path.isfile(info.localdst):
-                cmd = ('gdaladdo "%s" 2 4 8 16' %(info.localdst))
-                (err,so,se) = ExecCmd(cmd)
-                if err == 1:
-                    rc = 1
+    if FinishOutput(opt,info) == 1:
+        rc = 1
+
+    return rc
+
+
+def FinishOutput(opt,info):
+    """
+    Add pyramids (GTiff only) and stats to info.localdst in one in-process
+    pass and write its .prj file.
+    """
+
+    rc = 0
+
+    #### Calculate Pyramids and Stats
+    if not opt.no_pyramids and os.path.isfile(info.localdst):
+        threads = resources.warp_settings(getattr(opt,'processes',None), opt.warp_threads, opt.warp_memory)[0]
+        if finalize.run(info.localdst, opt.pyramid_levels, opt.pyramid_resampling, approx=opt.approx_stats,
+                        threads=threads, overviews=opt.format in ["GTiff"]) == 1:
+            rc = 1
 
     #### Write .prj File
     if os.path.isfile(info.localdst):
         txtpath = os.path.splitext(info.localdst)[0] + '.prj'
         txt = open(txtpath,'w')
-        txt.write(prj)
+        txt.write(opt.spatial_ref.srs.ExportToWkt())
         txt.close()
 
     return rc
 
 
+
 def GetImageStats(opt, info):
 
     #### Add code to read info from IKONOS blu image
@@ -743,6 +914,18 @@ def GetImageStats(opt, info):
 
         info.extent = "-te %.12f %.12f %.12f %.12f " %(min(Xs),min(Ys),max(Xs),max(Ys))
 
+        #### Clip the warp extent to the AOI
+        if opt.aoi is not None:
+            clipped = aoi.clip(opt.aoi, extent_geom, t_srs)
+            if clipped is None:
+                LogMsg("Image footprint does not intersect the AOI")
+                rc = 1
+            else:
+                minx, maxx, miny, maxy = clipped.GetEnvelope()
+                info.extent = "-te %.12f %.12f %.12f %.12f " %(minx,miny,maxx,maxy)
+                info.geometry_wkt = clipped.ExportToWkt()
+                LogMsg("AOI clipped extent: %s" %info.extent)
+
         rasterxsize_m = abs(math.sqrt((ul_geom.GetX() - ur_geom.GetX())**2 + (ul_geom.GetY() - ur_geom.GetY())**2))
         rasterysize_m = abs(math.sqrt((ul_geom.GetX() - ll_geom.GetX())**2 + (ul_geom.GetY() - ll_geom.GetY())**2))
 
@@ -840,30 +1023,34 @@ def ExtractDGMetadataFile(srcfp, wd):
     Searches the .tar for a valid XML. If found,
     extracts the metadata file. Returns
     None if no valid metadata could be found.
+    
+    For a /vsitar/ source the archive holding the image is searched for
+    the XML sharing the image's name.
     """
     
     metapath = None
     filename = os.path.basename(srcfp)
-    tarpath = os.path.splitext(srcfp)[0] + '.tar'
-    if os.path.isfile(tarpath):
+    metaname = None
+    if tar_index.is_vsitar(srcfp):
+        tarpath, member = tar_index.split(srcfp)
+        metaname = os.path.splitext(member)[0]
+    else:
+        tarpath = os.path.splitext(srcfp)[0] + '.tar'
         match = re.search(DG_FILE, filename)
         if match:
             metaname = match.group('oname')
-            
-            try:
-                tar = tarfile.open(tarpath, 'r')
-                tarlist = tar.getnames()
-                for t in tarlist:
-                    if metaname.lower() in t.lower() and os.path.splitext(t)[1].lower() == ".xml":
-                        tf = tar.extractfile(t)
-                        metapath = os.path.join(wd, os.path.splitext(filename)[0]+os.path.splitext(t)[1].lower())
-                        fpfh = open(metapath,"w")
-                        tfstr = tf.read()
-                        fpfh.write(tfstr)
-                        fpfh.close()
-                        tf.close()
-            except Exception,e:
-                logger.error("Cannot open Tar file: %s" %tarpath)
+    
+    if metaname and os.path.isfile(tarpath):
+        try:
+            index = tar_index.get(tarpath)
+            for t in index.names():
+                if metaname.lower() in t.lower() and os.path.splitext(t)[1].lower() == ".xml":
+                    metapath = os.path.join(wd, os.path.splitext(filename)[0]+os.path.splitext(t)[1].lower())
+                    fpfh = open(metapath,"wb")
+                    fpfh.write(index.read(t))
+                    fpfh.close()
+        except Exception,e:
+            logger.error("Cannot open Tar file: %s" %tarpath)
 
     if metapath and os.path.isfile(metapath):
         return metapath
@@ -1018,13 +1205,27 @@ def WarpImage(opt,info):
 
     rc = 0
 
-    pf = platform.platform()
-    if pf.startswith("Linux"):
-        config_options = '-wm 2000 --config GDAL_CACHEMAX 2048 --config GDAL_NUM_THREADS 1'
+    #### Size threads and memory from the job's allocation shared by concurrently running images
+    threads, wm, cachemax = resources.warp_settings(getattr(opt,'processes',None), opt.warp_threads, opt.warp_memory)
+    config_options = '-wm %i --config GDAL_CACHEMAX %i --config GDAL_NUM_THREADS %i' %(wm, cachemax, threads)
+    if threads > 1:
+        config_options += ' -multi -wo NUM_THREADS=%i' %threads
+    LogMsg("Warp settings: %i threads, %i MB warp memory, %i MB cache" %(threads, wm, cachemax))
+
+    #### In single pass mode a stretch VRT over the raw source is warped straight to the output
+    single_pass = UseSinglePass(opt)
+    if single_pass:
+        band_list = [int(b) for b in info.rgb_bands.split()[1::2]] or None
+        warpsrc = info.vrtfile
+        warpdst = info.localdst
+        out_options = '-of %s -ot %s %s' %(opt.format, opt.outtype, GetCreationOptions(opt))
     else:
-        config_options = '--config GDAL_NUM_THREADS 1'
+        band_list = None
+        warpsrc = info.rawvrt
+        warpdst = info.warpfile
+        out_options = '-of GTiff -ot UInt16 -co "TILED=YES" -co "BIGTIFF=IF_SAFER" '
 
-    if not os.path.isfile(info.warpfile):
+    if not os.path.isfile(warpdst):
 
         LogMsg("Warping Image")
         
@@ -1044,18 +1245,18 @@ def WarpImage(opt,info):
                     rc = 1
     
                 if rpb_p:
-                    if not os.path.isfile(rpb_p):
+                    if not tar_index.exists(rpb_p):
                         err = ExtractRPB(info.localsrc,rpb_p)
                         if err == 1:
                             rc = 1
-                    if not os.path.isfile(rpb_p):
+                    if not tar_index.exists(rpb_p):
                         logger.error("No RPC information found. Image cannot be terrain corrected with a DEM or avg elevation.")
                         rc = 1
                         
                         
         #### convert to VRT and modify 4th band
         cmd = 'gdal_translate -of VRT "{0}" "{1}"'.format(info.localsrc,info.rawvrt)
-        (err,so,se) = ExecCmd(cmd)
+        (err,so,se) = ExecGdalCmd(cmd)
         if err == 1:
             rc = 1
         
@@ -1065,7 +1266,11 @@ def WarpImage(opt,info):
                 vds.GetRasterBand(4).SetColorInterpretation(gdalconst.GCI_Undefined)
             vds = None
 
-        nodata_list = ["0"] * info.bands
+        if single_pass and rc <> 1:
+            LogMsg("Building stretch VRT over raw source")
+            rc = BuildStretchVrt(opt,info,info.rawvrt,info.vrtfile,band_list)
+
+        nodata_list = ["0"] * (len(band_list) if band_list else info.bands)
         
         
         if not opt.skip_warp:
@@ -1073,8 +1278,16 @@ def WarpImage(opt,info):
             if rc <> 1:
                 ####  Set RPC_DEM or RPC_HEIGHT transformation option
                 if opt.dem != None:
-                    LogMsg('DEM: %s' %(os.path.basename(opt.dem)))
-                    to = "RPC_DEM=%s" %opt.dem
+                    demfile = opt.dem
+                    if opt.dem_cache:
+                        cache = dem_cache.DemCache(opt.dem_cache, opt.dem_cache_size, opt.dem_cache_epsg)
+                        crop = cache.crop(opt.dem, info.geometry_wkt, opt.spatial_ref.srs, ExecGdalCmd)
+                        if crop:
+                            demfile = crop
+                        else:
+                            LogMsg("Cannot crop DEM, using the full DEM")
+                    LogMsg('DEM: %s' %(os.path.basename(demfile)))
+                    to = "RPC_DEM=%s" %demfile
     
                 elif opt.ortho_height is not None:
                     LogMsg("Elevation: {0} meters".format(opt.ortho_height))
@@ -1089,45 +1302,70 @@ def WarpImage(opt,info):
                     
                 
                 #### GDALWARP Command
-                cmd = 'gdalwarp %s -srcnodata "%s" -of GTiff -ot UInt16 %s%s%s-co "TILED=YES" -co "BIGTIFF=IF_SAFER" -t_srs "%s" -r %s -et 0.01 -rpc -to "%s" "%s" "%s"' %(
+                cmd = 'gdalwarp %s -srcnodata "%s" %s%s%s%s-t_srs "%s" -r %s -et 0.01 -rpc -to "%s" "%s" "%s"' %(
                     config_options,
                     " ".join(nodata_list),
+                    out_options,
                     info.centerlong,
                     info.extent,
                     info.res,
                     opt.spatial_ref.proj4,
                     opt.resample,
                     to,
-                    info.rawvrt,
-                    info.warpfile
+                    warpsrc,
+                    warpdst
                     )           
                 
-                (err,so,se) = ExecCmd(cmd)
+                warpstart = datetime.today()
+                (err,so,se) = ExecGdalCmd(cmd)
                 #print err
                 if err == 1:
                     rc = 1
+                else:
+                    LogWarpThroughput(warpdst, datetime.today()-warpstart, threads)
                 
                 
         else:
             #### GDALWARP Command
-            cmd = 'gdalwarp %s -srcnodata "%s" -of GTiff -ot UInt16 %s-co "TILED=YES" -co "BIGTIFF=IF_SAFER" -t_srs "%s" -r %s "%s" "%s"' %(
+            cmd = 'gdalwarp %s -srcnodata "%s" %s%s-t_srs "%s" -r %s "%s" "%s"' %(
                 config_options,
                 " ".join(nodata_list),
+                out_options,
                 info.res,
                 opt.spatial_ref.proj4,
                 opt.resample,
-                info.rawvrt,
-                info.warpfile
+                warpsrc,
+                warpdst
                 )           
             
-            (err,so,se) = ExecCmd(cmd)
+            warpstart = datetime.today()
+            (err,so,se) = ExecGdalCmd(cmd)
             #print err
             if err == 1:
                 rc = 1
+            else:
+                LogWarpThroughput(warpdst, datetime.today()-warpstart, threads)
                 
         return rc
 
 
+def LogWarpThroughput(warpfile, td, threads):
+    ds = gdal.Open(warpfile,gdalconst.GA_ReadOnly)
+    if ds is not None:
+        mpixels = ds.RasterXSize * ds.RasterYSize * ds.RasterCount / 1000000.0
+        ds = None
+        seconds = max(td.days * 86400 + td.seconds + td.microseconds / 1000000.0, 0.001)
+        LogMsg("Warp throughput: %.1f Mpixels in %s, %.2f Mpixels/s (%i threads)" %(mpixels, td, mpixels/seconds, threads))
+
+
+def LogNodeThroughput(image_list, starttime):
+    td = datetime.today() - starttime
+    seconds = max(td.days * 86400 + td.seconds + td.microseconds / 1000000.0, 0.001)
+    nbytes = sum([tar_index.getsize(fp) for fp in image_list if tar_index.exists(fp)])
+    LogMsg("Node %s throughput: %i images, %.2f GB in %s (%.1f images/hour, %.2f GB/hour)" %(
+        platform.node(), len(image_list), nbytes / 1e9, td, len(image_list) * 3600.0 / seconds, nbytes / 1e9 * 3600.0 / seconds))
+
+
 def get_rpc_height(info):
     ds = gdal.Open(info.localsrc,gdalconst.GA_ReadOnly)
     if ds is not None:
@@ -1203,44 +1441,27 @@ def overlap_check(geometry_wkt, spatial_ref, demPath):
 
     imageSpatialReference = spatial_ref.srs
     imageGeometry = ogr.CreateGeometryFromWkt(geometry_wkt)
-    dem = gdal.Open(demPath, gdalconst.GA_ReadOnly)
+    dem = dem_cache.dem_info(demPath)
 
     if dem is not None:
-            xsize = dem.RasterXSize
-            ysize = dem.RasterYSize
-            demProjection = dem.GetProjectionRef()
-            if demProjection:
-
-                gtf = dem.GetGeoTransform()
-
-                minx = gtf[0]
-                maxx = minx + xsize * gtf[1]
-                maxy = gtf[3]
-                miny = maxy + ysize * gtf[5]
-
-                dem_geometry_wkt = 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' %(minx,miny,minx,maxy,maxx,maxy,maxx,miny,minx,miny)
-                demGeometry = ogr.CreateGeometryFromWkt(dem_geometry_wkt)
-		LogMsg("DEM extent: %s" %demGeometry)
-                demSpatialReference = osr.SpatialReference(demProjection)
+        if dem.srs_wkt:
+            demGeometry = ogr.CreateGeometryFromWkt(dem.extent_wkt())
+            LogMsg("DEM extent: %s" %demGeometry)
+            demSpatialReference = dem.srs()
 
+            if not imageSpatialReference.IsSame(demSpatialReference):
+                LogMsg("Transforming image geometry to dem spatial reference")
                 coordinateTransformer = osr.CoordinateTransformation(imageSpatialReference, demSpatialReference)
-		if not imageSpatialReference.IsSame(demSpatialReference):
-		    #LogMsg("Image Spatial Refernce: %s" %imageSpatialReference)
-		    #LogMsg("DEM Spatial ReferenceL %s" %demSpatialReference)
-		    #LogMsg("Image Geometry before transformation: %s" %imageGeometry)
-		    LogMsg("Transforming image geometry to dem spatial reference")
-                    imageGeometry.Transform(coordinateTransformer)
-		    #LogMsg("Image Geometry after transformation: %s" %imageGeometry)
+                imageGeometry.Transform(coordinateTransformer)
 
-                dem = None
-                overlap = imageGeometry.Within(demGeometry)
+            overlap = imageGeometry.Within(demGeometry)
 
-                if overlap is False:
-                    LogMsg("ERROR - Image is not contained within DEM extent")
+            if overlap is False:
+                LogMsg("ERROR - Image is not contained within DEM extent")
 
-            else:
-                LogMsg("ERROR - DEM has no spatial reference information: %s" %demPath)
-                overlap = False
+        else:
+            LogMsg("ERROR - DEM has no spatial reference information: %s" %demPath)
+            overlap = False
 
     else:
         LogMsg("ERROR - Cannot open DEM to determine extent: %s" %demPath)
@@ -1252,23 +1473,24 @@ def overlap_check(geometry_wkt, spatial_ref, demPath):
 
 def ExtractRPB(item,rpb_p):
     rc = 0
+    if tar_index.is_vsitar(item):
+        #### GDAL reads sidecars inside the archive through /vsitar/; nothing to extract
+        if not tar_index.exists(rpb_p):
+            logger.error("No RPC file in tar archive: %s" %rpb_p)
+            rc = 1
+        return rc
+    
     tar_p = os.path.splitext(item)[0]+".tar"
     LogMsg(tar_p)
     if os.path.isfile(tar_p):
         try:
-            tar = tarfile.open(tar_p, 'r')
-            tarlist = tar.getnames()
-            for t in tarlist:
+            index = tar_index.get(tar_p)
+            for t in index.names():
                 if '.rpb' in string.lower(t) or '_rpc' in string.lower(t): #or '.til' in string.lower(t):
-                    tf = tar.extractfile(t)
                     fp = os.path.splitext(rpb_p)[0] + os.path.splitext(t)[1]
-                    fpfh = open(fp,"w")
-                    tfstr = tf.read()
-                    #print repr(tfstr)
-                    fpfh.write(tfstr)
+                    fpfh = open(fp,"wb")
+                    fpfh.write(index.read(t))
                     fpfh.close()
-                    tf.close()
-                    status = 0
         except Exception,e:
             logger.error("Cannot open Tar file: %s" %tar_p)
             rc = 1
@@ -1311,15 +1533,14 @@ def getDGXmlData(xmlpath,stretch):
     calibDict = {}
     abscalfact_dict = {}
     try:
-        xmldoc = minidom.parse(xmlpath)
+        md = dg_metadata.read(xmlpath)
     except Exception, e:
         logger.error("Cannot parse metadata file: {0}".format(xmlpath))
         return None
     else:
 
-        if len(xmldoc.getElementsByTagName('IMD')) >=1:
+        if len(md.bands) >=1:
     
-            nodeIMD = xmldoc.getElementsByTagName('IMD')[0]
             EsunDict = {  # Spectral Irradiance in W/m2/um
                 'QB02_BAND_P':1381.79,
                 'QB02_BAND_B':1924.59,
@@ -1371,15 +1592,11 @@ def getDGXmlData(xmlpath,stretch):
                 }
     
             # get acquisition IMAGE tags
-            nodeIMAGE = nodeIMD.getElementsByTagName('IMAGE')
+            sat = md.satid
+            t = md.firstlinetime
     
-            sat = nodeIMAGE[0].getElementsByTagName('SATID')[0].firstChild.data
-            t = nodeIMAGE[0].getElementsByTagName('FIRSTLINETIME')[0].firstChild.data
-    
-            if len(nodeIMAGE[0].getElementsByTagName('MEANSUNEL')) >= 1:
-                sunEl = float(nodeIMAGE[0].getElementsByTagName('MEANSUNEL')[0].firstChild.data)
-            elif len(nodeIMAGE[0].getElementsByTagName('SUNEL')) >= 1:
-                sunEl = float(nodeIMAGE[0].getElementsByTagName('SUNEL')[0].firstChild.data)
+            if md.sunel is not None:
+                sunEl = md.sunel
             else:
                 return None
     
@@ -1389,20 +1606,16 @@ def getDGXmlData(xmlpath,stretch):
             
             # get BAND tags
             for band in DGbandList:
-                nodeBAND = nodeIMD.getElementsByTagName(band)
-                #print nodeBAND
-                if not len(nodeBAND) == 0:
+                if band in md.bands:
                     
-                    temp = nodeBAND[0].getElementsByTagName('ABSCALFACTOR')
-                    if not len(temp) == 0:
-                        abscal = float(temp[0].firstChild.data)
+                    if band in md.abscalfactor:
+                        abscal = md.abscalfactor[band]
                         
                     else:
                         return None
                         
-                    temp = nodeBAND[0].getElementsByTagName('EFFECTIVEBANDWIDTH')
-                    if not len(temp) == 0:
-                        effbandw = float(temp[0].firstChild.data)
+                    if band in md.effectivebandwidth:
+                        effbandw = md.effectivebandwidth[band]
                     else:
                         return None
                     
@@ -1888,6 +2101,14 @@ def ExecCmd(cmd):
     return (err,so,se)
 
 
+def ExecGdalCmd(cmd):
+    """
+    Run a gdalwarp, gdal_translate or gdaladdo command line in-process via the
+    GDAL API, falling back to ExecCmd for anything else.
+    """
+    return gdal_exec.ExecGdalCmd(cmd, ExecCmd)
+
+
 def ExecCmd_mp(job):
     job_name, cmd = job
     logger.info('Running job: {0}'.format(job_name))
@@ -1917,61 +2138,19 @@ def getBitdepth(outtype):
 
 def getSensor(srcfn):
 
-    ### Regex signatures to identify file vendor, mode, kind, and create the name_dict
-    RAW_DG = "(?P<ts>\d\d[a-z]{3}\d{8})-(?P<prod>\w{4})?(?P<tile>\w+)?-(?P<oid>\d{12}_\d\d)_(?P<pnum>p\d{3})"
-
-    RENAMED_DG = "(?P<snsr>\w\w\d\d)_(?P<ts>\d\d[a-z]{3}\d{9})-(?P<prod>\w{4})?(?P<tile>\w+)?-(?P<catid>[a-z0-9]+)"
-
-    RENAMED_DG2 = "(?P<snsr>\w\w\d\d)_(?P<ts>\d{14})_(?P<catid>[a-z0-9]{16})"
-
-    RAW_GE = "(?P<snsr>\d[a-z])(?P<ts>\d{6})(?P<band>[a-z])(?P<said>\d{9})(?P<prod>\d[a-z])(?P<pid>\d{3})(?P<siid>\d{8})(?P<ver>\d)(?P<mono>[a-z0-9])_(?P<pnum>\d{8,9})"
-
-    RENAMED_GE = "(?P<snsr>\w\w\d\d)_(?P<ts>\d{6})(?P<band>\w)(?P<said>\d{9})(?P<prod>\d\w)(?P<pid>\d{3})(?P<siid>\d{8})(?P<ver>\d)(?P<mono>\w)_(?P<pnum>\d{8,9})"
-
-    RAW_IK = "po_(?P<po>\d{5,7})_(?P<band>[a-z]+)_(?P<cmp>\d+)"
-
-    RENAMED_IK = "(?P<snsr>[a-z]{2}\d\d)_(?P<ts>\d{12})(?P<siid>\d+)_(?P<band>[a-z]+)_(?P<lat>\d{4}[ns])"
+    return discovery.get_sensor(srcfn)
 
-    sat = None
-    vendor = None
 
-    DG_patterns = [RAW_DG, RENAMED_DG, RENAMED_DG2]
-    GE_patterns = [RAW_GE, RENAMED_GE]
-    IK_patterns = [RAW_IK, RENAMED_IK]
-
-    for pattern in DG_patterns:
-        p = re.compile(pattern)
-        m = p.search(srcfn.lower())
-        if m is not None:
-            vendor = "DigitalGlobe"
-            gd = m.groupdict()
-            if 'snsr' in gd:
-                sat = gd['snsr']
-
-    for pattern in GE_patterns:
-        p = re.compile(pattern)
-        m = p.search(srcfn.lower())
-        if m is not None:
-            vendor = "GeoEye"
-            sat = "GE01"
-
-    for pattern in IK_patterns:
-        p = re.compile(pattern)
-        m = p.search(srcfn.lower())
-        if m is not None:
-            vendor = "GeoEye"
-            sat = "IK01"
-
-    return vendor, sat
-
-
-def FindImages(inpath,exts):
+def FindImages(inpath,exts,manifest=None):
 
     image_list = []
-    for root,dirs,files in os.walk(inpath):
-        for f in  files:
-            if os.path.splitext(f)[1].lower() in exts:
-                image_path = os.path.join(root,f)
-                image_path = string.replace(image_path,'\\','/')
-                image_list.append(image_path)
+    for image_path in discovery.find_files(inpath,exts,manifest):
+        if os.path.splitext(image_path)[1].lower() == '.tar':
+            #### image members of the archive, as /vsitar/ paths
+            try:
+                image_list.extend(tar_index.find_images(image_path, [e for e in exts if e != '.tar']))
+            except Exception,e:
+                logger.error("Cannot index tar file %s: %s" %(image_path,e))
+        else:
+            image_list.append(image_path)
     return image_list
@@ -0,0 +1,211 @@
+"""
+In-process Brovey pan-sharpening.
+
+pansharpen() replaces the gdal_landsat_pansharp / gdal_translate chain: the
+multispectral ortho is resampled to the pan grid through a warped VRT,
+pan and multispectral windows are read block by block on a thread pool,
+sharpened with NumPy and written straight to the compressed, tiled output.
+Band statistics are accumulated while writing, so no extra pass is needed.
+Only a few windows per thread are in flight at a time, so finished windows
+do not pile up in memory while the single writer compresses them.
+
+Weighted Brovey scales every band by pan / I, where the intensity I is the
+weighted sum of the multispectral bands that fall inside the pan response.
+The weights below are each band's overlap with the sensor's pan band in nm,
+normalized at run time.  Plain Brovey weighs all bands equally.
+"""
+
+import os, logging, threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import gdal, gdalconst
+
+logger = logging.getLogger("logger")
+
+METHODS = ["weighted", "brovey"]
+CREATION_OPTIONS = ["TILED=YES", "COMPRESS=LZW", "BIGTIFF=IF_SAFER"]
+BLOCK = 1024
+#### Windows computed or being computed ahead of the writer, per thread
+INFLIGHT_PER_THREAD = 2
+
+#### Band overlap with the pan response (nm), keyed by sensor and band count
+BAND_WEIGHTS = {
+    ("WV02", 8): [0, 60, 70, 40, 60, 40, 30, 0],
+    ("WV03", 8): [0, 60, 70, 40, 60, 40, 30, 0],
+    ("WV02", 4): [60, 70, 60, 30],
+    ("WV03", 4): [60, 70, 60, 30],
+    ("QB02", 4): [60, 70, 60, 140],
+    ("GE01", 4): [60, 70, 35, 20],
+    ("IK01", 4): [0, 69, 66, 96],
+}
+
+
+def band_weights(sensor, nbands, method="weighted"):
+    """Normalized intensity weights for nbands multispectral bands."""
+    weights = BAND_WEIGHTS.get((sensor, nbands)) if method == "weighted" else None
+    if weights is None:
+        if method == "weighted":
+            logger.warning("No pan-sharpening weights for %s with %i bands, using equal weights" % (sensor, nbands))
+        weights = [1.0] * nbands
+    total = float(sum(weights))
+    return numpy.array([w / total for w in weights], dtype=numpy.float32)
+
+
+def brovey(pan, ms, weights, nodata=0):
+    """
+    Sharpens ms (bands x rows x cols) with pan (rows x cols).  Pixels where
+    pan or any band is nodata, or where the intensity is 0, are set to nodata.
+    """
+    ms = ms.astype(numpy.float32)
+    pan = pan.astype(numpy.float32)
+    intensity = numpy.tensordot(weights, ms, axes=1)
+    valid = (pan != nodata) & (intensity > 0) & numpy.all(ms != nodata, axis=0)
+    ratio = numpy.zeros(pan.shape, dtype=numpy.float32)
+    numpy.divide(pan, intensity, out=ratio, where=valid)
+    return ms * ratio, valid
+
+
+class RunningStats(object):
+    """Running per-band min, max, mean and std of the valid pixels."""
+
+    def __init__(self, nbands):
+        self.n = 0
+        self.sums = numpy.zeros(nbands)
+        self.sq = numpy.zeros(nbands)
+        self.mins = numpy.full(nbands, numpy.inf)
+        self.maxs = numpy.full(nbands, -numpy.inf)
+
+    def add(self, data, valid):
+        if not valid.any():
+            return
+        vals = data[:, valid].astype(numpy.float64)
+        self.n += vals.shape[1]
+        self.sums += vals.sum(axis=1)
+        self.sq += (vals * vals).sum(axis=1)
+        self.mins = numpy.minimum(self.mins, vals.min(axis=1))
+        self.maxs = numpy.maximum(self.maxs, vals.max(axis=1))
+
+    def write(self, ds):
+        if self.n == 0:
+            return
+        mean = self.sums / self.n
+        std = numpy.sqrt(numpy.maximum(self.sq / self.n - mean * mean, 0))
+        for b in range(len(mean)):
+            ds.GetRasterBand(b + 1).SetStatistics(float(self.mins[b]), float(self.maxs[b]), float(mean[b]), float(std[b]))
+
+
+def pansharpen(panfp, mulfp, dstfp, sensor=None, method="weighted", threads=1,
+               block=BLOCK, creation_options=CREATION_OPTIONS, resample="cubic"):
+    """
+    Writes the pan-sharpened image of the pan and multispectral orthos to
+    dstfp.  Returns 0 on success, 1 on failure.
+    """
+    pan_ds = gdal.Open(panfp, gdalconst.GA_ReadOnly)
+    mul_ds = gdal.Open(mulfp, gdalconst.GA_ReadOnly)
+    if pan_ds is None or mul_ds is None:
+        logger.error("Cannot open pan or multispectral image: %s, %s" % (panfp, mulfp))
+        return 1
+
+    xsize, ysize = pan_ds.RasterXSize, pan_ds.RasterYSize
+    gt = pan_ds.GetGeoTransform()
+    proj = pan_ds.GetProjectionRef()
+    nbands = mul_ds.RasterCount
+    datatype = mul_ds.GetRasterBand(1).DataType
+    mul_ds = None
+    pan_ds = None
+
+    #### Multispectral resampled on the fly to the pan grid
+    vrtfp = os.path.splitext(dstfp)[0] + "_mul.vrt"
+    bounds = [gt[0], gt[3] + ysize * gt[5], gt[0] + xsize * gt[1], gt[3]]
+    vrt = gdal.Warp(vrtfp, mulfp, format="VRT", outputBounds=bounds, width=xsize, height=ysize,
+                    dstSRS=proj, resampleAlg=resample)
+    if vrt is None:
+        logger.error("Cannot resample multispectral image to the pan grid: %s" % mulfp)
+        return 1
+    vrt = None
+
+    driver = gdal.GetDriverByName("GTiff")
+    dst_ds = driver.Create(dstfp, xsize, ysize, nbands, datatype, creation_options)
+    if dst_ds is None:
+        logger.error("Cannot create pan-sharpened image: %s" % dstfp)
+        os.remove(vrtfp)
+        return 1
+    dst_ds.SetGeoTransform(gt)
+    dst_ds.SetProjection(proj)
+    for b in range(nbands):
+        dst_ds.GetRasterBand(b + 1).SetNoDataValue(0)
+
+    weights = band_weights(sensor, nbands, method)
+    dtype = gdal_array_type(datatype)
+    info = numpy.iinfo(dtype) if numpy.issubdtype(dtype, numpy.integer) else None
+    local = threading.local()
+
+    def work(window):
+        #### GDAL datasets are not thread safe: one pair of handles per thread
+        if not hasattr(local, "pan"):
+            local.pan = gdal.Open(panfp, gdalconst.GA_ReadOnly)
+            local.mul = gdal.Open(vrtfp, gdalconst.GA_ReadOnly)
+        xoff, yoff, w, h = window
+        pan = local.pan.GetRasterBand(1).ReadAsArray(xoff, yoff, w, h)
+        ms = local.mul.ReadAsArray(xoff, yoff, w, h)
+        if ms.ndim == 2:
+            ms = ms[numpy.newaxis]
+        out, valid = brovey(pan, ms, weights)
+        if info is not None:
+            out = numpy.clip(numpy.rint(out), info.min, info.max)
+        return window, out.astype(dtype), valid
+
+    windows = [(x, y, min(block, xsize - x), min(block, ysize - y))
+               for y in range(0, ysize, block) for x in range(0, xsize, block)]
+    stats = RunningStats(nbands)
+    pool = ThreadPool(max(1, threads))
+    rc = 0
+    try:
+        for (xoff, yoff, w, h), out, valid in imap_bounded(pool, work, windows, INFLIGHT_PER_THREAD * max(1, threads)):
+            for b in range(nbands):
+                dst_ds.GetRasterBand(b + 1).WriteArray(out[b], xoff, yoff)
+            stats.add(out, valid)
+    except Exception as e:
+        logger.error("Pan-sharpening failed: %s" % e)
+        rc = 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if rc == 0:
+        stats.write(dst_ds)
+    dst_ds = None
+    os.remove(vrtfp)
+    if rc == 1 and os.path.isfile(dstfp):
+        os.remove(dstfp)
+    return rc
+
+
+def imap_bounded(pool, func, items, inflight):
+    """
+    pool.imap(func, items), but with at most inflight items submitted ahead
+    of the consumer.  Nothing more is submitted once a result raises or the
+    consumer stops, so the pool only has the items in flight left to finish.
+    """
+    queue = deque()
+    for item in items:
+        queue.append(pool.apply_async(func, (item,)))
+        if len(queue) >= max(1, inflight):
+            yield queue.popleft().get()
+    while queue:
+        yield queue.popleft().get()
+
+
+def gdal_array_type(datatype):
+    """NumPy dtype of a GDAL data type."""
+    return {
+        gdalconst.GDT_Byte: numpy.uint8,
+        gdalconst.GDT_UInt16: numpy.uint16,
+        gdalconst.GDT_Int16: numpy.int16,
+        gdalconst.GDT_UInt32: numpy.uint32,
+        gdalconst.GDT_Int32: numpy.int32,
+        gdalconst.GDT_Float32: numpy.float32,
+        gdalconst.GDT_Float64: numpy.float64,
+    }[datatype]
@@ -0,0 +1,125 @@
+# std modules:
+from unittest import TestCase, skipIf
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+try:
+    import gdal, osr
+    from lib import pansharpen
+except ImportError:
+    gdal = None
+
+
+@skipIf(gdal is None, "GDAL is not installed")
+class Test_imap_bounded(TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(2)
+        self.submitted = []
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def items(self, n):
+        for i in range(n):
+            self.submitted.append(i)
+            yield i
+
+    def test_results_in_order_and_bounded(self):
+        """results come back in order with at most inflight items ahead."""
+        results = []
+        for r in pansharpen.imap_bounded(self.pool, lambda i: i * 2, self.items(10), 3):
+            self.assertLessEqual(len(self.submitted) - len(results), 3)
+            results.append(r)
+        self.assertEqual(results, [i * 2 for i in range(10)])
+
+    def test_stops_submitting_on_error(self):
+        """the first error is raised and no further items are submitted."""
+        def work(i):
+            if i == 1:
+                raise ValueError("bad window")
+            return i
+        with self.assertRaises(ValueError):
+            list(pansharpen.imap_bounded(self.pool, work, self.items(10), 2))
+        self.assertLessEqual(len(self.submitted), 3)
+
+
+@skipIf(gdal is None, "GDAL is not installed")
+class Test_brovey(TestCase):
+    def test_band_weights(self):
+        """weights are normalized, and equal when unknown or for plain Brovey."""
+        weights = pansharpen.band_weights("WV02", 4)
+        self.assertAlmostEqual(float(weights.sum()), 1.0, places=6)
+        numpy.testing.assert_allclose(weights, numpy.array([60, 70, 60, 30]) / 220.0, rtol=1e-6)
+        numpy.testing.assert_allclose(pansharpen.band_weights("XX99", 3), [1 / 3.0] * 3, rtol=1e-6)
+        numpy.testing.assert_allclose(pansharpen.band_weights("WV02", 4, "brovey"), [0.25] * 4, rtol=1e-6)
+
+    def test_ratio_and_masking(self):
+        """bands scale by pan / intensity; nodata and zero intensity are masked."""
+        pan = numpy.array([[10, 0, 8, 6]], dtype=numpy.uint16)
+        ms = numpy.array([
+            [[2, 2, 0, 0]],
+            [[6, 6, 4, 0]],
+        ], dtype=numpy.uint16)
+        weights = numpy.array([0.5, 0.5], dtype=numpy.float32)
+        out, valid = pansharpen.brovey(pan, ms, weights)
+        self.assertEqual(valid.tolist(), [[True, False, False, False]])
+        numpy.testing.assert_allclose(out[:, 0, 0], [2 * 10 / 4.0, 6 * 10 / 4.0])
+        self.assertTrue((out[:, ~valid] == 0).all())
+
+
+@skipIf(gdal is None, "GDAL is not installed")
+class Test_pansharpen(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3413)
+        self.proj = srs.ExportToWkt()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def image(self, name, data, res):
+        path = os.path.join(self.tmpdir, name + ".tif")
+        ds = gdal.GetDriverByName("GTiff").Create(path, data.shape[2], data.shape[1], data.shape[0], gdal.GDT_Byte)
+        ds.SetGeoTransform((0, res, 0, 4, 0, -res))
+        ds.SetProjection(self.proj)
+        for b in range(data.shape[0]):
+            ds.GetRasterBand(b + 1).WriteArray(data[b])
+        ds = None
+        return path
+
+    def test_round_trip(self):
+        """blockwise output and stats match Brovey computed directly with NumPy."""
+        rng = numpy.random.RandomState(0)
+        pan = rng.randint(1, 255, size=(1, 4, 4)).astype(numpy.uint8)
+        pan[0, 0, 0] = 0
+        pan[0, 3, 3] = 255
+        ms = rng.randint(1, 60, size=(4, 2, 2)).astype(numpy.uint8)
+        panfp = self.image("pan", pan, 1.0)
+        mulfp = self.image("mul", ms, 2.0)
+        dstfp = os.path.join(self.tmpdir, "pansh.tif")
+
+        rc = pansharpen.pansharpen(panfp, mulfp, dstfp, "WV02", threads=2, block=2, resample="near")
+        self.assertEqual(rc, 0)
+
+        #### nearest resampling from 2 m to 1 m repeats each pixel 2 x 2
+        ms_up = ms.repeat(2, axis=1).repeat(2, axis=2)
+        expected, valid = pansharpen.brovey(pan[0], ms_up, pansharpen.band_weights("WV02", 4))
+        expected = numpy.clip(numpy.rint(expected), 0, 255).astype(numpy.uint8)
+        self.assertTrue((expected == 255).any())
+
+        ds = gdal.Open(dstfp)
+        numpy.testing.assert_array_equal(ds.ReadAsArray(), expected)
+        for b in range(4):
+            band = ds.GetRasterBand(b + 1)
+            vals = expected[b][valid].astype(numpy.float64)
+            self.assertAlmostEqual(float(band.GetMetadataItem("STATISTICS_MEAN")), vals.mean(), places=4)
+            self.assertAlmostEqual(float(band.GetMetadataItem("STATISTICS_MINIMUM")), vals.min())
+            self.assertAlmostEqual(float(band.GetMetadataItem("STATISTICS_MAXIMUM")), vals.max())
+            self.assertAlmostEqual(float(band.GetMetadataItem("STATISTICS_STDDEV")), vals.std(), places=4)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "pansh_mul.vrt")))
@@ -0,0 +1,156 @@
+"""
+CPU and memory available to the current job.
+
+Batch scripts size GDAL threading and memory from what the scheduler or
+container actually grants rather than what the node has: SLURM allocation
+variables first, then cgroup (v2 or v1) CPU quota and memory limit, then the
+host totals.  warp_settings turns that into per-image gdalwarp settings for a
+given number of images running concurrently on the node.  Tasks started side
+by side in one allocation (pgc_run_batch.py --processes) are told how many
+siblings they have through SHARED_TASKS_ENV and divide the job between them.
+"""
+
+import os, logging
+import multiprocessing as mp
+
+logger = logging.getLogger("logger")
+
+#### Fraction of the job memory handed out to concurrent images; the rest is
+#### left for the process itself, the page cache and the output drivers
+MEMORY_FRACTION = 0.75
+#### Older GDALs treat -wm values of 10000 and above as bytes
+MAX_WARP_MEMORY_MB = 8192
+DEFAULT_MEMORY_MB = 4096
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+#### Number of tasks sharing this job's allocation, set by the batch runner
+SHARED_TASKS_ENV = "PGC_SHARED_TASKS"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _slurm_cpus(environ):
+    value = environ.get("SLURM_CPUS_PER_TASK")
+    if value:
+        return int(value)
+    #### e.g. "16", "16(x2)" or "16,8" -- the first entry is this node
+    value = environ.get("SLURM_JOB_CPUS_PER_NODE")
+    if value:
+        return int(value.split(",")[0].split("(")[0])
+    return None
+
+
+def _cgroup_cpus(root):
+    quota = _read(os.path.join(root, "cpu.max"))
+    if quota:
+        q, period = quota.split()[:2]
+        if q != "max":
+            return max(1, int(int(q) / int(period)))
+        return None
+    q = _read(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+    period = _read(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if q and period and int(q) > 0:
+        return max(1, int(int(q) / int(period)))
+    return None
+
+
+def _host_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return mp.cpu_count()
+
+
+def job_cpus(environ=None, cgroup_root=CGROUP_ROOT):
+    """Number of CPUs available to this job."""
+    environ = os.environ if environ is None else environ
+    cpus = _slurm_cpus(environ)
+    if cpus is None:
+        cpus = _cgroup_cpus(cgroup_root)
+    host = _host_cpus()
+    return min(cpus, host) if cpus else host
+
+
+def _slurm_memory_mb(environ, cpus):
+    value = environ.get("SLURM_MEM_PER_NODE")
+    if value:
+        return int(value)
+    value = environ.get("SLURM_MEM_PER_CPU")
+    if value:
+        return int(value) * cpus
+    return None
+
+
+def _cgroup_memory_mb(root):
+    for path in (os.path.join(root, "memory.max"),
+                 os.path.join(root, "memory", "memory.limit_in_bytes")):
+        value = _read(path)
+        if value and value != "max":
+            limit = int(value) // (1024 * 1024)
+            #### v1 reports "unlimited" as a huge page-aligned number
+            if limit < 2 ** 40:
+                return limit
+    return None
+
+
+def _host_memory_mb():
+    meminfo = _read("/proc/meminfo")
+    if meminfo:
+        for line in meminfo.splitlines():
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) // 1024
+    return None
+
+
+def job_memory_mb(environ=None, cgroup_root=CGROUP_ROOT, cpus=None):
+    """Memory available to this job in MB (the smallest known limit)."""
+    environ = os.environ if environ is None else environ
+    if cpus is None:
+        cpus = job_cpus(environ, cgroup_root)
+    limits = [m for m in (_slurm_memory_mb(environ, cpus),
+                          _cgroup_memory_mb(cgroup_root),
+                          _host_memory_mb()) if m]
+    return min(limits) if limits else DEFAULT_MEMORY_MB
+
+
+def shared_tasks(environ=None):
+    """Number of tasks sharing this job, from SHARED_TASKS_ENV (default 1)."""
+    environ = os.environ if environ is None else environ
+    try:
+        return max(1, int(environ.get(SHARED_TASKS_ENV) or 1))
+    except ValueError:
+        return 1
+
+
+def warp_settings(concurrent=1, threads=None, memory_mb=None, environ=None, cgroup_root=CGROUP_ROOT):
+    """
+    Returns (threads, warp_memory_mb, cachemax_mb) for one of `concurrent`
+    images in each of the shared_tasks() tasks sharing this job.  threads and
+    memory_mb override the detected per-image values.  The per-image memory
+    budget is split 2:1 between the warp buffer (-wm) and the GDAL block
+    cache.
+    """
+    concurrent = max(1, concurrent or 1) * shared_tasks(environ)
+    cpus = job_cpus(environ, cgroup_root)
+    if threads is None:
+        threads = max(1, cpus // concurrent)
+
+    if memory_mb is None:
+        budget = int(job_memory_mb(environ, cgroup_root, cpus) * MEMORY_FRACTION) // concurrent
+        wm = min(MAX_WARP_MEMORY_MB, budget * 2 // 3)
+    else:
+        budget = memory_mb * 3 // 2
+        wm = memory_mb
+    cachemax = max(64, budget - wm)
+    wm = max(64, wm)
+
+    logger.debug("Job resources: %i cpus, %i concurrent images -> %i warp threads, -wm %i MB, GDAL_CACHEMAX %i MB" %
+                 (cpus, concurrent, threads, wm, cachemax))
+    return threads, wm, cachemax
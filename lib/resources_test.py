@@ -0,0 +1,64 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import resources
+
+
+class Test_resources(TestCase):
+    def setUp(self):
+        self.cgroup = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cgroup)
+
+    def write(self, name, text):
+        path = os.path.join(self.cgroup, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(text)
+
+    def test_slurm_allocation(self):
+        """SLURM variables bound cpus and memory."""
+        env = {"SLURM_CPUS_PER_TASK": "1", "SLURM_MEM_PER_CPU": "1024"}
+        self.assertEqual(resources.job_cpus(env, self.cgroup), 1)
+        self.assertEqual(resources.job_memory_mb(env, self.cgroup), 1024)
+
+    def test_cgroup_v2_limits(self):
+        """cgroup v2 cpu.max and memory.max are honoured."""
+        self.write("cpu.max", "100000 100000\n")
+        self.write("memory.max", "%d\n" % (2048 * 1024 * 1024))
+        self.assertEqual(resources.job_cpus({}, self.cgroup), 1)
+        self.assertEqual(resources.job_memory_mb({}, self.cgroup), 2048)
+
+    def test_cgroup_v1_unlimited(self):
+        """an unlimited cgroup v1 memory limit is ignored."""
+        self.write("memory/memory.limit_in_bytes", "9223372036854771712\n")
+        self.assertEqual(resources._cgroup_memory_mb(self.cgroup), None)
+
+    def test_warp_settings_split_across_images(self):
+        """threads and memory are divided among concurrent images."""
+        env = {"SLURM_CPUS_PER_TASK": "1", "SLURM_MEM_PER_NODE": "1600"}
+        threads, wm, cachemax = resources.warp_settings(2, environ=env, cgroup_root=self.cgroup)
+        self.assertEqual(threads, 1)
+        self.assertEqual(wm, 400)
+        self.assertEqual(cachemax, 200)
+
+    def test_warp_settings_shared_tasks(self):
+        """tasks sharing a job divide it further."""
+        env = {"SLURM_CPUS_PER_TASK": "4", "SLURM_MEM_PER_NODE": "3200", resources.SHARED_TASKS_ENV: "2"}
+        cpus = resources.job_cpus(env, self.cgroup)
+        threads, wm, cachemax = resources.warp_settings(None, environ=env, cgroup_root=self.cgroup)
+        self.assertEqual(threads, max(1, cpus // 2))
+        self.assertEqual((wm, cachemax), (800, 400))
+        threads, wm, cachemax = resources.warp_settings(2, environ=env, cgroup_root=self.cgroup)
+        self.assertEqual(threads, max(1, cpus // 4))
+        self.assertEqual((wm, cachemax), (400, 200))
+
+    def test_warp_settings_overrides(self):
+        """user values replace the detected ones."""
+        threads, wm, cachemax = resources.warp_settings(1, threads=6, memory_mb=3000, environ={}, cgroup_root=self.cgroup)
+        self.assertEqual((threads, wm, cachemax), (6, 3000, 1500))
@@ -0,0 +1,186 @@
+"""
+SQLite run state for resumable campaigns.
+
+Without a state file, an output is considered done when it exists, so the
+partial output of a killed job counts as done.  With --run_state, each
+scene's stages are recorded as running, done or failed, together with the
+output path, size, mtime, a fingerprint and timings.  A stage only counts as
+done once its output has been written and copied to the destination, and
+the parallel scripts read the done scenes with one query instead of
+stat-ing every output on shared storage.
+
+Every change is its own transaction, so concurrent jobs can share one state
+file; writers wait up to TIMEOUT seconds for the lock.  SQLite relies on
+POSIX byte-range locks, which NFS and Lustre mounts without flock do not
+provide reliably, so a state file shared between nodes must be on a
+filesystem with working locks (a local disk only serves the jobs of one
+node).
+"""
+
+import os, time, socket, sqlite3, hashlib, logging, threading
+
+logger = logging.getLogger("logger")
+
+STAGES = ["discovered", "staged", "warped", "stretched", "pansharpened",
+          "calibrated", "classified", "mosaicked"]
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+TIMEOUT = 300
+#### Bytes hashed from each end of an output for its fingerprint
+FINGERPRINT_BYTES = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    scene TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT,
+    size INTEGER,
+    mtime REAL,
+    fingerprint TEXT,
+    started REAL,
+    finished REAL,
+    host TEXT,
+    message TEXT,
+    PRIMARY KEY (scene, stage)
+);
+CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status);
+"""
+
+_memo = {}
+
+
+def add_arguments(parser):
+    parser.add_argument("--run_state",
+                        help="SQLite file recording the stage status of every scene in this campaign; restarts skip "
+                        "stages recorded as done and redo stages that were interrupted.  Jobs on several nodes can only "
+                        "share it on a filesystem with working POSIX locks (not NFS, or Lustre without flock)")
+
+
+def get(path):
+    """
+    Returns the RunState for path, or None if path is None.  SQLite
+    connections cannot be shared, so there is one per process and thread.
+    """
+    if not path:
+        return None
+    key = (os.getpid(), threading.current_thread().ident, os.path.abspath(path))
+    state = _memo.get(key)
+    if state is None:
+        state = RunState(key[2])
+        _memo[key] = state
+    return state
+
+
+def scene_name(path):
+    """Scene key of an image or output path: the file name without extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def fingerprint(path):
+    """SHA-1 of the size and the first and last FINGERPRINT_BYTES of path."""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        h.update(f.read(FINGERPRINT_BYTES))
+        if size > 2 * FINGERPRINT_BYTES:
+            f.seek(-FINGERPRINT_BYTES, os.SEEK_END)
+            h.update(f.read(FINGERPRINT_BYTES))
+    return h.hexdigest()
+
+
+def is_done(state, scene, stage, output):
+    """
+    Whether stage is complete for scene: recorded as done with an unchanged
+    output if state is given, else if output exists.
+    """
+    if state is None:
+        return os.path.isfile(output)
+    return state.is_done(scene, stage, output)
+
+
+class RunState(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.host = socket.gethostname()
+        self.conn = sqlite3.connect(path, timeout=TIMEOUT)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _set(self, scene, stage, status, **values):
+        values.update(scene=scene, stage=stage, status=status, host=self.host)
+        keys = sorted(values)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages (%s) VALUES (%s)" % (", ".join(keys), ", ".join("?" * len(keys))),
+                [values[k] for k in keys]
+            )
+
+    def start(self, scene, stage):
+        self._set(scene, stage, RUNNING, started=time.time())
+
+    def finish(self, scene, stage, output=None, started=None):
+        """Records stage as done, with the size, mtime and fingerprint of output if given."""
+        values = dict(started=started, finished=time.time(), output=output)
+        if started is None:
+            row = self.conn.execute("SELECT started FROM stages WHERE scene = ? AND stage = ?", (scene, stage)).fetchone()
+            values["started"] = row[0] if row else None
+        if output is not None:
+            st = os.stat(output)
+            values.update(size=st.st_size, mtime=st.st_mtime, fingerprint=fingerprint(output))
+        self._set(scene, stage, DONE, **values)
+
+    def fail(self, scene, stage, message=None):
+        self._set(scene, stage, FAILED, finished=time.time(), message=message)
+
+    def discover(self, scenes):
+        """Records scenes as discovered, leaving existing records alone."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO stages (scene, stage, status, started, finished, host) VALUES (?, ?, ?, ?, ?, ?)",
+                [(scene, "discovered", DONE, now, now, self.host) for scene in scenes]
+            )
+
+    def status(self, scene, stage):
+        row = self.conn.execute("SELECT status FROM stages WHERE scene = ? AND stage = ?", (scene, stage)).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, scene, stage, output=None):
+        """
+        Done, and output (if given) still has the recorded size, mtime and
+        fingerprint.  The fingerprint catches a rewrite that kept the size
+        and mtime, such as a copy made with shutil.copy2.
+        """
+        row = self.conn.execute(
+            "SELECT status, size, mtime, fingerprint FROM stages WHERE scene = ? AND stage = ?", (scene, stage)
+        ).fetchone()
+        if row is None or row[0] != DONE:
+            return False
+        if output is None or row[1] is None:
+            return True
+        try:
+            st = os.stat(output)
+            if (st.st_size, st.st_mtime) != (row[1], row[2]):
+                return False
+            return row[3] is None or fingerprint(output) == row[3]
+        except (IOError, OSError):
+            return False
+
+    def completed(self, stage):
+        """Set of the scenes whose stage is done, from the state alone."""
+        return set(row[0] for row in self.conn.execute(
+            "SELECT scene FROM stages WHERE stage = ? AND status = ?", (stage, DONE)))
+
+    def summary(self):
+        """{stage: {status: count}}"""
+        counts = {}
+        for stage, status, n in self.conn.execute("SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status"):
+            counts.setdefault(stage, {})[status] = n
+        return counts
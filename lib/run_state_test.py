@@ -0,0 +1,56 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lib import run_state
+
+
+class Test_run_state(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = run_state.RunState(os.path.join(self.tmpdir, "campaign.db"))
+        self.output = os.path.join(self.tmpdir, "scene_u08rf3413.tif")
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_interrupted_stage_is_not_done(self):
+        """an output left by a running stage does not count as done."""
+        self.state.start("scene", "stretched")
+        open(self.output, "w").close()
+        self.assertEqual(self.state.status("scene", "stretched"), run_state.RUNNING)
+        self.assertFalse(self.state.is_done("scene", "stretched", self.output))
+        self.assertTrue(run_state.is_done(None, "scene", "stretched", self.output))
+
+    def test_finish_records_output(self):
+        """a finished stage is done until its output changes."""
+        with open(self.output, "w") as f:
+            f.write("x" * 10)
+        self.state.start("scene", "stretched")
+        self.state.finish("scene", "stretched", self.output)
+        self.assertTrue(self.state.is_done("scene", "stretched", self.output))
+        self.assertEqual(self.state.completed("stretched"), set(["scene"]))
+        with open(self.output, "a") as f:
+            f.write("truncated copy")
+        self.assertFalse(self.state.is_done("scene", "stretched", self.output))
+
+    def test_fingerprint_catches_same_size_rewrite(self):
+        """an output rewritten with the same size and mtime is not done."""
+        with open(self.output, "w") as f:
+            f.write("x" * 10)
+        os.utime(self.output, (1400000000, 1400000000))
+        self.state.finish("scene", "stretched", self.output)
+        with open(self.output, "w") as f:
+            f.write("y" * 10)
+        os.utime(self.output, (1400000000, 1400000000))
+        self.assertFalse(self.state.is_done("scene", "stretched", self.output))
+
+    def test_discover_keeps_existing(self):
+        """discovering scenes again leaves their records alone."""
+        self.state.discover(["a", "b"])
+        self.state.fail("a", "discovered", "gone")
+        self.state.discover(["a", "b", "c"])
+        self.assertEqual(self.state.summary()["discovered"], {run_state.DONE: 2, run_state.FAILED: 1})
@@ -0,0 +1,224 @@
+"""
+In-process task scheduler for parallel image processing on a single node.
+
+run() calls a function such as processImage directly in long-lived worker
+processes instead of spawning a fresh interpreter per image.  Tasks are
+dispatched largest-first so the big images do not end up at the tail of
+the run.  A task that fails (non-zero return or exception), runs past the
+timeout, or takes its worker down is retried up to the given number of
+times.  Its worker is replaced when it was killed.  Progress, throughput
+and an ETA are logged as tasks complete.  A task can lead to follow-up
+tasks, e.g. pansharpening a pair once both of its orthos are done; these
+run ahead of the remaining pending tasks.
+
+Each worker runs in its own process group so a timed-out task is killed
+together with any shell commands it started.
+"""
+
+import os, sys, time, signal, logging, traceback
+import multiprocessing as mp
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+logger = logging.getLogger("logger")
+
+#### Seconds between checks for timed-out or dead workers
+POLL = 1.0
+
+
+class Task(object):
+    """A unit of work: func(*args) is called in a worker."""
+
+    __slots__ = ("name", "args", "size", "attempts")
+
+    def __init__(self, name, args, size=0):
+        self.name = name
+        self.args = args
+        self.size = size
+        self.attempts = 0
+
+
+class _Worker(object):
+
+    def __init__(self, wid, func, initializer, initargs, result_q):
+        self.wid = wid
+        self.task_q = mp.Queue()
+        self.task = None
+        self.started = None
+        self.proc = mp.Process(target=_work, args=(wid, func, initializer, initargs, self.task_q, result_q))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def assign(self, i, task):
+        self.task = i
+        self.started = time.time()
+        self.task_q.put((i, task.args))
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        self.proc.join(5)
+        if self.proc.is_alive():
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.proc.join()
+
+
+def _work(wid, func, initializer, initargs, task_q, result_q):
+    os.setpgrp()
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        item = task_q.get()
+        if item is None:
+            break
+        i, args = item
+        try:
+            rc = func(*args)
+        except Exception:
+            logger.error("Task failed with an exception:\n%s" % traceback.format_exc())
+            rc = 1
+        result_q.put((wid, i, rc or 0))
+
+
+class Progress(object):
+    """Completed/failed counts, throughput and ETA over the task sizes."""
+
+    def __init__(self, tasks):
+        self.total = len(tasks)
+        self.total_bytes = sum([t.size for t in tasks])
+        self.done = 0
+        self.failed = 0
+        self.done_bytes = 0
+        self.starttime = time.time()
+
+    def update(self, task, rc):
+        if rc == 0:
+            self.done += 1
+        else:
+            self.failed += 1
+        self.done_bytes += task.size
+
+    def summary(self):
+        elapsed = max(time.time() - self.starttime, 0.001)
+        finished = self.done + self.failed
+        if self.done_bytes > 0:
+            eta = (self.total_bytes - self.done_bytes) * elapsed / self.done_bytes
+        elif finished > 0:
+            eta = (self.total - finished) * elapsed / finished
+        else:
+            eta = None
+        return "%i/%i images done, %i failed, %.1f images/hour, %.2f GB/hour, elapsed %s, ETA %s" % (
+            finished, self.total, self.failed, finished * 3600.0 / elapsed,
+            self.done_bytes / 1e9 * 3600.0 / elapsed, _hms(elapsed),
+            _hms(eta) if eta is not None else "unknown")
+
+
+def _hms(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def run(tasks, func, processes=1, timeout=None, retries=0, initializer=None, initargs=(), cleanup=None, then=None):
+    """
+    Runs func(*task.args) for every Task in up to processes workers and
+    returns {task name: rc}, rc 0 meaning success.  timeout is in seconds
+    per attempt.  cleanup(*task.args) is called in the parent after a
+    failed attempt, e.g. to remove partial outputs before a retry.
+    initializer(*initargs) runs once in each worker.  then(task, rc) is
+    called in the parent once a task has finished for good and returns the
+    Tasks to run next, if any.
+    """
+    tasks = sorted(tasks, key=lambda t: t.size, reverse=True)
+    pending = list(range(len(tasks)))
+    results = {}
+    progress = Progress(tasks)
+    result_q = mp.Queue()
+    workers = {}
+    next_wid = [0]
+
+    def spawn():
+        wid = next_wid[0]
+        next_wid[0] += 1
+        workers[wid] = _Worker(wid, func, initializer, initargs, result_q)
+
+    def finish(i, rc, reason=None):
+        task = tasks[i]
+        task.attempts += 1
+        if rc != 0:
+            if reason:
+                logger.error("%s: %s" % (task.name, reason))
+            if cleanup is not None:
+                try:
+                    cleanup(*task.args)
+                except Exception as e:
+                    logger.error("Cleanup failed for %s: %s" % (task.name, e))
+            if task.attempts <= retries:
+                logger.info("Retrying %s (attempt %i of %i)" % (task.name, task.attempts + 1, retries + 1))
+                pending.append(i)
+                return
+        results[task.name] = rc
+        progress.update(task, rc)
+        logger.info(progress.summary())
+        if then is not None:
+            for n, follow in enumerate(then(task, rc) or []):
+                tasks.append(follow)
+                pending.insert(n, len(tasks) - 1)
+                progress.total += 1
+                progress.total_bytes += follow.size
+
+    for n in range(min(processes, len(tasks))):
+        spawn()
+
+    try:
+        while pending or [w for w in workers.values() if w.task is not None]:
+            #### Hand the largest pending tasks to idle workers
+            for w in workers.values():
+                if w.task is None and pending:
+                    i = pending.pop(0)
+                    logger.info("Running job: %s" % tasks[i].name)
+                    w.assign(i, tasks[i])
+
+            try:
+                wid, i, rc = result_q.get(timeout=POLL)
+            except Empty:
+                pass
+            else:
+                w = workers.get(wid)
+                if w is not None and w.task == i:
+                    w.task = None
+                    finish(i, rc, "failed" if rc != 0 else None)
+
+            #### Replace workers that timed out or died
+            now = time.time()
+            for wid, w in list(workers.items()):
+                if w.task is None:
+                    continue
+                reason = None
+                if timeout and now - w.started > timeout:
+                    reason = "timed out after %s" % _hms(now - w.started)
+                elif not w.proc.is_alive():
+                    reason = "worker exited with code %s" % w.proc.exitcode
+                if reason:
+                    i = w.task
+                    w.kill()
+                    del workers[wid]
+                    finish(i, 1, reason)
+                    spawn()
+    except KeyboardInterrupt:
+        for w in workers.values():
+            w.kill()
+        raise
+
+    for w in workers.values():
+        w.task_q.put(None)
+    for w in workers.values():
+        w.proc.join()
+    return results
@@ -0,0 +1,74 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+
+from lib import scheduler
+
+
+def record(logdir, name, rc=0, sleep=0):
+    with open(os.path.join(logdir, "order"), "a") as f:
+        f.write(name + "\n")
+    time.sleep(sleep)
+    return rc
+
+
+def fail_once(logdir, name):
+    marker = os.path.join(logdir, name)
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        return 1
+    return 0
+
+
+def then_after(logdir, name):
+    def then(task, rc):
+        if task.name == name:
+            return [scheduler.Task(name + "2", (logdir, name + "2"))]
+    return then
+
+
+class Test_scheduler(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        scheduler.POLL = 0.1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def order(self):
+        with open(os.path.join(self.tmpdir, "order")) as f:
+            return f.read().split()
+
+    def test_largest_first(self):
+        """tasks are dispatched in decreasing size."""
+        tasks = [scheduler.Task(n, (self.tmpdir, n), size) for n, size in (("a", 1), ("b", 30), ("c", 20))]
+        results = scheduler.run(tasks, record, processes=1)
+        self.assertEqual(self.order(), ["b", "c", "a"])
+        self.assertEqual(results, {"a": 0, "b": 0, "c": 0})
+
+    def test_follow_up_runs_next(self):
+        """follow-up tasks run ahead of the pending ones."""
+        tasks = [scheduler.Task(n, (self.tmpdir, n), size) for n, size in (("a", 2), ("b", 1))]
+        results = scheduler.run(tasks, record, processes=1, then=then_after(self.tmpdir, "a"))
+        self.assertEqual(self.order(), ["a", "a2", "b"])
+        self.assertEqual(results, {"a": 0, "a2": 0, "b": 0})
+
+    def test_retry_after_failure(self):
+        """a failed task is cleaned up and run again."""
+        cleaned = []
+        tasks = [scheduler.Task("a", (self.tmpdir, "a"))]
+        results = scheduler.run(tasks, fail_once, retries=1, cleanup=lambda *args: cleaned.append(args))
+        self.assertEqual(results, {"a": 0})
+        self.assertEqual(cleaned, [(self.tmpdir, "a")])
+
+    def test_timeout_replaces_worker(self):
+        """a task past its timeout fails and later tasks still run."""
+        tasks = [scheduler.Task("slow", (self.tmpdir, "slow", 0, 30), 2),
+                 scheduler.Task("fast", (self.tmpdir, "fast"), 1)]
+        start = time.time()
+        results = scheduler.run(tasks, record, processes=1, timeout=0.5)
+        self.assertEqual(results, {"slow": 1, "fast": 0})
+        self.assertTrue(time.time() - start < 10)
@@ -0,0 +1,81 @@
+"""
+In-memory bounding-box index for footprint/tile intersection.
+
+STRtree packs the bounding boxes of a fixed set of geometries into an R-tree
+with the Sort-Tile-Recursive algorithm: boxes are sorted by x center, cut into
+vertical slices, sorted by y center within each slice and grouped into nodes
+of `capacity` entries, level by level up to the root.  query() walks only the
+nodes whose boxes overlap the search box, so finding the candidates for one
+tile costs O(log n + hits) instead of a test against every image.  Callers
+run the exact geometry test on the candidates only.
+
+Boxes are (minx, maxx, miny, maxy), the order of OGR's GetEnvelope().
+"""
+
+import math
+
+CAPACITY = 16
+
+
+def overlaps(a, b):
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+
+def union(boxes):
+    return (min([b[0] for b in boxes]), max([b[1] for b in boxes]),
+            min([b[2] for b in boxes]), max([b[3] for b in boxes]))
+
+
+class STRtree(object):
+    """
+    R-tree over items, a sequence of (box, value) pairs.  query() returns the
+    values whose boxes overlap a box, in the order they were given.
+    """
+
+    def __init__(self, items, capacity=CAPACITY):
+        self.capacity = max(2, capacity)
+        #### entries are (box, children or None, (order, value) for leaves)
+        entries = [(tuple(box), None, (i, value)) for i, (box, value) in enumerate(items) if box is not None]
+        self.size = len(entries)
+        self.root = None
+        level = entries
+        while level:
+            level = self._pack(level)
+            if len(level) == 1:
+                self.root = level[0]
+                break
+
+    def __len__(self):
+        return self.size
+
+    def _pack(self, entries):
+        """Groups entries into parent nodes of at most capacity children."""
+        n = len(entries)
+        nodes = int(math.ceil(n / float(self.capacity)))
+        slices = int(math.ceil(math.sqrt(nodes)))
+        per_slice = slices * self.capacity
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][1])
+        parents = []
+        for s in range(0, n, per_slice):
+            column = sorted(entries[s:s + per_slice], key=lambda e: e[0][2] + e[0][3])
+            for c in range(0, len(column), self.capacity):
+                children = column[c:c + self.capacity]
+                parents.append((union([e[0] for e in children]), children, None))
+        return parents
+
+    def query(self, box):
+        """Values of the items whose boxes overlap box, in insertion order."""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_box, children, leaf = stack.pop()
+            if not overlaps(node_box, box):
+                continue
+            if children is None:
+                found.append(leaf)
+            else:
+                stack.extend(children)
+        found.sort(key=lambda leaf: leaf[0])
+        return [value for order, value in found]
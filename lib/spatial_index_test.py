@@ -0,0 +1,30 @@
+# std modules:
+from unittest import TestCase
+import random
+
+from lib import spatial_index
+
+
+class Test_spatial_index(TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.items = []
+        for i in range(500):
+            x, y = rng.uniform(0, 1000), rng.uniform(0, 1000)
+            self.items.append(((x, x + rng.uniform(1, 50), y, y + rng.uniform(1, 50)), i))
+        self.tree = spatial_index.STRtree(self.items, capacity=8)
+
+    def brute(self, box):
+        return [v for b, v in self.items if spatial_index.overlaps(b, box)]
+
+    def test_query_matches_brute_force(self):
+        """the tree returns exactly the overlapping boxes, in insertion order."""
+        for box in [(0, 100, 0, 100), (450, 460, 300, 900), (-10, -5, 0, 10), (0, 2000, 0, 2000)]:
+            self.assertEqual(self.tree.query(box), self.brute(box))
+
+    def test_small_and_empty(self):
+        """a single item or no items still answer queries."""
+        tree = spatial_index.STRtree([((0, 1, 0, 1), "a"), (None, "no geometry")])
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(tree.query((0.5, 2, 0.5, 2)), ["a"])
+        self.assertEqual(spatial_index.STRtree([]).query((0, 1, 0, 1)), [])
@@ -0,0 +1,351 @@
+"""
+Source staging for ortho jobs.
+
+processImage needs the source image and its sibling files (<image>.*: xml,
+rpb, til, ...) next to the working files in wd.  Rather than always copying
+them, stage() links or references them when that is as good as a copy:
+
+  inplace   read the source where it is (wd is the source directory)
+  hardlink  same filesystem: a second name for the same inode, no bytes moved
+  symlink   different filesystem that is not faster than the source
+  copy      wd is node-local scratch and the source is on a network filesystem
+
+The bytes a copy would have moved but were not are reported per image and
+totalled per process (see totals()).
+
+StagingManager drives stage() for a sequence of images: it stages the next
+images in a background thread while the current one processes, removes each
+image's staged files once it is done, copies outputs back to the destination
+in another thread, and holds prefetching back while free space in wd is
+under the reserve.  Queuing a copy waits while lookahead copies are already
+queued, or while free space is under the reserve and earlier copies are
+still to free it, so outputs cannot fill scratch when the destination is
+slower than processing.
+"""
+
+import os, glob, time, shutil, logging, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger("logger")
+
+MODES = ["auto", "copy", "hardlink", "symlink", "inplace"]
+
+#### Filesystem types treated as shared/network storage
+NETWORK_FS = ("lustre", "nfs", "nfs4", "gpfs", "cifs", "smbfs", "beegfs", "panfs", "ceph", "fuse.sshfs", "glusterfs")
+
+_totals = {"images": 0, "copied": 0, "saved": 0}
+
+#### Seconds between capacity checks while prefetching is held back
+POLL = 1.0
+
+
+def fs_type(path, mounts="/proc/mounts"):
+    """Filesystem type of the mount containing path, or None if unknown."""
+    path = os.path.realpath(path)
+    best = None
+    try:
+        with open(mounts) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace("\\040", " ")
+                if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and (best is None or len(mnt) > len(best[0])):
+                    best = (mnt, fields[2])
+    except (IOError, OSError):
+        return None
+    return best[1] if best else None
+
+
+def is_network(path):
+    t = fs_type(path)
+    return t is not None and (t in NETWORK_FS or t.startswith("nfs"))
+
+
+def same_filesystem(a, b):
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def choose_mode(srcdir, wd):
+    """Staging mode used by "auto" for sources in srcdir and working dir wd."""
+    if os.path.realpath(srcdir) == os.path.realpath(wd):
+        return "inplace"
+    if same_filesystem(srcdir, wd):
+        return "hardlink"
+    if is_network(srcdir) and not is_network(wd):
+        return "copy"
+    return "symlink"
+
+
+def stage(srcfp, wd, mode="auto"):
+    """
+    Makes srcfp and its sibling files available in wd.  Returns
+    (mode, localsrc) where localsrc is the path processing should read;
+    for "inplace" that is srcfp itself, which must never be deleted as a
+    temp file.  Falls back hardlink -> symlink -> copy on failure.
+    """
+    srcdir = os.path.dirname(os.path.abspath(srcfp))
+    if mode == "auto":
+        mode = choose_mode(srcdir, wd)
+
+    files = glob.glob("%s.*" % os.path.splitext(srcfp)[0])
+    nbytes = sum([os.path.getsize(fp) for fp in files])
+
+    if mode == "inplace":
+        copied = 0
+        localsrc = srcfp
+    else:
+        copied = 0
+        for fpi in files:
+            fpo = os.path.join(wd, os.path.basename(fpi))
+            if os.path.lexists(fpo):
+                continue
+            used = _stage_file(fpi, fpo, mode)
+            if used == "copy":
+                copied += os.path.getsize(fpi)
+        localsrc = os.path.join(wd, os.path.basename(srcfp))
+
+    saved = nbytes - copied
+    _totals["images"] += 1
+    _totals["copied"] += copied
+    _totals["saved"] += saved
+    logger.info("Staged %i files by %s: %.1f MB copied, %.1f MB saved" %
+                (len(files), mode, copied / 1048576.0, saved / 1048576.0))
+    return mode, localsrc
+
+
+def _stage_file(fpi, fpo, mode):
+    if mode == "hardlink":
+        try:
+            os.link(fpi, fpo)
+            return mode
+        except (OSError, AttributeError) as e:
+            logger.debug("Cannot hardlink %s, trying symlink: %s" % (fpi, e))
+            mode = "symlink"
+    if mode == "symlink":
+        try:
+            os.symlink(os.path.abspath(fpi), fpo)
+            return mode
+        except (OSError, AttributeError) as e:
+            logger.debug("Cannot symlink %s, copying: %s" % (fpi, e))
+    shutil.copy(fpi, fpo)
+    return "copy"
+
+
+def totals():
+    """(images, bytes copied, bytes saved) staged by this process."""
+    return _totals["images"], _totals["copied"], _totals["saved"]
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class StagingManager(object):
+    """
+    Stages images into wd ahead of use.  schedule() lists the upcoming
+    images in processing order; up to lookahead of them are staged in the
+    background.  acquire() returns stage()'s (mode, localsrc) for the
+    current image, staging it now if it was not prefetched, and release()
+    removes its staged files.  copy_back() queues outputs to be copied to
+    the destination.  Prefetching waits while wd has less than reserve_mb
+    free after the image's copy; the current image is always staged.
+    copy_back() waits while lookahead copies are queued or wd has less than
+    reserve_mb free with copies queued.
+    """
+
+    def __init__(self, wd, mode="auto", lookahead=1, reserve_mb=2048):
+        self.wd = wd
+        self.mode = mode
+        self.lookahead = lookahead
+        self.reserve = reserve_mb * 1048576
+        self.cond = threading.Condition()
+        self.pending = []
+        self.staged = {}
+        self.staging = None
+        self.current = None
+        self.closed = False
+        self.failed = []
+        self.copies = queue.Queue()
+        self.queued = 0
+        self.prefetcher = threading.Thread(target=self._prefetch, name="prefetch")
+        self.copier = threading.Thread(target=self._copy, name="copy_back")
+        for t in (self.prefetcher, self.copier):
+            t.daemon = True
+            t.start()
+
+    def schedule(self, srcfps):
+        with self.cond:
+            self.pending.extend(srcfps)
+            self.cond.notify_all()
+
+    def needed(self, srcfp):
+        """Bytes staging srcfp takes in wd: only copies use space."""
+        mode = self.mode
+        if mode == "auto":
+            mode = choose_mode(os.path.dirname(os.path.abspath(srcfp)), self.wd)
+        if mode != "copy":
+            return 0
+        return sum([os.path.getsize(fp) for fp in glob.glob("%s.*" % os.path.splitext(srcfp)[0])])
+
+    def _next(self):
+        for srcfp in self.pending[:self.lookahead]:
+            if srcfp not in self.staged:
+                return srcfp
+        return None
+
+    def _prefetch(self):
+        held = None
+        while True:
+            with self.cond:
+                while not self.closed and self._next() is None:
+                    self.cond.wait(POLL)
+                if self.closed:
+                    return
+                srcfp = self._next()
+                self.staging = srcfp
+
+            try:
+                room = free_bytes(self.wd) - self.needed(srcfp) >= self.reserve
+            except OSError:
+                room = True
+            if not room:
+                if held != srcfp:
+                    logger.info("Scratch space in %s is under the reserve, holding prefetch of %s" % (self.wd, os.path.basename(srcfp)))
+                    held = srcfp
+                with self.cond:
+                    self.staging = None
+                    self.cond.notify_all()
+                    self.cond.wait(POLL)
+                continue
+
+            try:
+                result = stage(srcfp, self.wd, self.mode)
+            except Exception as e:
+                logger.warning("Cannot prefetch %s: %s" % (srcfp, e))
+                result = None
+            with self.cond:
+                self.staging = None
+                if result is not None and (srcfp in self.pending or srcfp == self.current):
+                    self.staged[srcfp] = result
+                elif result is not None:
+                    self._remove(result)
+                else:
+                    #### let acquire stage it and report the error
+                    self.pending.remove(srcfp)
+                self.cond.notify_all()
+
+    def acquire(self, srcfp):
+        with self.cond:
+            if srcfp in self.pending:
+                self.pending.remove(srcfp)
+            self.current = srcfp
+            while self.staging == srcfp:
+                self.cond.wait(POLL)
+            result = self.staged.get(srcfp)
+        if result is None:
+            result = stage(srcfp, self.wd, self.mode)
+            with self.cond:
+                self.staged[srcfp] = result
+        else:
+            logger.info("Using prefetched image: %s" % result[1])
+        return result
+
+    def _remove(self, result):
+        mode, localsrc = result
+        if mode != "inplace":
+            for fp in glob.glob("%s.*" % os.path.splitext(localsrc)[0]):
+                try:
+                    os.remove(fp)
+                except OSError:
+                    pass
+
+    def release(self, srcfp, delete=True):
+        """
+        Done with srcfp, whether or not it was acquired: it leaves the
+        schedule and its staged files are removed if delete.  Releasing
+        twice is harmless.
+        """
+        with self.cond:
+            if srcfp in self.pending:
+                self.pending.remove(srcfp)
+            if srcfp == self.current:
+                self.current = None
+            result = self.staged.pop(srcfp, None)
+            if result is not None and delete:
+                self._remove(result)
+            self.cond.notify_all()
+
+    def _room(self):
+        try:
+            return free_bytes(self.wd) >= self.reserve
+        except OSError:
+            return True
+
+    def copy_back(self, files, dstdir, callback=None, key=None):
+        """
+        Copies files to dstdir in the background, each under a temporary
+        name renamed into place when complete, skipping files that exist.
+        callback(ok) runs in the copy thread once all are copied.  If the
+        copy fails, key (default: the files) is reported by close().
+        Blocks while the queue is full or scratch is short of the reserve.
+        """
+        held = False
+        with self.cond:
+            while self.queued > 0 and (self.queued >= max(1, self.lookahead) or not self._room()):
+                if not held:
+                    logger.info("Waiting for %i queued copies to %s" % (self.queued, dstdir))
+                    held = True
+                self.cond.wait(POLL)
+            self.queued += 1
+        self.copies.put((list(files), dstdir, callback, key))
+
+    def _copy(self):
+        while True:
+            job = self.copies.get()
+            if job is None:
+                self.copies.task_done()
+                return
+            files, dstdir, callback, key = job
+            ok = True
+            try:
+                for fpi in files:
+                    fpo = os.path.join(dstdir, os.path.basename(fpi))
+                    if os.path.isfile(fpo):
+                        continue
+                    shutil.copy(fpi, fpo + ".part")
+                    os.rename(fpo + ".part", fpo)
+            except (IOError, OSError) as e:
+                logger.error("Cannot copy outputs to %s: %s" % (dstdir, e))
+                self.failed.extend([key] if key is not None else files)
+                ok = False
+            try:
+                if callback is not None:
+                    callback(ok)
+            except Exception as e:
+                logger.error("Copy-back callback failed: %s" % e)
+            finally:
+                self.copies.task_done()
+                with self.cond:
+                    self.queued -= 1
+                    self.cond.notify_all()
+
+    def close(self):
+        """
+        Waits for the queued copies, stops prefetching and removes images
+        prefetched but never used.  Returns the keys of the copies that
+        failed.
+        """
+        self.copies.put(None)
+        self.copier.join()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.prefetcher.join()
+        for srcfp in list(self.staged):
+            self.release(srcfp)
+        return self.failed
@@ -0,0 +1,163 @@
+# std modules:
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from lib import staging
+
+
+class Test_staging(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, "src")
+        self.wd = os.path.join(self.tmpdir, "wd")
+        os.makedirs(self.srcdir)
+        os.makedirs(self.wd)
+        self.srcfp = os.path.join(self.srcdir, "scene.ntf")
+        for ext, size in ((".ntf", 1000), (".xml", 10)):
+            with open(os.path.join(self.srcdir, "scene" + ext), "w") as f:
+                f.write("x" * size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_auto_same_dir_is_inplace(self):
+        """a source in the working dir is read where it is."""
+        mode, localsrc = staging.stage(self.srcfp, self.srcdir)
+        self.assertEqual((mode, localsrc), ("inplace", self.srcfp))
+
+    def test_auto_same_filesystem_hardlinks(self):
+        """same-filesystem staging links every sibling without copying."""
+        copied = staging.totals()[1]
+        mode, localsrc = staging.stage(self.srcfp, self.wd)
+        self.assertEqual(mode, "hardlink")
+        self.assertEqual(localsrc, os.path.join(self.wd, "scene.ntf"))
+        self.assertEqual(sorted(os.listdir(self.wd)), ["scene.ntf", "scene.xml"])
+        self.assertTrue(os.path.samefile(localsrc, self.srcfp))
+        self.assertEqual(staging.totals()[1], copied)
+
+    def test_copy_counts_bytes(self):
+        """copy mode reports the bytes it moved."""
+        copied = staging.totals()[1]
+        staging.stage(self.srcfp, self.wd, "copy")
+        self.assertFalse(os.path.islink(os.path.join(self.wd, "scene.ntf")))
+        self.assertEqual(staging.totals()[1] - copied, 1010)
+
+    def test_fs_type_longest_mount(self):
+        """the innermost mount decides the filesystem type."""
+        mounts = os.path.join(self.tmpdir, "mounts")
+        with open(mounts, "w") as f:
+            f.write("/dev/sda1 / ext4 rw 0 0\n")
+            f.write("server:/lus %s lustre rw 0 0\n" % os.path.realpath(self.srcdir))
+        self.assertEqual(staging.fs_type(self.srcfp, mounts), "lustre")
+        self.assertEqual(staging.fs_type(self.wd, mounts), "ext4")
+
+
+class Test_StagingManager(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, "src")
+        self.wd = os.path.join(self.tmpdir, "wd")
+        self.dstdir = os.path.join(self.tmpdir, "dst")
+        for d in (self.srcdir, self.wd, self.dstdir):
+            os.makedirs(d)
+        self.srcfps = []
+        for name in ("a", "b", "c"):
+            for ext in (".ntf", ".xml"):
+                with open(os.path.join(self.srcdir, name + ext), "w") as f:
+                    f.write("x" * 100)
+            self.srcfps.append(os.path.join(self.srcdir, name + ".ntf"))
+        staging.POLL = 0.05
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, path):
+        for i in range(100):
+            if os.path.exists(path):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_prefetch_and_release(self):
+        """the next image is staged while the current one is in use, and removed after."""
+        manager = staging.StagingManager(self.wd, "copy", lookahead=1, reserve_mb=0)
+        manager.schedule(self.srcfps)
+        mode, localsrc = manager.acquire(self.srcfps[0])
+        self.assertEqual(localsrc, os.path.join(self.wd, "a.ntf"))
+        self.assertTrue(self.wait_for(os.path.join(self.wd, "b.ntf")))
+        manager.release(self.srcfps[0])
+        self.assertFalse(os.path.exists(localsrc))
+        self.assertFalse(os.path.exists(os.path.join(self.wd, "c.ntf")))
+        manager.close()
+        self.assertEqual(os.listdir(self.wd), [])
+
+    def test_release_without_acquire(self):
+        """an image skipped before it is acquired leaves the schedule and scratch."""
+        manager = staging.StagingManager(self.wd, "copy", lookahead=1, reserve_mb=0)
+        manager.schedule(self.srcfps)
+        self.assertTrue(self.wait_for(os.path.join(self.wd, "a.ntf")))
+        manager.release(self.srcfps[0])
+        self.assertFalse(os.path.exists(os.path.join(self.wd, "a.ntf")))
+        manager.acquire(self.srcfps[1])
+        self.assertTrue(self.wait_for(os.path.join(self.wd, "c.ntf")))
+        self.assertFalse(os.path.exists(os.path.join(self.wd, "a.ntf")))
+        manager.release(self.srcfps[1])
+        manager.release(self.srcfps[2])
+        manager.close()
+        self.assertEqual(os.listdir(self.wd), [])
+
+    def test_reserve_holds_prefetch(self):
+        """with no room under the reserve only the current image is staged."""
+        manager = staging.StagingManager(self.wd, "copy", lookahead=2, reserve_mb=1 << 40)
+        manager.schedule(self.srcfps)
+        manager.acquire(self.srcfps[0])
+        time.sleep(0.3)
+        self.assertEqual(sorted(os.listdir(self.wd)), ["a.ntf", "a.xml"])
+        manager.close()
+
+    def test_copy_back(self):
+        """outputs are copied in the background and the callback runs after."""
+        manager = staging.StagingManager(self.wd, "copy")
+        out = os.path.join(self.wd, "a_u08rf3413.tif")
+        with open(out, "w") as f:
+            f.write("out")
+        done = []
+        manager.copy_back([out], self.dstdir, done.append)
+        self.assertEqual(manager.close(), [])
+        self.assertEqual(done, [True])
+        self.assertEqual(os.listdir(self.dstdir), ["a_u08rf3413.tif"])
+
+    def test_copy_back_waits_for_queue(self):
+        """a copy is only queued once fewer than lookahead are pending."""
+        manager = staging.StagingManager(self.wd, "copy", lookahead=1, reserve_mb=0)
+        outs = []
+        for name in ("a", "b"):
+            outs.append(os.path.join(self.wd, name + "_u08rf3413.tif"))
+            with open(outs[-1], "w") as f:
+                f.write("out")
+        release = threading.Event()
+        manager.copy_back([outs[0]], self.dstdir, lambda ok: release.wait(10))
+        second = threading.Thread(target=manager.copy_back, args=([outs[1]], self.dstdir))
+        second.start()
+        time.sleep(0.3)
+        self.assertTrue(second.is_alive())
+        release.set()
+        second.join(5)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(manager.close(), [])
+        self.assertEqual(sorted(os.listdir(self.dstdir)), ["a_u08rf3413.tif", "b_u08rf3413.tif"])
+
+    def test_copy_back_failure_reports_key(self):
+        """a failed copy is reported under its key, e.g. the source image."""
+        manager = staging.StagingManager(self.wd, "copy")
+        out = os.path.join(self.wd, "a_u08rf3413.tif")
+        with open(out, "w") as f:
+            f.write("out")
+        done = []
+        manager.copy_back([out], os.path.join(self.tmpdir, "missing"), done.append, self.srcfps[0])
+        self.assertEqual(manager.close(), [self.srcfps[0]])
+        self.assertEqual(done, [False])
@@ -0,0 +1,160 @@
+"""
+SLURM job-array submission for the *_parallel scripts.
+
+Instead of one scheduler job per image or tile, submit_array writes the
+task command lines to a manifest and submits a single sbatch --array job.
+Each array element runs pgc_run_batch.py, which executes its batch of
+manifest lines one after another or --slurm_batch_processes at a time.
+Commands run side by side get resources.SHARED_TASKS_ENV in their
+environment so each sizes its GDAL threads and memory for its share of the
+element's allocation.
+Manifest, batch script and per-element logs are written to one directory.
+"""
+
+import os, sys, math, time, shlex, logging, subprocess
+import multiprocessing as mp
+
+from lib import resources
+
+logger = logging.getLogger("logger")
+
+SLURM = "SLURM"
+
+#### Options consumed by the submitting script, never passed to child jobs
+ARG_KEYS = ("slurm_batch_size", "slurm_batch_processes", "slurm_options", "slurm_max_running")
+
+RUNNER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pgc_duplication", "pgc_run_batch.py")
+
+
+def add_arguments(parser):
+    parser.add_argument("--slurm_batch_size", type=int, default=10,
+                        help="tasks run by each SLURM array element (default 10)")
+    parser.add_argument("--slurm_batch_processes", type=int, default=1,
+                        help="tasks each SLURM array element runs at the same time (default 1, sequential)")
+    parser.add_argument("--slurm_max_running", type=int,
+                        help="maximum number of array elements running at once (sbatch --array %%N)")
+    parser.add_argument("--slurm_options",
+                        help="extra sbatch options, quoted, e.g. \"--time=4:00:00 --mem=20G\"")
+
+
+def _which(prog):
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        fp = os.path.join(d, prog)
+        if os.path.isfile(fp) and os.access(fp, os.X_OK):
+            return fp
+    return None
+
+
+def slurm_available():
+    return _which("sbatch") is not None
+
+
+def batches(ntasks, batch_size):
+    """Number of array elements needed for ntasks."""
+    return int(math.ceil(ntasks / float(max(batch_size, 1))))
+
+
+def write_manifest(path, commands):
+    f = open(path, "w")
+    try:
+        for cmd in commands:
+            f.write(cmd.replace("\n", " ") + "\n")
+    finally:
+        f.close()
+
+
+def read_batch(path, index, batch_size):
+    """Command lines of array element index."""
+    f = open(path)
+    try:
+        lines = [line.rstrip("\n") for line in f if line.strip()]
+    finally:
+        f.close()
+    return lines[index * batch_size:(index + 1) * batch_size]
+
+
+def batch_script(job_name, manifest, n, args):
+    logpattern = os.path.splitext(manifest)[0] + "_%A_%a.out"
+    array = "0-%d" % (n - 1)
+    if args.slurm_max_running:
+        array += "%%%d" % args.slurm_max_running
+    lines = [
+        "#!/bin/bash",
+        "#SBATCH --job-name=%s" % job_name,
+        "#SBATCH --array=%s" % array,
+        "#SBATCH --output=%s" % logpattern,
+        "#SBATCH --nodes=1",
+    ]
+    if args.slurm_batch_processes > 1:
+        lines.append("#SBATCH --cpus-per-task=%d" % args.slurm_batch_processes)
+    lines.append("")
+    lines.append('%s "%s" --batch_size %d --processes %d "%s" $SLURM_ARRAY_TASK_ID' % (
+        sys.executable or "python", RUNNER, args.slurm_batch_size, args.slurm_batch_processes, manifest))
+    return "\n".join(lines) + "\n"
+
+
+def submit_array(task_queue, job_name, outdir, args, dryrun=False):
+    """
+    Submits the (job_name, cmd) pairs of task_queue as one SLURM array job.
+    The manifest, batch script and logs go to outdir.  Returns the job id,
+    or None on failure or dry run.
+    """
+    commands = [cmd for name, cmd in task_queue if cmd]
+    if not commands:
+        logger.info("No tasks to submit")
+        return None
+
+    stamp = time.strftime("%Y%m%d%H%M%S")
+    manifest = os.path.join(outdir, "%s_%s.tasks" % (job_name, stamp))
+    script = os.path.splitext(manifest)[0] + ".sbatch"
+    n = batches(len(commands), args.slurm_batch_size)
+
+    write_manifest(manifest, commands)
+    f = open(script, "w")
+    f.write(batch_script(job_name, manifest, n, args))
+    f.close()
+    logger.info("Wrote %i tasks in %i array elements to %s" % (len(commands), n, manifest))
+
+    cmd = ["sbatch", "--parsable"] + shlex.split(args.slurm_options or "") + [script]
+    logger.info(" ".join(cmd))
+    if dryrun:
+        return None
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    so, se = p.communicate()
+    if p.returncode != 0:
+        logger.error("sbatch failed: %s" % se.decode("utf-8").strip())
+        return None
+    jobid = so.decode("utf-8").strip().split(";")[0]
+    logger.info("Submitted array job %s" % jobid)
+    return jobid
+
+
+def _run(cmd, env=None):
+    logger.info("Running: %s" % cmd)
+    rc = subprocess.call(cmd, shell=True, env=env)
+    if rc != 0:
+        logger.error("Return code %s: %s" % (rc, cmd))
+    return rc
+
+
+def _run_job(job):
+    return _run(*job)
+
+
+def run_batch(manifest, index, batch_size, processes=1):
+    """Runs the commands of array element index, returns the number that failed."""
+    commands = read_batch(manifest, index, batch_size)
+    logger.info("Array element %i: %i tasks" % (index, len(commands)))
+    if processes > 1 and len(commands) > 1:
+        n = min(processes, len(commands))
+        env = dict(os.environ)
+        env[resources.SHARED_TASKS_ENV] = str(n)
+        pool = mp.Pool(n)
+        try:
+            rcs = pool.map(_run_job, [(cmd, env) for cmd in commands], 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rcs = [_run(cmd) for cmd in commands]
+    return len([rc for rc in rcs if rc != 0])
@@ -0,0 +1,60 @@
+# std modules:
+from unittest import TestCase
+import argparse
+import os
+import shutil
+import tempfile
+
+from lib import resources
+from lib import submission
+
+
+class Test_submission(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        parser = argparse.ArgumentParser()
+        submission.add_arguments(parser)
+        self.args = parser.parse_args(["--slurm_batch_size", "2", "--slurm_max_running", "5"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_batches_split_manifest(self):
+        """each array element gets its own slice of the manifest."""
+        manifest = os.path.join(self.tmpdir, "tasks")
+        submission.write_manifest(manifest, ["echo %d" % i for i in range(5)])
+        self.assertEqual(submission.batches(5, 2), 3)
+        self.assertEqual(submission.read_batch(manifest, 2, 2), ["echo 4"])
+
+    def test_batch_script_array(self):
+        """the array covers every batch and honours the running limit."""
+        script = submission.batch_script("Ortho", "/x/Ortho.tasks", 3, self.args)
+        self.assertIn("#SBATCH --array=0-2%5", script)
+        self.assertIn("--batch_size 2 --processes 1", script)
+
+    def test_run_batch_counts_failures(self):
+        """failed commands are counted, in sequence or in parallel."""
+        manifest = os.path.join(self.tmpdir, "tasks")
+        submission.write_manifest(manifest, ["true", "false", "true", "false"])
+        self.assertEqual(submission.run_batch(manifest, 0, 2), 1)
+        self.assertEqual(submission.run_batch(manifest, 1, 2, processes=2), 1)
+
+    def test_run_batch_shares_resources(self):
+        """commands run side by side are told how many share the element."""
+        manifest = os.path.join(self.tmpdir, "tasks")
+        out = os.path.join(self.tmpdir, "shared_%d")
+        submission.write_manifest(manifest, ['echo "$%s" > %s' % (resources.SHARED_TASKS_ENV, out % i) for i in range(3)])
+        self.assertEqual(submission.run_batch(manifest, 0, 3, processes=2), 0)
+        for i in range(3):
+            with open(out % i) as f:
+                self.assertEqual(f.read().strip(), "2")
+        self.assertEqual(submission.run_batch(manifest, 0, 1), 0)
+        with open(out % 0) as f:
+            self.assertEqual(f.read().strip(), os.environ.get(resources.SHARED_TASKS_ENV, ""))
+
+    def test_dryrun_writes_manifest(self):
+        """a dry run writes the manifest and script without submitting."""
+        jobid = submission.submit_array([("a", "echo a"), ("b", "echo b"), ("c", None)], "Pansh", self.tmpdir, self.args, dryrun=True)
+        self.assertEqual(jobid, None)
+        names = sorted(os.listdir(self.tmpdir))
+        self.assertEqual([os.path.splitext(n)[1] for n in names], [".sbatch", ".tasks"])
@@ -0,0 +1,158 @@
+"""
+Member index for .tar deliveries, for reading them without extraction.
+
+A TarIndex lists every member of an archive with its data offset and size.
+It is built with one scan of the archive and cached next to it as
+<archive>.index.json, or under TAR_INDEX_CACHE if the archive directory is
+not writable, and revalidated by the archive's size and mtime.  Small
+members (XML, RPB) are then read by seeking straight to their offset.
+Images are opened by GDAL through /vsitar/ paths, so nothing is unpacked.
+"""
+
+import os, json, hashlib, tarfile, logging
+
+logger = logging.getLogger("logger")
+
+VSI_PREFIX = "/vsitar/"
+CACHE_ENV_VAR = "TAR_INDEX_CACHE"
+INDEX_SUFFIX = ".index.json"
+
+_memo = {}
+
+
+def is_vsitar(path):
+    return path.startswith(VSI_PREFIX)
+
+
+def vsipath(tarpath, member):
+    """GDAL path of a member; the archive path is kept absolute."""
+    return VSI_PREFIX + os.path.abspath(tarpath) + "/" + member
+
+
+def split(path):
+    """Splits a /vsitar/ path into (archive path, member name)."""
+    rest = path[len(VSI_PREFIX):]
+    i = rest.lower().find(".tar/")
+    if i == -1:
+        raise ValueError("not a /vsitar/ member path: %s" % path)
+    return rest[:i + 4], rest[i + 5:]
+
+
+def exists(path):
+    """os.path.isfile that also understands /vsitar/ member paths."""
+    if not is_vsitar(path):
+        return os.path.isfile(path)
+    try:
+        tarpath, member = split(path)
+        return os.path.isfile(tarpath) and get(tarpath).find(member) is not None
+    except ValueError:
+        return False
+
+
+def getsize(path):
+    """os.path.getsize that also understands /vsitar/ member paths."""
+    if not is_vsitar(path):
+        return os.path.getsize(path)
+    tarpath, member = split(path)
+    index = get(tarpath)
+    return index.members[index.find(member)][1]
+
+
+def get(tarpath):
+    """Returns the TarIndex for tarpath, memoized per process."""
+    key = os.path.abspath(tarpath)
+    st = os.stat(key)
+    index = _memo.get(key)
+    if index is None or (index.size, index.mtime) != (st.st_size, st.st_mtime):
+        index = TarIndex(key, st)
+        _memo[key] = index
+    return index
+
+
+def find_images(tarpath, exts):
+    """/vsitar/ paths of the members of tarpath with one of exts."""
+    index = get(tarpath)
+    return [vsipath(tarpath, name) for name in index.names()
+            if os.path.splitext(name)[1].lower() in exts]
+
+
+class TarIndex(object):
+
+    def __init__(self, tarpath, st=None):
+        self.tarpath = tarpath
+        st = st or os.stat(tarpath)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.members = self._load()
+        if self.members is None:
+            self.members = self._build()
+            self._save()
+        self._lower = dict((name.lower(), name) for name in self.members)
+
+    def names(self):
+        return sorted(self.members)
+
+    def find(self, name):
+        """Actual member name matching name case-insensitively, or None."""
+        if name in self.members:
+            return name
+        return self._lower.get(name.lower())
+
+    def read(self, name):
+        """Bytes of a regular file member."""
+        offset, size = self.members[self.find(name)]
+        with open(self.tarpath, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _build(self):
+        logger.debug("Indexing tar file: %s" % self.tarpath)
+        members = {}
+        tar = tarfile.open(self.tarpath, "r:")
+        try:
+            for ti in tar:
+                if ti.isfile():
+                    members[ti.name] = (ti.offset_data, ti.size)
+        finally:
+            tar.close()
+        return members
+
+    def _cache_paths(self):
+        paths = [self.tarpath + INDEX_SUFFIX]
+        cache_dir = os.environ.get(CACHE_ENV_VAR)
+        if cache_dir:
+            name = hashlib.sha1(self.tarpath.encode("utf-8")).hexdigest() + INDEX_SUFFIX
+            paths.append(os.path.join(cache_dir, name))
+        return paths
+
+    def _load(self):
+        for fp in self._cache_paths():
+            try:
+                with open(fp) as f:
+                    d = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            if d.get("tarpath") == self.tarpath and d.get("size") == self.size and d.get("mtime") == self.mtime:
+                return dict((m[0], (m[1], m[2])) for m in d["members"])
+        return None
+
+    def _save(self):
+        d = {
+            "tarpath": self.tarpath,
+            "size": self.size,
+            "mtime": self.mtime,
+            "members": [[name, off, size] for name, (off, size) in sorted(self.members.items())],
+        }
+        for fp in self._cache_paths():
+            tmp = "%s.%d.tmp" % (fp, os.getpid())
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(d, f)
+                os.rename(tmp, fp)
+                return
+            except (IOError, OSError) as e:
+                logger.debug("Cannot write tar index %s: %s" % (fp, e))
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
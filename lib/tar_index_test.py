@@ -0,0 +1,47 @@
+# std modules:
+from unittest import TestCase
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+from lib import tar_index
+
+
+class Test_tar_index(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tarpath = os.path.join(self.tmpdir, "order.tar")
+        tar = tarfile.open(self.tarpath, "w")
+        for name, data in (("order/scene.NTF", b"n" * 3000),
+                           ("order/scene.XML", b"<isd/>"),
+                           ("order/scene.RPB", b"rpc")):
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tar.addfile(ti, io.BytesIO(data))
+        tar.close()
+        tar_index._memo.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_member_from_index(self):
+        """members are read by offset, and the index is cached on disk."""
+        index = tar_index.get(self.tarpath)
+        self.assertEqual(index.read("order/scene.XML"), b"<isd/>")
+        self.assertTrue(os.path.isfile(self.tarpath + tar_index.INDEX_SUFFIX))
+        reloaded = tar_index.TarIndex(self.tarpath)
+        self.assertEqual(reloaded.members, index.members)
+
+    def test_vsitar_paths(self):
+        """image members are listed as /vsitar/ paths that split back."""
+        images = tar_index.find_images(self.tarpath, [".ntf", ".tif"])
+        self.assertEqual(images, ["/vsitar/" + self.tarpath + "/order/scene.NTF"])
+        self.assertEqual(tar_index.split(images[0]), (self.tarpath, "order/scene.NTF"))
+        self.assertEqual(tar_index.getsize(images[0]), 3000)
+
+    def test_exists_is_case_insensitive(self):
+        """sidecars are found regardless of extension case."""
+        self.assertTrue(tar_index.exists(tar_index.vsipath(self.tarpath, "order/scene.rpb")))
+        self.assertFalse(tar_index.exists(tar_index.vsipath(self.tarpath, "order/scene_rpc.txt")))
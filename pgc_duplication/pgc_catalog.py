@@ -0,0 +1,89 @@
+import os, string, sys, logging, argparse
+
+from lib import ortho_utils
+from lib import catalog
+
+#### Create Loggers
+logger = logging.getLogger("logger")
+logger.setLevel(logging.DEBUG)
+
+
+def main():
+
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Crawl an image archive once and record per-scene metadata in a SQLite scene catalog"
+        )
+
+    parser.add_argument("src", help="source image, text file, or directory")
+    parser.add_argument("catalog", help="catalog file to create or update (%s)" % string.join(catalog.CATALOG_EXTS, ','))
+    parser.add_argument("--exts", nargs="+", default=ortho_utils.exts,
+                        help="image file extensions to catalog (default %s)" % string.join(ortho_utils.exts, ' '))
+    parser.add_argument("--prune", action="store_true", default=False,
+                        help="remove catalog entries whose image no longer exists")
+    parser.add_argument("--log", help="file to log progress (default is <catalog dir>/catalog.log)")
+
+    #### Parse Arguments
+    opt = parser.parse_args()
+    src = os.path.abspath(opt.src)
+    catpath = os.path.abspath(opt.catalog)
+    exts = [e.lower() if e.startswith('.') else '.' + e.lower() for e in opt.exts]
+
+    #### Validate Required Arguments
+    if os.path.isdir(src):
+        srctype = 'dir'
+    elif os.path.isfile(src) and os.path.splitext(src)[1].lower() == '.txt':
+        srctype = 'textfile'
+    elif os.path.isfile(src) and os.path.splitext(src)[1].lower() in exts:
+        srctype = 'image'
+    else:
+        parser.error("Arg1 is not a recognized file path or file type: %s" % (src))
+
+    if os.path.splitext(catpath)[1].lower() not in catalog.CATALOG_EXTS:
+        parser.error("Catalog extension must be one of %s: %s" % (string.join(catalog.CATALOG_EXTS, ','), catpath))
+    if not os.path.isdir(os.path.dirname(catpath)):
+        parser.error("Catalog directory is not valid: %s" % os.path.dirname(catpath))
+
+    #### Set Up Logging Handlers
+    if opt.log is None:
+        logfile = os.path.join(os.path.dirname(catpath), "catalog.log")
+    else:
+        logfile = os.path.abspath(opt.log)
+
+    lso = logging.StreamHandler()
+    lso.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S')
+    lso.setFormatter(formatter)
+    logger.addHandler(lso)
+
+    lfh = logging.FileHandler(logfile)
+    lfh.setLevel(logging.DEBUG)
+    lfh.setFormatter(formatter)
+    logger.addHandler(lfh)
+
+    #### Find Images
+    if srctype == 'dir':
+        image_list = ortho_utils.FindImages(src, exts)
+    elif srctype == 'textfile':
+        t = open(src, 'r')
+        image_list = [line.rstrip() for line in t.readlines() if line.strip()]
+        t.close()
+    else:
+        image_list = [src]
+
+    logger.info("Number of src images: %i" % len(image_list))
+
+    #### Update Catalog
+    cat = catalog.Catalog(catpath)
+    try:
+        added, updated, unchanged = cat.update(image_list, ortho_utils.GetDGMetadataPath)
+        logger.info("Catalog %s: %i added, %i updated, %i unchanged" % (catpath, added, updated, unchanged))
+        if opt.prune:
+            logger.info("Removed %i missing images" % cat.prune())
+        logger.info("Catalog contains %i images" % len(cat))
+    finally:
+        cat.close()
+
+
+if __name__ == '__main__':
+    main()
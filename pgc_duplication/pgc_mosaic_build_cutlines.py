@@ -5,6 +5,8 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import resources
+from lib import footprint_cache
 import gdal, ogr,osr,gdalconst
 
 logger = logging.getLogger("logger")
@@ -29,6 +31,9 @@ def main():
     
     parser.add_argument("--cutline_step", type=int, default=2,
                        help="cutline calculator pixel skip interval (default=2)")
+    parser.add_argument("--cutline_max_error", type=float, default=0,
+                       help="trace cutlines on the coarsest image overview with pixels no larger than this, in mosaic "
+                       "units (default=0, full resolution)")
     parser.add_argument("--component_shp", action="store_true", default=False,
                         help="create shp of all component images")
    
@@ -95,7 +100,8 @@ def main():
         
         #### gather image info list
         logger.info("Gathering image info")
-        imginfo_list = [ImageInfo(image,"IMAGE") for image in intersects]
+        cache = footprint_cache.get(args.footprint_cache)
+        imginfo_list = [ImageInfo(image,"IMAGE",cache=cache) for image in intersects]
         
         #### Get mosaic parameters
         logger.info("Getting mosaic parameters")
@@ -108,9 +114,10 @@ def main():
         logger.info("Getting Exact Image geometry")
         
         imginfo_list2 =[]
-        for iinfo in imginfo_list:
-            simplify_tolerance = 2.0 * ((params.xres + params.yres) / 2.0) ## 2 * avg(xres, yres), should be 1 for panchromatic mosaics where res = 0.5m
-            geom,xs1,ys1 = GetExactTrimmedGeom(iinfo.srcfp,step=args.cutline_step,tolerance=simplify_tolerance)
+        simplify_tolerance = 2.0 * ((params.xres + params.yres) / 2.0) ## 2 * avg(xres, yres), should be 1 for panchromatic mosaics where res = 0.5m
+        footprints = GetExactTrimmedGeoms([iinfo.srcfp for iinfo in imginfo_list],step=args.cutline_step,tolerance=simplify_tolerance,
+                                          max_error=args.cutline_max_error,threads=resources.job_cpus(),cache=cache)
+        for iinfo,(geom,xs1,ys1) in zip(imginfo_list,footprints):
                 
             if geom is None:
                 logger.info("%s: geometry could not be determined" %iinfo.srcfn)
@@ -135,35 +142,7 @@ def main():
         else:
             
             logger.info("Overlaying images to determine contributors")
-            contribs = []
-            
-            for i in xrange(0,len(imginfo_list2)):
-                iinfo = imginfo_list2[i]
-                basegeom = iinfo.geom
-            
-                for j in range(i+1,len(imginfo_list2)):
-                    iinfo2 = imginfo_list2[j]
-                    geom2 = iinfo2.geom
-                    
-                    if basegeom.Intersects(geom2):
-                        basegeom = basegeom.Difference(geom2)
-                        if basegeom is None or basegeom.IsEmpty():
-                            break
-                            
-                if basegeom is None:
-                    logger.info("Function Error: %s" %iinfo.srcfn)
-                elif basegeom.IsEmpty():
-                    logger.info("Removing non-contributing image: %s" %iinfo.srcfn)
-                else:
-                    basegeom = basegeom.Intersection(extent_geom)
-                    if basegeom is None:
-                        logger.info("Function Error: %s" %iinfo.srcfn)
-                    elif basegeom.IsEmpty():
-                        logger.info("Removing non-contributing image: %s" %iinfo.srcfn)
-                    else:
-                        contribs.append((iinfo,basegeom))
-                        tm = datetime.today()    
-                        logger.info("Image: %s" %(os.path.basename(image)))
+            contribs = GetContributors(imginfo_list2,extent_geom)
         
         logger.info("Number of contributors: %d" %len(contribs))
         
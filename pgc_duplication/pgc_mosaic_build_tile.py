@@ -6,6 +6,10 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import compositor
+from lib import finalize
+from lib import run_state
+from lib import resources
 import numpy
 import gdal, ogr,osr, gdalconst
     
@@ -34,6 +38,8 @@ def main():
                         help="scratch space (default is mosaic directory)")
     parser.add_argument("--gtiff_compression", choices=GTIFF_COMPRESSIONS, default="lzw",
                         help="GTiff compression type. Default=lzw (%s)"%string.join(GTIFF_COMPRESSIONS,','))
+    parser.add_argument("--concurrent_tiles", type=int, default=1,
+                        help="tiles built at once on this machine; each gets an equal share of the cpus (default 1)")
     
     #### Parse Arguments
     args = parser.parse_args()
@@ -46,7 +52,6 @@ def main():
     tile = args.tile
     ref_xres, ref_yres = args.resolution
     xmin,xmax,ymin,ymax = args.extent
-    dims = "-tr %s %s -te %s %s %s %s" %(ref_xres,ref_yres,xmin,ymin,xmax,ymax)
     
     ##### Configure Logger
     logfile = os.path.splitext(tile)[0]+".log"
@@ -78,18 +83,29 @@ def main():
     if not os.path.isdir(wd):
         os.makedirs(wd)
     localtile2 = os.path.join(wd,os.path.basename(tile)) 
-    localtile1 = localtile2.replace(".tif","_temp.tif")
+
+    #### With a run state, a tile left by an interrupted job is rebuilt
+    state = run_state.get(args.run_state)
+    scene = run_state.scene_name(tile)
+    if state is not None:
+        if state.is_done(scene,"mosaicked",tile):
+            logger.info("Tile is recorded as done: %s" %tile)
+            return
+        for fp in (tile,localtile2):
+            if os.path.isfile(fp):
+                os.remove(fp)
+        state.start(scene,"mosaicked")
     
     del_images = []
     final_intersects = []
-    images = {}
+    proj = None
     
     for image in intersects:
         ds = gdal.Open(image)
         if ds is not None:
-            srcbands = ds.RasterCount
+            if proj is None:
+                proj = ds.GetProjectionRef()
             
-            images[image] = srcbands
             final_intersects.append(image)
             logger.info("%s" %(os.path.basename(image)))
     
@@ -102,62 +118,39 @@ def main():
     poly_wkt = 'POLYGON (( %s %s, %s %s, %s %s, %s %s, %s %s ))' %(xmin,ymin,xmin,ymax,xmax,ymax,xmax,ymin,xmin,ymin)
     tile_geom = ogr.CreateGeometryFromWkt(poly_wkt)
     
-    c = 0
-    for img in final_intersects:
-            
-        #### Check if bands number is correct
-        mergefile = img
-        
-        if args.force_pan_to_multi is True and bands > 1:
-            srcbands = images[img]
-            if srcbands == 1:
-                mergefile = os.path.join(wd,os.path.basename(img)[:-4])+"_merge.tif"
-                cmd = 'gdal_merge.py -ps %s %s -separate -o "%s" "%s"' %(ref_xres, ref_yres, mergefile, string.join(([img] * bands),'" "'))
-                ExecCmd(cmd)
-        srcnodata = string.join((['0'] * bands)," ")
-            
-        if c == 0:
-            if os.path.isfile(localtile1):
-                logger.info("localtile1 already exists")
-                status = 1
-                break
-            cmd = 'gdalwarp %s -srcnodata "%s" -dstnodata "%s" "%s" "%s"' %(dims,srcnodata,srcnodata,mergefile,localtile1)
-            ExecCmd(cmd)
-            
-        else:
-            cmd = 'gdalwarp -srcnodata "%s" "%s" "%s"' %(srcnodata,mergefile,localtile1)
-            ExecCmd(cmd)
-            
-        c += 1
-        
-        
-        if not mergefile == img:
-            del_images.append(mergefile)
-            
-    del_images.append(localtile1)        
+    #### Tiles running side by side share the job's cpus
+    threads = resources.warp_settings(args.concurrent_tiles)[0]
+    
+    ####  Composite the images in score order straight to the compressed tile
+    ####  (with force_pan_to_multi, pan images are read once and copied to every band)
+    if len(final_intersects) == 0:
+        logger.error("No images could be opened for tile: %s" %tile)
+        status = 1
+    else:
+        grid = compositor.Grid(xmin,xmax,ymin,ymax,ref_xres,ref_yres,proj)
+        status = compositor.composite(final_intersects,localtile2,grid,bands,compression=args.gtiff_compression,
+                                      threads=threads,pan_to_multi=args.force_pan_to_multi)
     
     if status == 0:
-        ####  Write to Compressed file
-        if os.path.isfile(localtile1):
-            if args.gtiff_compression == 'lzw':
-                compress_option = '-co "compress=lzw"'
-            elif args.gtiff_compression == 'jpeg95':
-                compress_option =  '-co "compress=jpeg" -co "jpeg_quality=95"'
-                
-            cmd = 'gdal_translate -stats -of GTiff %s -co "PHOTOMETRIC=MINISBLACK" -co "TILED=YES" -co "BIGTIFF=IF_SAFER" "%s" "%s"' %(compress_option,localtile1,localtile2)
-            ExecCmd(cmd)
-        
-        ####  Build Pyramids        
+        ####  Build Pyramids and Stats
         if os.path.isfile(localtile2):
-            cmd = 'gdaladdo "%s" 2 4 8 16 30' %(localtile2)
-            ExecCmd(cmd)
+            if finalize.run(localtile2, args.pyramid_levels, args.pyramid_resampling, approx=args.approx_stats,
+                            threads=threads) == 1:
+                logger.error("Building pyramids or stats failed for tile: %s" %tile)
+                status = 1
         
         #### Copy tile to destination
-        if os.path.isfile(localtile2):
+        if status == 0 and os.path.isfile(localtile2):
             logger.info("Copying output files to destination dir")
             copyall(localtile2,os.path.dirname(tile))
             
         del_images.append(localtile2)
+
+    if state is not None:
+        if status == 0 and os.path.isfile(tile):
+            state.finish(scene,"mosaicked",tile)
+        else:
+            state.fail(scene,"mosaicked","Tile not built")
     
     
     #### Delete temp files
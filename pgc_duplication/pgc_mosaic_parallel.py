@@ -6,6 +6,12 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import catalog
+from lib import discovery
+from lib import footprint_cache
+from lib import run_state
+from lib import spatial_index
+from lib import submission
 import gdal, ogr, osr, gdalconst
 import numpy
 import multiprocessing as mp
@@ -17,7 +23,7 @@ logger.setLevel(logging.DEBUG)
 default_qsub_script = "qsub_mosaic.sh"
 default_logfile = "mosaic.log"
 
-SUBMISSION_TYPES = ['HPC','VM']
+SUBMISSION_TYPES = ['HPC','VM',submission.SLURM]
 
 def main():
     
@@ -32,7 +38,7 @@ def main():
 	description="Sumbit mosaic jobs to HPC cluster"
 	)
     
-    parser.add_argument("src", help="textfile or directory of input rasters (tif only)")
+    parser.add_argument("src", help="textfile, directory, or scene catalog of input rasters (tif only)")
     parser.add_argument("mosaic_name", help="output mosaic name excluding extension")
     pos_arg_keys = ["src","mosaic_name"]
 
@@ -54,6 +60,8 @@ def main():
                         help="create shp of all componenet images")
     parser.add_argument("--gtiff_compression", choices=GTIFF_COMPRESSIONS, default="lzw",
                         help="GTiff compression type. Default=lzw (%s)"%string.join(GTIFF_COMPRESSIONS,','))
+    catalog.add_query_arguments(parser)
+    submission.add_arguments(parser)
     
     #### Parse Arguments
     args = parser.parse_args()
@@ -62,20 +70,24 @@ def main():
     mosaic = os.path.abspath(args.mosaic_name)
     mosaic = os.path.splitext(mosaic)[0]
     mosaic_dir = os.path.dirname(mosaic)
+    if args.run_state is not None:
+        args.run_state = os.path.abspath(args.run_state)
+    if args.footprint_cache is not None:
+        args.footprint_cache = os.path.abspath(args.footprint_cache)
     
     if args.qsubscript is None: 
         qsubpath = os.path.join(os.path.dirname(scriptpath),default_qsub_script)
     else:
         qsubpath = os.path.abspath(args.qsubscript)
-        
-    if not os.path.isfile(qsubpath):
-        parser.error("qsub script path is not valid: %s" %qsubpath)
     
     cutline_builder_script = os.path.join(os.path.dirname(scriptpath),'pgc_mosaic_build_cutlines.py')
     tile_builder_script = os.path.join(os.path.dirname(scriptpath),'pgc_mosaic_build_tile.py')
     
     #### Validate Arguments
-    if os.path.isfile(inpath):
+    bCatalog = catalog.is_catalog(inpath)
+    if bCatalog:
+        bTextfile = False
+    elif os.path.isfile(inpath):
         bTextfile = True
     elif os.path.isdir(inpath):
         bTextfile = False
@@ -84,8 +96,6 @@ def main():
         
     if not os.path.isdir(mosaic_dir):
         os.makedirs(mosaic_dir)
-    if not os.path.isfile(qsubpath):
-        parser.error("Arg3 is not a valid file path: %s" %qsubpath)
         
     
     #### Validate target day option
@@ -136,14 +146,19 @@ def main():
         is_hpc = True
         
     if args.submission_type is None:
-        submission_type = "HPC" if is_hpc else "VM"
+        submission_type = "HPC" if is_hpc else submission.SLURM if submission.slurm_available() else "VM"
         
     elif args.submission_type == "HPC" and is_hpc is False:
         parser.error("Submission type HPC is not available on this system")
+    elif args.submission_type == submission.SLURM and not submission.slurm_available():
+        parser.error("Submission type SLURM is not available on this system")
     else:
         submission_type = args.submission_type
     
     logger.info("Submission type: {0}".format(submission_type))
+    
+    if submission_type == 'HPC' and not os.path.isfile(qsubpath):
+        parser.error("qsub script path is not valid: %s" %qsubpath)
     task_queue = []
     
     if args.processes and not submission_type == 'VM':
@@ -180,7 +195,7 @@ def main():
     xs = []
     ys = []
     
-    image_list = FindImages(inpath,bTextfile,exclude_list)
+    image_list = FindImages(inpath,bTextfile,exclude_list,args if bCatalog else None)
         
     if len(image_list) == 0:
         logger.error("No images found in input file or directory: %s" %inpath)
@@ -190,7 +205,8 @@ def main():
     
     #### gather image info list
     logger.info("Getting image info")
-    imginfo_list = [ImageInfo(image,"IMAGE") for image in image_list]
+    cache = footprint_cache.get(args.footprint_cache)
+    imginfo_list = [ImageInfo(image,"IMAGE",cache=cache) for image in image_list]
     
     #### Get mosaic parameters
     logger.info("Setting mosaic parameters")
@@ -212,11 +228,13 @@ def main():
         poly_wkt = 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' %(params.xmin,params.ymin,params.xmin,params.ymax,params.xmax,params.ymax,params.xmax,params.ymin,params.xmin,params.ymin)
         params.extent_geom = ogr.CreateGeometryFromWkt(poly_wkt)
         
-        #### Check geom overlaps extent
+        #### Check geom overlaps extent, testing exactly only the images whose bounding box overlaps it
+        index = spatial_index.STRtree([(iinfo.geom.GetEnvelope() if iinfo.geom is not None else None, n) for n, iinfo in enumerate(imginfo_list2)])
+        candidates = set(index.query(params.extent_geom.GetEnvelope()))
         imginfo_list3 = []
-        for iinfo in imginfo_list2:
+        for n, iinfo in enumerate(imginfo_list2):
             if iinfo.geom is not None:
-                if params.extent_geom.Intersect(iinfo.geom) is True:
+                if n in candidates and params.extent_geom.Intersect(iinfo.geom) is True:
                     imginfo_list3.append(iinfo)
                 else:
                     logger.debug("Image does not intersect mosaic extent: %s" %iinfo.srcfn)
@@ -272,16 +290,14 @@ def main():
     #### Write all intersects file
     intersects_all = []
     
+    #### imginfo_list3 only holds images intersecting the extent
     for iinfo in imginfo_list3:
-        if params.extent_geom.Intersect(iinfo.geom) is True:
-            if iinfo.score > 0:
-                intersects_all.append(iinfo)
-            elif args.nosort:
-                intersects_all.append(iinfo)
-            else:
-                logger.debug("Image has an invalid score: %s --> %i" %(iinfo.srcfp, iinfo.score))
+        if iinfo.score > 0:
+            intersects_all.append(iinfo)
+        elif args.nosort:
+            intersects_all.append(iinfo)
         else:
-            logger.debug("Image does not intersect mosaic extent: %s" %iinfo.srcfp)  ### this line should never be needed.  non-intersecting images should be removed earlier if extent is provided, otherwise all images are in the extent.
+            logger.debug("Image has an invalid score: %s --> %i" %(iinfo.srcfp, iinfo.score))
     
     aitpath = mosaic+"_intersects.txt"
     ait = open(aitpath,"w")
@@ -413,7 +429,7 @@ def main():
     
     if args.component_shp is True:
         
-        arg_keys_to_remove = ('l','qsubscript','processes','log','gtiff_compression','mode','extent','resolution','submission_type','wd')
+        arg_keys_to_remove = ('l','qsubscript','processes','log','gtiff_compression','mode','extent','resolution','submission_type','wd') + catalog.QUERY_ARG_KEYS + submission.ARG_KEYS
         shp_arg_str = build_arg_list(args, pos_arg_keys, arg_keys_to_remove)
         
         comp_shp = mosaic + "_components.shp"
@@ -438,7 +454,7 @@ def main():
                     qsubpath
                     )
             
-            elif submission_type == 'VM':
+            elif submission_type in ('VM',submission.SLURM):
                 cmd = r'python %s --cutline_step=512 %s -e %f %f %f %f %s %s' %(
                     cutline_builder_script,
                     shp_arg_str,
@@ -464,7 +480,7 @@ def main():
     ###############################################
     shp = mosaic + "_cutlines.shp"
     
-    arg_keys_to_remove = ('l','qsubscript','processes','log','gtiff_compression','mode','extent','resolution','component_shp','submission_type','wd')
+    arg_keys_to_remove = ('l','qsubscript','processes','log','gtiff_compression','mode','extent','resolution','component_shp','submission_type','wd') + catalog.QUERY_ARG_KEYS + submission.ARG_KEYS
     shp_arg_str = build_arg_list(args, pos_arg_keys, arg_keys_to_remove)
     
     if os.path.isfile(shp):
@@ -486,7 +502,7 @@ def main():
                 qsubpath
                 )
         
-        elif submission_type == 'VM':
+        elif submission_type in ('VM',submission.SLURM):
             cmd = r'python %s %s -e %f %f %f %f %s %s' %(
                 cutline_builder_script,
                 shp_arg_str,
@@ -511,9 +527,14 @@ def main():
     ####  For each tile set up mosaic call to qsub
     ################################################
     
-    arg_keys_to_remove = ('l','qsubscript','processes','log','mode','extent','resolution','bands','component_shp','submission_type')
+    arg_keys_to_remove = ('l','qsubscript','processes','log','mode','extent','resolution','bands','component_shp','submission_type') + catalog.QUERY_ARG_KEYS + submission.ARG_KEYS
     tile_arg_str = build_arg_list(args, pos_arg_keys, arg_keys_to_remove)
+    state = run_state.get(args.run_state)
+    if state is not None:
+        completed = state.completed("mosaicked")
     logger.debug("Identifying components of {0} subtiles".format(num_tiles))
+    #### Bounding-box index of the image footprints; each tile tests exactly only the candidates it returns, in score order
+    index = spatial_index.STRtree([(iinfo.geom.GetEnvelope(), n) for n, iinfo in enumerate(intersects_all)])
     for t in tiles:
         logger.debug("Identifying components of tile %d of %d: %s" %(i,num_tiles,os.path.basename(t.name)))
         
@@ -521,7 +542,8 @@ def main():
         logger.debug("Running intersect with imagery")       
         
         intersects = []
-        for iinfo in intersects_all:
+        for n in index.query(t.geom.GetEnvelope()):
+            iinfo = intersects_all[n]
             if t.geom.Intersect(iinfo.geom) is True:
                 if iinfo.score > 0:
                     logger.debug("intersects! %s - score %f" %(iinfo.srcfn,iinfo.score))
@@ -543,7 +565,11 @@ def main():
             
             #### Submit QSUB job
             logger.debug("Building mosaicking job for tile: %s" %os.path.basename(t.name))
-            if os.path.isfile(t.name) is False:
+            if state is not None:
+                done = run_state.scene_name(t.name) in completed
+            else:
+                done = os.path.isfile(t.name)
+            if done is False:
                 
                 if submission_type == 'HPC':
                     cmd = r'qsub %s -N Mosaic%04i -v p1="%s %s -e %f %f %f %f -r %s %s -b %d %s %s" "%s"' %(
@@ -562,7 +588,7 @@ def main():
                         qsubpath
                         )
                        
-                elif submission_type == 'VM':
+                elif submission_type in ('VM',submission.SLURM):
                     cmd = r'python %s %s -e %f %f %f %f -r %s %s -b %d %s %s' %(
                         tile_builder_script,
                         tile_arg_str,
@@ -576,6 +602,8 @@ def main():
                         t.name,
                         itpath,
                         )
+                    if submission_type == 'VM':
+                        cmd += " --concurrent_tiles %d" %processes
                     
                 else:
                     cmd = None
@@ -599,6 +627,9 @@ def main():
             job_name,cmd = task
             subprocess.call(cmd,shell=True)
         
+    elif submission_type == submission.SLURM:
+        submission.submit_array(task_queue, "Mosaic", mosaic_dir, args)
+        
     elif submission_type == 'VM':
         pool = mp.Pool(processes)
         try:
@@ -612,11 +643,17 @@ def main():
         
     
 
-def FindImages(inpath,bTextfile,exclude_list):
+def FindImages(inpath,bTextfile,exclude_list,catalog_args=None):
     
     image_list = []
     
-    if bTextfile is True:
+    if catalog_args is not None:
+        #### query the scene catalog and seed the metadata memo used for scoring
+        for image in catalog.query_from_args(inpath,catalog_args):
+            if os.path.splitext(image)[1].lower() in EXTS:
+                image_list.append(image)
+    
+    elif bTextfile is True:
         t = open(inpath,'r')
         for line in t.readlines():
             image = line.rstrip('\n').rstrip('\r')
@@ -627,12 +664,7 @@ def FindImages(inpath,bTextfile,exclude_list):
         t.close()
                 
     else:
-        for root,dirs,files in os.walk(inpath):
-            for f in  files:
-                if os.path.splitext(f)[1].lower() in EXTS:
-                    image_path = os.path.join(root,f)
-                    image_path = string.replace(image_path,'\\','/')
-                    image_list.append(image_path)
+        image_list = discovery.find_files(inpath,EXTS)
     
     #print len(exclude_list)
     if len(exclude_list) > 0:
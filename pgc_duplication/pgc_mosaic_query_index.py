@@ -292,34 +292,7 @@ def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
                     
                     ####  Overlay geoms and remove non-contributors
                     logger.debug("Overlaying images to determine contributors")
-                    contribs = []
-                    
-                    for i in xrange(0,len(imginfo_list3)):
-                        iinfo = imginfo_list3[i]
-                        basegeom = iinfo.geom
-    
-                        for j in range(i+1,len(imginfo_list3)):
-                            iinfo2 = imginfo_list3[j]
-                            geom2 = iinfo2.geom
-                            
-                            if basegeom.Intersects(geom2):
-                                basegeom = basegeom.Difference(geom2)
-                                if basegeom is None or basegeom.IsEmpty():
-                                    #logger.debug("Broke after %i comparisons" %j)
-                                    break
-                                    
-                        if basegeom is None:
-                            logger.debug("Function Error: %s" %iinfo.srcfp)
-                        elif basegeom.IsEmpty():
-                            logger.debug("Removing non-contributing image: %s" %iinfo.srcfp)
-                        else:
-                            basegeom = basegeom.Intersection(t.geom)
-                            if basegeom is None:
-                                logger.debug("Function Error: %s" %iinfo.srcfp)
-                            elif basegeom.IsEmpty():
-                                logger.debug("Removing non-contributing image: %s" %iinfo.srcfp)
-                            else:
-                                contribs.append(iinfo.srcfp)
+                    contribs = [iinfo.srcfp for iinfo, geom in GetContributors(imginfo_list3,t.geom)]
                                                 
                 elif args.nosort is True:
                     contribs = image_list
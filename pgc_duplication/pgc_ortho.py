@@ -8,6 +8,10 @@ from xml.etree import cElementTree as ET
 import gdal, ogr,osr, gdalconst
 
 from lib import ortho_utils as ortho_utils
+from lib import catalog
+from lib import run_state
+from lib import staging
+from lib import tar_index
 
 #### Create Loggers
 logger = logging.getLogger("logger")
@@ -33,18 +37,22 @@ def main():
 
     #### Parse Arguments
     opt = parser.parse_args()
-    src = os.path.abspath(opt.src)
+    src = opt.src if tar_index.is_vsitar(opt.src) else os.path.abspath(opt.src)
     dstdir = os.path.abspath(opt.dst)
 
     #### Validate Required Arguments
     if os.path.isdir(src):
         srctype = 'dir'
+    elif catalog.is_catalog(src):
+        srctype = 'catalog'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() == '.txt':
         srctype = 'textfile'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() in ortho_utils.exts:
         srctype = 'image'
     elif os.path.isfile(src.replace('msi','blu')) and os.path.splitext(src)[1].lower() in ortho_utils.exts:
         srctype = 'image'
+    elif tar_index.is_vsitar(src) and tar_index.exists(src) and os.path.splitext(src)[1].lower() in ortho_utils.exts:
+        srctype = 'image'
     else:
         parser.error("Arg1 is not a recognized file path or file type: %s" % (src))
 
@@ -92,13 +100,15 @@ def main():
 
     #### Find Images
     if srctype == "dir":
-        image_list = ortho_utils.FindImages(src, ortho_utils.exts)
+        image_list = ortho_utils.FindImages(src, ortho_utils.exts + ['.tar'] if opt.tar_input else ortho_utils.exts, opt.discovery_manifest)
     elif srctype == "textfile":
         t = open(src,'r')
         image_list = []
         for line in t.readlines():
             image_list.append(line.rstrip('\n'))
         t.close()
+    elif srctype == "catalog":
+        image_list = catalog.query_from_args(src, opt)
     elif srctype == "image":
         image_list = [src]
 
@@ -118,26 +128,64 @@ def main():
 
     image_list3 = list(set(image_list2))
 
-    # Iterate Through Found Images
+    state = run_state.get(opt.run_state)
+    if state is not None:
+        state.discover([run_state.scene_name(srcfp) for srcfp in image_list3])
+        completed = state.completed("stretched")
+
+    # Find the images still to process
+    tasks = []
     for srcfp in image_list3:
 
         srcdir, srcfn = os.path.split(srcfp)
 
         #### Derive dstfp
-        stretch = opt.stretch
-
         dstfp = os.path.join(dstdir,"%s_%s%s%d%s" % (os.path.splitext(srcfn)[0],
-	    ortho_utils.getBitdepth(opt.outtype),
-	    opt.stretch,
-	    spatial_ref.epsg,
-	    ortho_utils.formats[opt.format]
-	    ))
-
-        done = os.path.isfile(dstfp)
+            ortho_utils.getBitdepth(opt.outtype),
+            opt.stretch,
+            spatial_ref.epsg,
+            ortho_utils.formats[opt.format]
+            ))
+
+        if state is not None:
+            done = run_state.scene_name(srcfp) in completed
+        else:
+            done = os.path.isfile(dstfp)
 
         if done is False:
-            rc_dict[srcfn] = ortho_utils.processImage(srcfp,dstfp,opt)
+            tasks.append((srcfp,dstfp))
+
+    #### Stage upcoming images into the working dir while the current one processes
+    manager = None
+    if opt.prefetch > 0:
+        if opt.wd is None:
+            ortho_utils.LogMsg("--prefetch has no effect without --wd")
+        else:
+            manager = staging.StagingManager(opt.wd, opt.staging, opt.prefetch, opt.scratch_reserve)
+            manager.schedule([srcfp for srcfp, dstfp in tasks if os.path.isfile(srcfp)])
 
+    # Iterate Through Found Images
+    starttime = datetime.today()
+    processed = []
+    for srcfp, dstfp in tasks:
+        try:
+            rc_dict[os.path.basename(srcfp)] = ortho_utils.processImage(srcfp,dstfp,opt,manager)
+        finally:
+            #### images skipped or failed before staging must leave the prefetch schedule too
+            if manager is not None:
+                manager.release(srcfp,not opt.save_temps)
+        processed.append(srcfp)
+
+    if manager is not None:
+        ortho_utils.LogMsg("Waiting for outputs to be copied to the destination")
+        for srcfp in manager.close():
+            ortho_utils.LogMsg("Failed to copy the outputs of: %s" %srcfp)
+            rc_dict[os.path.basename(srcfp)] = 1
+
+    if len(processed) > 0:
+        ortho_utils.LogNodeThroughput(processed, starttime)
+        images, copied, saved = staging.totals()
+        ortho_utils.LogMsg("Staging: %i images, %.2f GB copied, %.2f GB saved" %(images, copied / 1e9, saved / 1e9))
 
     #### Print Images with Errors
     for k,v in rc_dict.iteritems():
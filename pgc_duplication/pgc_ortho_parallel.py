@@ -8,12 +8,45 @@ from xml.etree import cElementTree as ET
 import gdal, ogr,osr, gdalconst
 import multiprocessing as mp
 from lib.ortho_utils import *
+from lib import aoi
+from lib import catalog
+from lib import run_state
+from lib import scheduler
+from lib import submission
+from lib import tar_index
 
 #### Create Loggers
 logger = logging.getLogger("logger")
 logger.setLevel(logging.DEBUG)
 
-SUBMISSION_TYPES = ['HPC','VM']
+SUBMISSION_TYPES = ['HPC','VM',submission.SLURM]
+
+#### Options of the in-process workers used in VM mode
+_worker_opt = None
+
+def init_worker(opt, console_handler):
+    global _worker_opt
+    _worker_opt = opt
+    #### Each image logs to its own file, as when it runs as a separate job
+    logger.removeHandler(console_handler)
+
+def process_task(srcfp, dstfp):
+    lfh = logging.FileHandler(os.path.splitext(dstfp)[0]+".log")
+    lfh.setLevel(logging.DEBUG)
+    lfh.setFormatter(logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S'))
+    logger.addHandler(lfh)
+    try:
+        return processImage(srcfp,dstfp,_worker_opt)
+    finally:
+        logger.removeHandler(lfh)
+        lfh.close()
+
+def cleanup_task(srcfp, dstfp, opt):
+    """Removes the partial output and temp files of a failed or killed attempt."""
+    wd = opt.wd if opt.wd is not None else os.path.dirname(dstfp)
+    base = os.path.join(wd, os.path.splitext(os.path.basename(srcfp))[0])
+    deleteTempFiles([dstfp, os.path.join(wd, os.path.basename(dstfp)), base+"_raw.vrt", base+"_warp.tif", base+"_vrt.vrt"])
+
 
 def main():
 
@@ -32,30 +65,39 @@ def main():
 			help="job submission type. Default is determined automatically (%s)"%string.join(SUBMISSION_TYPES,','))
     parser.add_argument("--processes", type=int,
 			help="number of processes to spawn for orthoing individual images (default 1). Use only on non-HPC runs.")
+    parser.add_argument("--task_timeout", type=float,
+			help="minutes after which an image is killed and counted as failed (VM only, default no limit)")
+    parser.add_argument("--task_retries", type=int, default=0,
+			help="number of times a failed or timed out image is retried (VM only, default 0)")
     parser.add_argument("--qsubscript",
 		      help="qsub script to use in cluster job submission (default is qsub_ortho.sh in script root folder)")
     parser.add_argument("-l",
 		      help="PBS resources requested (mimicks qsub syntax)")
     parser.add_argument("--dryrun", action='store_true', default=False,
 			help='print actions without executing')
+    submission.add_arguments(parser)
 
 
     #### Parse Arguments
     opt = parser.parse_args()
     scriptpath = os.path.abspath(sys.argv[0])
-    src = os.path.abspath(opt.src)
+    src = opt.src if tar_index.is_vsitar(opt.src) else os.path.abspath(opt.src)
     dstdir = os.path.abspath(opt.dst)
 
 
     #### Validate Required Arguments
     if os.path.isdir(src):
 	srctype = 'dir'
+    elif catalog.is_catalog(src):
+	srctype = 'catalog'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() == '.txt':
 	srctype = 'textfile'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() in exts:
 	srctype = 'image'
     elif os.path.isfile(src.replace('msi','blu')) and os.path.splitext(src)[1].lower() in exts:
 	srctype = 'image'
+    elif tar_index.is_vsitar(src) and tar_index.exists(src) and os.path.splitext(src)[1].lower() in exts:
+	srctype = 'image'
     else:
 	parser.error("Error arg1 is not a recognized file path or file type: %s" %(src))
 
@@ -63,15 +105,21 @@ def main():
     if not os.path.isdir(dstdir):
 	parser.error("Error arg2 is not a valid file path: %s" %(dstdir))
 
+    #### Validate the AOI, passing child jobs an absolute path to a vector AOI
+    if opt.aoi is not None:
+	if os.path.isfile(opt.aoi):
+	    opt.aoi = os.path.abspath(opt.aoi)
+	try:
+	    aoi.load(opt.aoi)
+	except ValueError, e:
+	    parser.error(str(e))
+
 
     if opt.qsubscript is None:
 	qsubpath = os.path.join(os.path.dirname(scriptpath),'qsub_ortho.sh')
     else:
 	qsubpath = os.path.abspath(opt.qsubscript)
 
-    if not os.path.isfile(qsubpath):
-	parser.error("qsub script path is not valid: %s" %qsubpath)
-
 
     #### Verify EPSG
     try:
@@ -100,7 +148,7 @@ def main():
     ####  Submission logic
     ################################
 
-    if srctype in ['dir','textfile']:
+    if srctype in ['dir','textfile','catalog']:
 	
 	    
 	####  Determine submission type based on presence of pbsnodes cmd
@@ -114,13 +162,18 @@ def main():
 	    is_hpc = True
     
 	if opt.submission_type is None:
-	    submission_type = "HPC" if is_hpc else "VM"
+	    submission_type = "HPC" if is_hpc else submission.SLURM if submission.slurm_available() else "VM"
 	elif opt.submission_type == "HPC" and is_hpc is False:
 	    parser.error("Submission type HPC is not available on this system")
+	elif opt.submission_type == submission.SLURM and not submission.slurm_available():
+	    parser.error("Submission type SLURM is not available on this system")
 	else:
 	    submission_type = opt.submission_type
     
 	logger.info("Submission type: {0}".format(submission_type))
+
+	if submission_type == 'HPC' and not os.path.isfile(qsubpath):
+	    parser.error("qsub script path is not valid: %s" %qsubpath)
 	task_queue = []
     
 	if opt.processes and not submission_type == 'VM':
@@ -141,13 +194,18 @@ def main():
 	    logger.info("Number of child processes to spawn: {0}".format(processes))
 	
 
+	#### Child jobs share the run state, wherever they run
+	if opt.run_state is not None:
+	    opt.run_state = os.path.abspath(opt.run_state)
+	state = run_state.get(opt.run_state)
+
 	#### Get args ready to pass through
 	#### Get -l args and make a var
 	l = ("-l %s" %opt.l) if opt.l is not None else ""
 
 	args_dict = vars(opt)
 	arg_list = []
-	arg_keys_to_remove = ('l','qsubscript','dryrun')
+	arg_keys_to_remove = ('l','qsubscript','dryrun') + catalog.QUERY_ARG_KEYS + submission.ARG_KEYS
 
 	## Add optional args to arg_list
 	for k,v in args_dict.iteritems():
@@ -164,16 +222,18 @@ def main():
 
 
 	if srctype == 'dir':
-	    image_list = FindImages(src,exts)
+	    image_list = FindImages(src,exts + ['.tar'] if opt.tar_input else exts,opt.discovery_manifest)
 	elif srctype == 'textfile':
 	    t = open(src,'r')
 	    image_list = []
 	    for line in t.readlines():
-		if os.path.isfile(line.rstrip()):
+		if tar_index.exists(line.rstrip()):
 		    image_list.append(line.rstrip())
 		elif not line == '\n':
 		    LogMsg('Src image does not exist: %s' %line.rstrip())
 	    t.close()
+	elif srctype == 'catalog':
+	    image_list = catalog.query_from_args(src, opt, prime=False)
 
 
 	#### Group Ikonos
@@ -191,11 +251,22 @@ def main():
 
 	image_list3 = list(set(image_list2))
 
+	#### Drop images whose footprint misses the AOI before submitting them
+	if opt.aoi is not None:
+	    image_count = len(image_list3)
+	    image_list3 = [srcfp for srcfp in image_list3 if aoi.intersects_metadata(opt.aoi, GetDGMetadataPath(srcfp))]
+	    logger.info('Images outside the AOI: %i' %(image_count - len(image_list3)))
+
 
 	#### Iterate Through Found Images
 	logger.info('Number of src images: %i' %len(image_list3))
+	if state is not None:
+	    state.discover([run_state.scene_name(srcfp) for srcfp in image_list3])
+	    completed = state.completed("stretched")
 	i = 0
 	task_queue = []
+	task_srcs = []
+	tasks = []
 
 	for srcfp in image_list3:
 
@@ -208,21 +279,30 @@ def main():
 		formats[opt.format]
 		))
 
-	    done = os.path.isfile(dstfp)
+	    if state is not None:
+		done = run_state.scene_name(srcfp) in completed
+	    else:
+		done = os.path.isfile(dstfp)
 
 	    if done is False:
 
 		if submission_type == 'HPC':
 		    cmd = r'qsub %s -N Ortho%04i -v p1="%s %s %s %s" "%s"' %(l,i,scriptpath,arg_str,srcfp,dstdir,qsubpath)
 
-		elif submission_type == 'VM':
+		elif submission_type == submission.SLURM:
 		    cmd = r'python %s %s %s %s' %(scriptpath,arg_str,srcfp,dstdir)
 
+		elif submission_type == 'VM':
+		    cmd = None
+		    size = tar_index.getsize(srcfp) if tar_index.exists(srcfp) else 0
+		    tasks.append(scheduler.Task(srcfn,(srcfp,dstfp),size))
+
 		else:
 		    cmd = None
 
 		job_name = srcfn
 		task_queue.append((job_name,cmd))
+		task_srcs.append(srcfp)
 		i+=1
 
 	logger.info("Number of images to process: %i" %i)
@@ -235,14 +315,23 @@ def main():
 		    job_name,cmd = task
 		    subprocess.call(cmd,shell=True)
 		logger.info("Images submitted: %i" %i)    
+	    elif submission_type == submission.SLURM:
+		submission.submit_array(task_queue, "Ortho", dstdir, opt)
 	    elif submission_type == 'VM':
-		pool = mp.Pool(processes)
+		starttime = datetime.today()
 		try:
-		    pool.map(ExecCmd_mp,task_queue,1)
+		    results = scheduler.run(tasks, process_task, processes,
+			timeout=opt.task_timeout * 60 if opt.task_timeout else None,
+			retries=opt.task_retries,
+			initializer=init_worker, initargs=(opt,lso),
+			cleanup=lambda srcfp, dstfp: cleanup_task(srcfp, dstfp, opt))
 		except KeyboardInterrupt:
-		    pool.terminate()
 		    logger.info("Processes terminated without file cleanup")
 		else:
+		    failed = sorted([name for name, rc in results.items() if rc != 0])
+		    if failed:
+			logger.error("Failed images (%i): %s" %(len(failed), ", ".join(failed)))
+		    LogNodeThroughput(task_srcs, starttime)
 		    logger.info("Done")
 
 
@@ -270,7 +359,7 @@ def main():
 	lfh.setFormatter(formatter)
 	logger.addHandler(lfh)
 
-	done = os.path.isfile(dstfp)
+	done = run_state.is_done(run_state.get(opt.run_state),run_state.scene_name(src),"stretched",dstfp)
 
 	if done is False:
 	    rc = processImage(src,dstfp,opt)
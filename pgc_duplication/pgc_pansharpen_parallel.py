@@ -1,11 +1,20 @@
-import os, string, sys, shutil, math, glob, re, tarfile, argparse
+import os, string, sys, shutil, math, glob, re, tarfile, argparse, copy, traceback
 from datetime import datetime, timedelta
 
 from subprocess import *
 from lib.ortho_utils import *
+from lib import catalog
+from lib import finalize
+from lib import pansharpen as pansharpen_engine
+from lib import resources
+from lib import run_state
+from lib import scheduler
+from lib import submission
 
 import gdal, ogr,osr, gdalconst
 
+SUBMISSION_TYPES = ['HPC','VM',submission.SLURM]
+ENGINES = ['numpy','gdal_landsat_pansharp']
 
 #### Reg Exs
 
@@ -50,6 +59,183 @@ def get_multispectral_name(sensor,pan_name):
 
     return mul_name
 
+
+class Pair(object):
+    """Paths of a pan/multispectral pair and its pansharpened output."""
+
+    def __init__(self, panfp, mulfp, sensor, res, opt, wd, dstdir):
+        self.panfp = panfp
+        self.mulfp = mulfp
+        self.sensor = sensor
+        self.pan_res = str(res)
+        self.mul_res = str(res*4.0)
+        self.wd = wd
+        self.dstdir = dstdir
+
+        bittype = getBitdepth(opt.outtype)
+        p = os.path.splitext(os.path.basename(panfp))[0]
+        m = os.path.splitext(os.path.basename(mulfp))[0]
+        self.panolp = os.path.join(wd,"%s_%s%s%s.tif"%(p,bittype,opt.stretch,opt.epsg))
+        self.mulolp = os.path.join(wd,"%s_%s%s%s.tif"%(m,bittype,opt.stretch,opt.epsg))
+        self.panop = os.path.join(dstdir,"%s_%s%s%s.tif"%(p,bittype,opt.stretch,opt.epsg))
+        self.mulop = os.path.join(dstdir,"%s_%s%s%s.tif"%(m,bittype,opt.stretch,opt.epsg))
+        self.panshtp = os.path.join(wd,"%s_%s%s%s_pansh_temp.tif"%(p,bittype,opt.stretch,opt.epsg))
+        self.panshlp = os.path.join(wd,"%s_%s%s%s_pansh.tif"%(p,bittype,opt.stretch,opt.epsg))
+        self.panshp = os.path.join(dstdir,"%s_%s%s%s_pansh.tif"%(p,bittype,opt.stretch,opt.epsg))
+
+
+def ortho_member(srcfp, dstfp, localfp, resolution, opt):
+    """Orthos one image of a pair and makes it available in the working dir."""
+    rc = 0
+    done = run_state.is_done(run_state.get(opt.run_state),run_state.scene_name(srcfp),"stretched",dstfp)
+    if not done and not os.path.isfile(localfp):
+        member_opt = copy.copy(opt)
+        member_opt.resolution = resolution
+        rc = processImage(srcfp,dstfp,member_opt)
+
+    if not os.path.isfile(localfp) and os.path.isfile(dstfp):
+        shutil.copy2(dstfp,localfp)
+    return rc
+
+
+def pansharpen(pair, opt):
+    """Pansharpens the orthoed pair, then compresses, builds pyramids and cleans up."""
+    rc = 0
+    wd, dstdir = pair.wd, pair.dstdir
+    threads = resources.warp_settings(opt.processes, opt.warp_threads, opt.warp_memory)[0]
+
+    #### With a run state, outputs left by an interrupted job are redone
+    state = run_state.get(opt.run_state)
+    scene = run_state.scene_name(pair.panfp)
+    if state is not None:
+        for fp in (pair.panshtp,pair.panshlp,pair.panshp):
+            if os.path.isfile(fp):
+                os.remove(fp)
+        state.start(scene,"pansharpened")
+
+    ####  Pansharpen: the numpy engine writes the compressed output directly
+    if not (os.path.isfile(pair.panolp) and os.path.isfile(pair.mulolp)):
+        print "Pan or Multi warped image does not exist\n\t%s\n\t%s" %(pair.panolp,pair.mulolp)
+        rc = 1
+    elif opt.pansharpen_engine == 'numpy':
+        if not os.path.isfile(pair.panshlp):
+            LogMsg("Pansharpening with %s Brovey, %i threads" %(opt.pansharpen_method,threads))
+            rc = pansharpen_engine.pansharpen(pair.panolp,pair.mulolp,pair.panshlp,pair.sensor,opt.pansharpen_method,threads)
+    elif not os.path.isfile(pair.panshtp):
+        cmd = 'gdal_landsat_pansharp -rgb "%s" -pan "%s" -o "%s"' %(pair.mulolp,pair.panolp,pair.panshtp)
+        err, so, se = ExecCmd(cmd)
+        rc = err
+
+    #### Compress
+    if os.path.isfile(pair.panshtp) and not os.path.isfile(pair.panshlp):
+        cmd = 'gdal_translate -co BIGTIFF=IF_SAFER -co COMPRESS=LZW -co TILED=YES "%s" "%s"' %(pair.panshtp,pair.panshlp)
+        ExecGdalCmd(cmd)
+
+    #### Make pyramids and stats (the numpy engine already wrote the stats)
+    if os.path.isfile(pair.panshlp) and not opt.no_pyramids:
+        if finalize.run(pair.panshlp, opt.pyramid_levels, opt.pyramid_resampling, approx=opt.approx_stats, threads=threads) == 1:
+            rc = 1
+
+    #### Copy pansharpened output
+    if wd <> dstdir:
+        for local_path, dst_path in [(pair.panshlp,pair.panshp), (pair.panolp,pair.panop), (pair.mulolp,pair.mulop)]:
+            if os.path.isfile(local_path) and not os.path.isfile(dst_path):
+                shutil.copy2(local_path,dst_path)
+
+    if state is not None:
+        if rc == 0 and os.path.isfile(pair.panshp):
+            state.finish(scene,"pansharpened",pair.panshp)
+        else:
+            state.fail(scene,"pansharpened","Pansharpened image not built")
+
+    #### Delete Temp Files
+    temp_files = [pair.panshtp]
+    wd_files = [
+        pair.panshlp,
+        pair.panolp,
+        pair.mulolp
+    ]
+
+    if not opt.save_temps:
+        for f in temp_files:
+            try:
+                os.remove(f)
+            except Exception, e:
+                LogMsg('Could not remove %s: %s' %(os.path.basename(f),e))
+
+        if wd <> dstdir:
+            for f in wd_files:
+                try:
+                    os.remove(f)
+                except Exception, e:
+                    LogMsg('Could not remove %s: %s' %(os.path.basename(f),e))
+    return rc
+
+
+def run_pair_step(step, pair, opt):
+    """Scheduler task: one ortho or the pansharpening of pair.  Never raises."""
+    try:
+        if step == "pan":
+            rc = ortho_member(pair.panfp,pair.panop,pair.panolp,pair.pan_res,opt)
+        elif step == "mul":
+            rc = ortho_member(pair.mulfp,pair.mulop,pair.mulolp,pair.mul_res,opt)
+        else:
+            rc = pansharpen(pair,opt)
+    except Exception:
+        logger.error("%s step failed for %s:\n%s" %(step,os.path.basename(pair.panfp),traceback.format_exc()))
+        rc = 1
+    return rc
+
+
+def pair_task(step, pair, opt):
+    return scheduler.Task("%s %s" %(os.path.basename(pair.panfp),step),(step,pair,opt))
+
+
+def run_pairs(pairs, opt, processes):
+    """
+    Orthos the pan and multispectral image of each pair concurrently and
+    pansharpens a pair as soon as both are done, ahead of the orthos of the
+    following pairs.  The steps run in lib.scheduler workers, so a worker
+    killed by a crash or the OOM killer, or a step past --task_timeout,
+    fails that step instead of stalling the run.  With one process the
+    steps run in order in this process.
+    """
+    for pair in pairs:
+        if not os.path.isdir(pair.wd):
+            os.makedirs(pair.wd)
+
+    if processes < 2:
+        for pair in pairs:
+            for step in ("pan","mul","pansh"):
+                run_pair_step(step,pair,opt)
+        return
+
+    tasks = []
+    for pair in pairs:
+        tasks.extend([pair_task("pan",pair,opt), pair_task("mul",pair,opt)])
+    orthos_left = dict((pair.panfp,2) for pair in pairs)
+
+    def then(task, rc):
+        step, pair = task.args[:2]
+        if step in ("pan","mul"):
+            orthos_left[pair.panfp] -= 1
+            if orthos_left[pair.panfp] == 0:
+                logger.info("Pansharpening pair: %s" %os.path.basename(pair.panfp))
+                return [pair_task("pansh",pair,opt)]
+        elif rc == 0:
+            logger.info("Pansharpened: %s" %os.path.basename(pair.panshp))
+        else:
+            logger.error("Pansharpening failed: %s" %os.path.basename(pair.panfp))
+
+    try:
+        scheduler.run(tasks, run_pair_step, processes,
+            timeout=opt.task_timeout * 60 if opt.task_timeout else None,
+            retries=opt.task_retries,
+            then=then)
+    except KeyboardInterrupt:
+        logger.info("Processes terminated without file cleanup")
+
+
 def main():
 
 
@@ -65,9 +251,25 @@ def main():
                       help="qsub script to use in cluster job submission (default is qsub_pansharpen.sh in script root folder)")
     parser.add_argument("--dryrun", action="store_true", default=False,
                     help="print actions without executing")
+    parser.add_argument("--submission_type", choices=SUBMISSION_TYPES,
+                      help="job submission type. Default is HPC unless only SLURM is available (%s)"%string.join(SUBMISSION_TYPES,','))
+    parser.add_argument("--processes", type=int,
+                      help="number of processes orthoing and pansharpening pairs at once (VM, or per image job; default 1)")
+    parser.add_argument("--task_timeout", type=float,
+                      help="minutes after which an ortho or pansharpening step is killed and counted as failed (VM only, default no limit)")
+    parser.add_argument("--task_retries", type=int, default=0,
+                      help="number of times a failed or timed out step is retried (VM only, default 0)")
+    parser.add_argument("--pansharpen_engine", choices=ENGINES, default='numpy',
+                      help="numpy: in-process blockwise Brovey writing the compressed output in one pass (default); "
+                      "gdal_landsat_pansharp: external tool followed by gdal_translate")
+    parser.add_argument("--pansharpen_method", choices=pansharpen_engine.METHODS, default='weighted',
+                      help="numpy engine only: weighted Brovey with the sensor's band weights (default) or plain Brovey")
+    submission.add_arguments(parser)
 
     #### Parse Arguments
     opt = parser.parse_args()
+    if opt.run_state is not None:
+        opt.run_state = os.path.abspath(opt.run_state)
     scriptpath = os.path.abspath(sys.argv[0])
     src = os.path.abspath(opt.src)
     dstdir = os.path.abspath(opt.dst)
@@ -75,6 +277,8 @@ def main():
     #### Validate Required Arguments
     if os.path.isdir(src):
         srctype = 'dir'
+    elif catalog.is_catalog(src):
+        srctype = 'catalog'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() == '.txt':
         srctype = 'textfile'
     elif os.path.isfile(src) and os.path.splitext(src)[1].lower() in exts:
@@ -93,9 +297,6 @@ def main():
     else:
         qsubpath = os.path.abspath(opt.qsubscript)
 
-    if not os.path.isfile(qsubpath):
-        parser.error("qsub script path is not valid: %s" %qsubpath)
-
     #### Verify EPSG
     try:
         spatial_ref = SpatialRef(opt.epsg)
@@ -113,8 +314,34 @@ def main():
     ###############################
     ####  Submission logic
     ################################
-    if srctype in ['dir','textfile']:
+    if srctype in ['dir','textfile','catalog']:
+
+        ####  Determine submission type based on presence of pbsnodes and sbatch cmds
+        try:
+            p = Popen("pbsnodes", stdout=PIPE, stderr=PIPE)
+            so, se = p.communicate()
+        except OSError,e:
+            is_hpc = False
+        else:
+            is_hpc = True
+
+        if opt.submission_type is None:
+            submission_type = "HPC" if is_hpc else submission.SLURM if submission.slurm_available() else "VM"
+        elif opt.submission_type == "HPC" and is_hpc is False:
+            parser.error("Submission type HPC is not available on this system")
+        elif opt.submission_type == submission.SLURM and not submission.slurm_available():
+            parser.error("Submission type SLURM is not available on this system")
+        else:
+            submission_type = opt.submission_type
+        print "Submission type: %s" %submission_type
+        pairs = []
+        processes = max(opt.processes or 1, 1)
+        if submission_type == 'VM':
+            wd = opt.wd if opt.wd is not None else dstdir
 
+        if submission_type == 'HPC' and not os.path.isfile(qsubpath):
+            parser.error("qsub script path is not valid: %s" %qsubpath)
+        task_queue = []
 
         #### Get args ready to pass through
         #### Get -l args and make a var
@@ -122,7 +349,7 @@ def main():
 
         args_dict = vars(opt)
         arg_list = []
-        arg_keys_to_remove = ('l','qsubscript')
+        arg_keys_to_remove = ('l','qsubscript') + catalog.QUERY_ARG_KEYS + submission.ARG_KEYS
 
         ## Add optional args to arg_list
         for k,v in args_dict.iteritems():
@@ -150,9 +377,15 @@ def main():
                 else:
                     logger.warning('Src image does not exist: %s' %line.rstrip())
             t.close()
+        elif srctype == 'catalog':
+            image_list = catalog.query_from_args(src, opt, prime=False)
 
         print 'Number of images to process: %i' %len(image_list)
 
+        state = run_state.get(opt.run_state)
+        if state is not None:
+            completed = state.completed("pansharpened")
+
         #### Loop over images
         i = 0
 	j = 0
@@ -179,14 +412,23 @@ def main():
                 panshp = os.path.join(dstdir,"%s_%s%s%s_pansh.tif"%(os.path.splitext(srcname)[0],bittype,opt.stretch,opt.epsg))
 
                 if os.path.isfile(mulp):
-                    if not os.path.isfile(panshp):
-
-                        cmd = r'qsub %s -N Pansh%04i -v p1="%s %s %s %s" "%s"' %(l,i,scriptpath,arg_str,image,dstdir,qsubpath)
+                    if state is not None:
+                        done = run_state.scene_name(image) in completed
+                    else:
+                        done = os.path.isfile(panshp)
+                    if not done:
+
+                        if submission_type == 'VM':
+                            pairs.append(Pair(image,mulp,sensor,res,opt,wd,dstdir))
+                        elif submission_type == submission.SLURM:
+                            task_queue.append((srcname, r'python %s %s %s %s' %(scriptpath,arg_str,image,dstdir)))
+                        else:
+                            cmd = r'qsub %s -N Pansh%04i -v p1="%s %s %s %s" "%s"' %(l,i,scriptpath,arg_str,image,dstdir,qsubpath)
                         
-                        if not opt.dryrun:
-                            print i, cmd
-			    p = Popen(cmd,shell=True)
-                            p.wait()
+                            if not opt.dryrun:
+                                print i, cmd
+                                p = Popen(cmd,shell=True)
+                                p.wait()
                         i+=1
 
                 else:
@@ -195,6 +437,12 @@ def main():
 	if j<1:
 	    print "No panchromatic images found matching name patterns"
 
+        if submission_type == submission.SLURM:
+            submission.submit_array(task_queue, "Pansh", dstdir, opt, opt.dryrun)
+        elif submission_type == 'VM' and not opt.dryrun:
+            print "Pairs to process: %i, processes: %i" %(len(pairs),processes)
+            run_pairs(pairs, opt, processes)
+
 
     ###############################
     ####  Execution logic
@@ -237,91 +485,15 @@ def main():
                 print "Error: Multispectral image not found: %s" %(mulp)
 
             else:
-
-                if opt.dem is not None:
-                    dem_arg = '-d "%s" ' %opt.dem
-                else:
-                    dem_arg = ""
-
-                bittype = getBitdepth(opt.outtype)
-
-                p = os.path.splitext(srcname)[0]
-                m = os.path.splitext(mul_name)[0]
-                panolp = os.path.join(wd,"%s_%s%s%s.tif"%(p,bittype,opt.stretch,opt.epsg))
-                mulolp = os.path.join(wd,"%s_%s%s%s.tif"%(m,bittype,opt.stretch,opt.epsg))
-                panop = os.path.join(dstdir,"%s_%s%s%s.tif"%(p,bittype,opt.stretch,opt.epsg))
-                mulop = os.path.join(dstdir,"%s_%s%s%s.tif"%(m,bittype,opt.stretch,opt.epsg))
-                panshtp = os.path.join(wd,"%s_%s%s%s_pansh_temp.tif"%(p,bittype,opt.stretch,opt.epsg))
-                panshlp = os.path.join(wd,"%s_%s%s%s_pansh.tif"%(p,bittype,opt.stretch,opt.epsg))
-                panshp = os.path.join(dstdir,"%s_%s%s%s_pansh.tif"%(p,bittype,opt.stretch,opt.epsg))
+                pair = Pair(src,mulp,sensor,res,opt,wd,dstdir)
 
                 #### Check if pansh is already present
-                if not os.path.isfile(panshp) and not opt.dryrun:
-
-                    if not os.path.isdir(wd):
-                        os.makedirs(wd)
-
-                    ####  Ortho pan
-                    if not os.path.isfile(panop) and not os.path.isfile(panolp):
-                        opt.resolution = str(res)
-                        rc = processImage(src,panop,opt)
-
-                    if not os.path.isfile(panolp) and os.path.isfile(panop):
-                        shutil.copy2(panop,panolp)
-
-
-                    ####  Ortho multi - call python script: also copies to output, add do not delete temp files flag
-                    if not os.path.isfile(mulop) and not os.path.isfile(mulolp):
-                        opt.resolution = str(res*4.0)
-                        rc = processImage(mulp,mulop,opt)
-
-                    if not os.path.isfile(mulolp) and os.path.isfile(mulop):
-                        shutil.copy2(mulop,mulolp)
-
-                    ####  Pansharpen
-                    if os.path.isfile(panolp) and os.path.isfile(mulolp) and not os.path.isfile(panshtp):
-                        cmd = 'gdal_landsat_pansharp -rgb "%s" -pan "%s" -o "%s"' %(mulolp,panolp,panshtp)
-                        ExecCmd(cmd)
-                    else:
-                        print "Pan or Multi warped image does not exist\n\t%s\n\t%s" %(panolp,mulolp)
-
-                    #### Compress
-                    if os.path.isfile(panshtp) and not os.path.isfile(panshlp):
-                        cmd = 'gdal_translate -stats -co BIGTIFF=IF_SAFER -co COMPRESS=LZW -co TILED=YES "%s" "%s"' %(panshtp,panshlp)
-                        ExecCmd(cmd)
-
-                    #### Make pyramids
-                    if os.path.isfile(panshlp):
-                       cmd = 'gdaladdo "%s" 2 4 8 16' %(panshlp)
-                       ExecCmd(cmd)
-
-                    #### Copy pansharpened output
-                    if wd <> dstdir:
-                        for local_path, dst_path in [(panshlp,panshp), (panolp,panop), (mulolp,mulop)]:
-                            if os.path.isfile(local_path) and not os.path.isfile(dst_path):
-                                shutil.copy2(local_path,dst_path)
-
-                    #### Delete Temp Files
-                    temp_files = [panshtp]
-                    wd_files = [
-                        panshlp,
-                        panolp,
-                        mulolp
-                    ]
-
-                    if not opt.save_temps:
-                        for f in temp_files:
-                            try:
-                                os.remove(f)
-                            except Exception, e:
-                                LogMsg('Could not remove %s: %s' %(os.path.basename(f),e))
-
-                        if wd <> dstdir:
-                            for f in wd_files:
-                                try:
-                                    os.remove(f)
-                                except Exception, e:
-                                    LogMsg('Could not remove %s: %s' %(os.path.basename(f),e))
+                state = run_state.get(opt.run_state)
+                if not run_state.is_done(state,run_state.scene_name(src),"pansharpened",pair.panshp) and not opt.dryrun:
+                    #### Orthos running side by side each size themselves for half the job
+                    pair_opt = copy.copy(opt)
+                    pair_opt.processes = min(max(opt.processes or 1, 1), 2)
+                    run_pairs([pair], pair_opt, pair_opt.processes)
 
 
 if __name__ == '__main__':
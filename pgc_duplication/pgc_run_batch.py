@@ -0,0 +1,44 @@
+import os, sys, logging, argparse
+
+from lib import submission
+
+#### Create Loggers
+logger = logging.getLogger("logger")
+logger.setLevel(logging.DEBUG)
+
+
+def main():
+
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Run one SLURM array element's batch of tasks from a submission manifest"
+        )
+
+    parser.add_argument("manifest", help="task manifest written at submission, one command per line")
+    parser.add_argument("index", type=int, help="array element index (SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--batch_size", type=int, default=10,
+                        help="tasks per array element, as at submission (default 10)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="tasks to run at the same time (default 1, sequential)")
+
+    #### Parse Arguments
+    opt = parser.parse_args()
+    if not os.path.isfile(opt.manifest):
+        parser.error("Manifest does not exist: %s" % opt.manifest)
+
+    #### Set Up Logging Handlers
+    lso = logging.StreamHandler()
+    lso.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S')
+    lso.setFormatter(formatter)
+    logger.addHandler(lso)
+
+    failed = submission.run_batch(opt.manifest, opt.index, opt.batch_size, opt.processes)
+    if failed:
+        logger.error("%i tasks failed" % failed)
+        sys.exit(1)
+    logger.info("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Overlapped read / classify / write pipeline for batch classification.
+
+process_file reads a whole scene, classifies it and then writes its outputs,
+so the CPU idles while the shared filesystem is busy and vice versa.  Here
+each stage runs in its own thread, connected by queues holding at most
+`depth` scenes: the next scene is read while the current one is classified
+and the previous one's outputs are written.  GDAL releases the GIL while
+reading, writing and compressing, so the I/O really overlaps the classifier.
+The decision tree uses scene-wide statistics, so the unit of work is a whole
+scene rather than a window.
+
+usage:
+    python -m wv_classify.pipeline output_dir roi_name tif xml [tif xml ...]
+"""
+import argparse
+import threading
+import time
+from queue import Queue
+
+from lib import run_state
+
+_END = object()
+
+
+class Stage(object):
+    """One pipeline stage and the time it spent working."""
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.busy = 0.0
+        self.items = 0
+
+    def utilization(self, wall):
+        return self.busy / wall if wall > 0 else 0.0
+
+
+def run(items, stages, depth=1):
+    """
+    Passes every item through stages, a list of (name, func) pairs where
+    each func takes the previous stage's result.  An item whose stage
+    raises is dropped from the later stages.
+
+    returns:
+    --------
+    failures : list
+        (item, stage name, exception) of the items that failed.
+    stages : list
+        the Stage objects, with their busy time and item counts.
+    wall : float
+        elapsed seconds.
+    """
+    stages = [Stage(name, func) for name, func in stages]
+    queues = [Queue(maxsize=max(1, depth)) for _ in stages]
+    failures = []
+    lock = threading.Lock()
+
+    def work(i, stage):
+        inbox = queues[i]
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        while True:
+            task = inbox.get()
+            if task is _END:
+                if outbox is not None:
+                    outbox.put(_END)
+                return
+            item, value = task
+            start = time.time()
+            try:
+                result = stage.func(value)
+            except Exception as e:
+                with lock:
+                    failures.append((item, stage.name, e))
+                print("{} failed for {}: {}".format(stage.name, item, e))
+                continue
+            finally:
+                stage.busy += time.time() - start
+                stage.items += 1
+            if outbox is not None:
+                outbox.put((item, result))
+
+    start = time.time()
+    threads = [
+        threading.Thread(target=work, args=(i, stage), name=stage.name)
+        for i, stage in enumerate(stages)
+    ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for item in items:
+        queues[0].put((item, item))
+    queues[0].put(_END)
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+    return failures, stages, wall
+
+
+def report(stages, wall):
+    """Prints each stage's busy time and utilization."""
+    print("pipeline: {:.1f}s wall".format(wall))
+    for stage in stages:
+        print("\t{:<10} {:4d} scenes {:8.1f}s busy {:5.1%} utilized".format(
+            stage.name, stage.items, stage.busy, stage.utilization(wall)
+        ))
+
+
+def process_files(
+    pairs,  # (MS Tiff input image path, XML met input file path) pairs
+    loc_out,  # output directory
+    loc,  # RoI identifier string
+    coor_sys=4326,  # coordinate system code
+    d_t=2,  # 0=End after Rrs conversion; 2 = rrs, bathy & DT
+    Rrs_write=1,  # 1=write Rrs geotiff; 0=do not write
+    depth=1,  # scenes waiting between two stages
+    state_path=None,  # SQLite run state file recording each scene's stages
+):
+    """
+    process_file for many scenes, with reading, classification and writing
+    overlapped.  With state_path, scenes recorded as done are skipped.
+    Returns the failures as listed by run().
+    """
+    # GDAL is only needed once there is something to classify
+    from wv_classify.wv_classify_v1 import (
+        read_scene, classify_scene, write_outputs, scene_done, final_stage,
+        record_outputs
+    )
+    if d_t == 1:
+        raise NotImplementedError("rrs output only not yet supported")
+
+    state = run_state.get(state_path)
+    todo = [
+        pair for pair in pairs
+        if not scene_done(state, pair[0], loc_out, loc, d_t, Rrs_write)
+    ]
+    if len(todo) < len(pairs):
+        print("{} scenes recorded as done".format(len(pairs) - len(todo)))
+
+    def read(pair):
+        # each stage thread has its own run state connection
+        state = run_state.get(state_path)
+        if state is not None:
+            state.start(run_state.scene_name(pair[0]), final_stage(d_t))
+        return read_scene(*pair)
+
+    def classify(scene):
+        X = scene["X"]
+        return X, scene["R"], classify_scene(
+            scene, loc_out, loc, d_t, Rrs_write
+        )
+
+    def write(classified):
+        X, R, outputs = classified
+        write_outputs(outputs, R, coor_sys)
+        record_outputs(
+            run_state.get(state_path), X, loc_out, loc, d_t, Rrs_write
+        )
+
+    failures, stages, wall = run(
+        todo,
+        [
+            ("read", read),
+            ("classify", classify),
+            ("write", write),
+        ],
+        depth
+    )
+    report(stages, wall)
+    if state is not None:
+        for pair, stage, e in failures:
+            state.fail(
+                run_state.scene_name(pair[0]), final_stage(d_t),
+                "{}: {}".format(stage, e)
+            )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="classify WorldView-2 scenes, overlapping I/O and compute"
+    )
+    parser.add_argument("output_dir")
+    parser.add_argument("roi_name")
+    parser.add_argument("files", nargs="+", help="tif xml [tif xml ...]")
+    parser.add_argument("--dt", type=int, default=2, choices=[0, 2],
+                        help="0 = Rrs only; 2 = rrs, bathy & DT (default)")
+    parser.add_argument("--no_rrs", action="store_true",
+                        help="do not write the Rrs geotiff")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="scenes held between stages (default 1)")
+    run_state.add_arguments(parser)
+    args = parser.parse_args()
+    if len(args.files) % 2 != 0:
+        parser.error("files must be tif xml pairs")
+
+    pairs = list(zip(args.files[0::2], args.files[1::2]))
+    failures = process_files(
+        pairs, args.output_dir, args.roi_name, 4326, args.dt,
+        0 if args.no_rrs else 1, args.depth, args.run_state
+    )
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# std modules:
+from unittest import TestCase
+import time
+
+from wv_classify import pipeline
+
+
+class Test_pipeline(TestCase):
+    def test_stages_overlap(self):
+        """the next scene is read while the current one is classified."""
+        active = set()
+        overlapped = []
+
+        def stage(name):
+            def func(value):
+                active.add(name)
+                if len(active) > 1:
+                    overlapped.append(True)
+                time.sleep(0.05)
+                active.discard(name)
+                return value
+            return func
+
+        written = []
+        failures, stages, wall = pipeline.run(
+            range(4),
+            [("read", stage("read")), ("classify", stage("classify")),
+             ("write", written.append)]
+        )
+        self.assertEqual(failures, [])
+        self.assertEqual(written, [0, 1, 2, 3])
+        self.assertTrue(overlapped)
+        self.assertTrue(wall < 4 * 2 * 0.05)
+        self.assertEqual([s.items for s in stages], [4, 4, 4])
+
+    def test_failed_scene_skips_later_stages(self):
+        """a scene that fails to classify is reported and not written."""
+        def classify(value):
+            if value == 1:
+                raise ValueError("bad scene")
+            return value
+
+        written = []
+        failures, stages, wall = pipeline.run(
+            [0, 1, 2], [("classify", classify), ("write", written.append)]
+        )
+        self.assertEqual(written, [0, 2])
+        self.assertEqual([(item, name) for item, name, e in failures],
+                         [(1, "classify")])
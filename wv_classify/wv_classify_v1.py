@@ -43,9 +43,11 @@ from wv_classify.matlab_fns import tand
 from wv_classify.matlab_fns import acosd
 from wv_classify.matlab_fns import asind
 from wv_classify.matlab_fns import rdivide
-from wv_classify.read_wv_xml import read_wv_xml
+from wv_classify.read_wv_xml import read_wv_metadata
+from wv_classify.read_wv_xml import WV2_MS_BANDS
 from wv_classify.run_rrs import run_rrs
 from wv_classify.stumpf_relative_depth import stumpf_relative_depth
+from lib import run_state
 
 OUTPUT_NaN = numpy.nan
 BASE_DATATYPE = numpy.float32
@@ -76,6 +78,7 @@ def process_file(
     coor_sys=4326,  # coordinate system code
     d_t=2,  # 0=End after Rrs conversion; 1=rrs, bathy, DT; 2 = rrs, bathy & DT
     Rrs_write=1,  # 1=write Rrs geotiff; 0=do not write
+    state_path=None,  # SQLite run state file recording the scene's stages
 ):
     """
     process a single set of files
@@ -83,22 +86,128 @@ def process_file(
     if d_t == 1:  # this is here to catch it quickly
         raise NotImplementedError("rrs output only not yet supported")
 
+    state = run_state.get(state_path)
+    if scene_done(state, X, loc_out, loc, d_t, Rrs_write):
+        print("\tscene recorded as done: {}".format(X))
+        return
+    if state is not None:
+        state.start(run_state.scene_name(X), final_stage(d_t))
+    try:
+        scene = read_scene(X, Z)
+        outputs = classify_scene(scene, loc_out, loc, d_t, Rrs_write)
+        write_outputs(outputs, scene["R"], coor_sys)
+    except Exception as e:
+        if state is not None:
+            state.fail(run_state.scene_name(X), final_stage(d_t), str(e))
+        raise
+    record_outputs(state, X, loc_out, loc, d_t, Rrs_write)
+
+
+def stage_outputs(
+    X,  # MS Tiff input image path
+    loc_out,  # output directory
+    loc,  # RoI identifier string
+    d_t=2,  # 0=End after Rrs conversion; 2 = rrs, bathy & DT
+    Rrs_write=1,  # 1=write Rrs geotiff; 0=do not write
+):
+    """
+    {run state stage: output path} of the scene in X: "calibrated" is the
+    Rrs geotiff (None if not written) and, if d_t > 0, "classified" is the
+    class map.
+    """
     if not loc_out.endswith("/"):
         loc_out += "/"
+    id = path.basename(X)[0:18]
+    outputs = {"calibrated": None}
+    if Rrs_write == 1:
+        outputs["calibrated"] = ''.join([loc_out, id, '_', loc, '_Rrs.tif'])
+    if d_t > 0:
+        outputs["classified"] = ''.join([loc_out, id, '_', loc, '_Map_pytest.tif'])
+    return outputs
 
-    fname = path.basename(X)
-    id = fname[0:18]
 
+def final_stage(d_t=2):
+    """The last run state stage a scene goes through."""
+    return "classified" if d_t > 0 else "calibrated"
+
+
+def scene_done(state, X, loc_out, loc, d_t=2, Rrs_write=1):
+    """Whether state records the scene in X as done with unchanged outputs."""
+    if state is None:
+        return False
+    stage = final_stage(d_t)
+    output = stage_outputs(X, loc_out, loc, d_t, Rrs_write)[stage]
+    return state.is_done(run_state.scene_name(X), stage, output)
+
+
+def record_outputs(state, X, loc_out, loc, d_t=2, Rrs_write=1):
+    """Records the stages of the scene in X as done once its outputs exist."""
+    if state is None:
+        return
+    scene = run_state.scene_name(X)
+    for stage, output in sorted(stage_outputs(X, loc_out, loc, d_t, Rrs_write).items()):
+        state.finish(scene, stage, output)
+
+
+def read_scene(X, Z):
+    """
+    Reads the ortho image X and its metadata Z.
+
+    returns:
+    --------
+    scene : dict
+        X, A (the image as A[row, col, band]), R (spatial ref) and met.
+        classify_scene pops A so the image can be freed once Rrs exists.
+    """
     A, R = geotiffread(X, numpy_dtype=BASE_DATATYPE)
+    met = read_wv_metadata(Z)
+    return {"X": X, "A": A, "R": R, "met": met}
+
+
+def write_outputs(outputs, R, coor_sys=4326):
+    """Writes the (path, array) outputs of classify_scene as geotiffs."""
+    for Z, arr in outputs:
+        geotiffwrite(Z, arr, R, CoordRefSysCode=coor_sys)
+
+
+def classify_scene(
+    scene,  # from read_scene
+    loc_out,  # output directory
+    loc,  # RoI identifier string
+    d_t=2,  # 0=End after Rrs conversion; 1=rrs, bathy, DT; 2 = rrs, bathy & DT
+    Rrs_write=1,  # 1=write Rrs geotiff; 0=do not write
+):
+    """
+    Calibrates and classifies a scene read by read_scene.
+
+    returns:
+    --------
+    outputs : list
+        (output path, array) pairs, in the order they used to be written.
+    """
+    if d_t == 1:  # this is here to catch it quickly
+        raise NotImplementedError("rrs output only not yet supported")
+
+    if not loc_out.endswith("/"):
+        loc_out += "/"
+
+    outputs = []
+    fname = path.basename(scene["X"])
+    id = fname[0:18]
+
+    A = scene.pop("A")
     print("\tinput size: {}".format(A.shape))
     szA = [A.shape[0], A.shape[1], A.shape[2]]
 
-    (
-        szB, aqmonth, aqyear, aqhour, aqminute, aqsecond, sunaz, sunel,
-        satel, sensaz, aqday, satview, kf, cl_cov
-    ) = read_wv_xml(Z)
+    met = scene["met"]
+    aq_dt = met.acqtime
+    aqyear, aqmonth, aqday = aq_dt.year, aq_dt.month, aq_dt.day
+    aqhour, aqminute, aqsecond = aq_dt.hour, aq_dt.minute, aq_dt.second
+    sunaz, sunel, satel = met.sunaz, met.sunel, met.satel
+    sensaz, satview = met.sataz, met.offnadir
+    kf = [met.abscalfactor[band] for band in WV2_MS_BANDS]
 
-    szB[2] = 8
+    szB = [met.numrows, met.numcolumns, 8]
 
     print(" === calculating coefficients...")
     # ==================================================================
@@ -331,8 +440,9 @@ def process_file(
     print("\t  Rrs size: {}".format(Rrs.shape))
     # === Output reflectance image
     if Rrs_write == 1:
-        Z = ''.join([loc_out, id, '_', loc, '_Rrs.tif'])
-        geotiffwrite(Z, Rrs, R, CoordRefSysCode=coor_sys)
+        Z = stage_outputs(scene["X"], loc_out, loc, d_t, Rrs_write)["calibrated"]
+        # the DT below converts Rrs to rrs in place
+        outputs.append((Z, Rrs.copy() if d_t > 0 else Rrs))
     # end
 
     if d_t > 0:
@@ -816,16 +926,17 @@ def process_file(
         #         AA, dt_filt, R, CoordRefSysCode=coor_sys
         #     )
         # else:
-        Z1 = ''.join([loc_out, id, '_', loc, '_Map_pytest.tif'])
-        geotiffwrite(Z1, classif_map, R, CoordRefSysCode=coor_sys)
+        Z1 = stage_outputs(scene["X"], loc_out, loc, d_t, Rrs_write)["classified"]
+        outputs.append((Z1, classif_map))
         # end
 
         # === Output images
         # Z = [loc_out, id, '_', loc, '_Bathy1']
         # geotiffwrite(Z, Bathy, R(1, 1), CoordRefSysCode=coor_sys)
         Z2 = ''.join([loc_out, id, '_', loc, '_rrssub.tif'])  # last=52
-        geotiffwrite(Z2, Rrs, R, CoordRefSysCode=coor_sys)
+        outputs.append((Z2, Rrs))
     # end  # If dt == 2
+    return outputs
 # end
 
 